@@ -17,12 +17,18 @@ import matplotlib
 matplotlib.use("TkAgg")   # NOTE: import order matters
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib import pyplot as plt
-from matplotlib.collections import LineCollection
 # - RETINA SSPD driver IMPORTS
 #from Code.RetinaFiles.src.WebSQController import WebSQController
 # - Spectro GUI Library IMPORTS
 from Code.SpectroGUILibrary.CIEColorMatching import ColorMatchingCIE
 from Code.SpectroGUILibrary.SpectroGUILibrary import ETA, LiveCounts, DebuggingFunctions
+from Code.SpectroGUILibrary.TimeresIndex import TimeresIndex
+from Code.SpectroGUILibrary.AnalysisRunner import AnalysisRunner
+from Code.SpectroGUILibrary.LiveAnalysis import LiveLifetime, TimeresTail, SyntheticTagStream
+from Code.SpectroGUILibrary.TimeresFile import temp_timeres_file
+from Code.SpectroGUILibrary.PlotArtists import LinePlot, ColorRowPlot
+from Code.SpectroGUILibrary.HistogramPyramid import HistogramPyramid, axis_pixels
+from Code.SpectroGUILibrary.ScanResults import ScanResults
 #from Code.SpectroGUILibrary.SpectroGUILibrary import TT
 
 
@@ -147,9 +153,15 @@ class Plotting:
             #ttk.Checkbutton(butt_frame_t, text=lookup['h23'], command=update_plot, variable=self.ch_show_correlation['h23'], onvalue=True, offvalue=False).grid(row=0, column=0, columnspan=1, sticky="ew")
             #ttk.Checkbutton(butt_frame_t, text=lookup['h24'], command=update_plot, variable=self.ch_show_correlation['h24'], onvalue=True, offvalue=False).grid(row=1, column=0, columnspan=1, sticky="ew")
             #ttk.Checkbutton(butt_frame_t, text=lookup['h34'], command=update_plot, variable=self.ch_show_correlation['h34'], onvalue=True, offvalue=False).grid(row=2, column=0, columnspan=1, sticky="ew")
-            ttk.Radiobutton(butt_frame_t, text=lookup['h23'], variable=active_plot, value='h23', command=update_plot).grid(row=0, column=0, columnspan=1, sticky="ew")
-            ttk.Radiobutton(butt_frame_t, text=lookup['h24'], variable=active_plot, value='h24', command=update_plot).grid(row=1, column=0, columnspan=1, sticky="ew")
-            ttk.Radiobutton(butt_frame_t, text=lookup['h34'], variable=active_plot, value='h34', command=update_plot).grid(row=2, column=0, columnspan=1, sticky="ew")
+            if len(lookup) <= 6:
+                for row, key in enumerate(lookup):
+                    ttk.Radiobutton(butt_frame_t, text=lookup[key], variable=active_plot, value=key, command=update_plot).grid(row=row, column=0, columnspan=1, sticky="ew")
+            else:
+                # note: with N channels there are N(N-1)/2 pairs, too many for buttons
+                option_pair = ttk.OptionMenu(butt_frame_t, active_plot, active_plot.get())
+                option_pair.grid(row=0, column=0, sticky="ew")
+                for key in lookup:
+                    option_pair['menu'].add_command(label=lookup[key], command=lambda k=key: (active_plot.set(k), update_plot()))
 
             butt_frame_s.grid(row=2, column=0, sticky="news")
             butt_frame_t.grid(row=3, column=0, sticky="news")
@@ -158,26 +170,22 @@ class Plotting:
 
         def update_plot(scale=''):
 
-            fig.clear()
-            ax1 = fig.add_subplot(111)
-
-            #b = self.parent.eta_class.lifetime_bins_ns
-            ax1.set_title(f"G2 measurement")
-
             #for i, thing in enumerate(self.ch_show_correlation.keys()):
             #    if self.ch_show_correlation[thing].get() is False:
             #        print(f"{thing} is hidden")
             #        continue  # doesn't plot when hidden
 
-            avg_val = np.mean(corr_dict[active_plot.get()])
-            ax1.plot(delta_t, corr_dict[active_plot.get()]/avg_val, label=lookup[active_plot.get()])
+            set_line(*line_plot.ax.get_xlim())
+
+            line_plot.autoscale(scalex=False)
+            line_plot.update_legend()
+            line_plot.redraw(full=False)   # note: the axes are only redrawn if their limits changed
+
+        def set_line(x_lo, x_hi):
+            # note: only the shown range, at the pyramid level with about one bin per pixel (mean g2 per base bin)
+            x, rows = pyramid.view(x_lo, x_hi, pixels=axis_pixels(line_plot.ax), centered=True)
+            line_plot.set_line('g2', x, rows[active_plot.get()], label=lookup[active_plot.get()])
 
-            ax1.legend()
-            ax1.set_xlabel('time [ns]', fontsize=10)
-            ax1.set_ylabel('coincidence', fontsize=10)
-            ax1.set_xlim([-30, 30])
-            ax1.legend()
-            fig.canvas.draw_idle()  # updates the canvas immediately?
         # h2 --> ch6
         # h3 --> ch7
         # h4 --> ch5
@@ -209,8 +217,29 @@ class Plotting:
 
         # the figure that will contain the plot
         fig = plt.figure(figsize=(8, 5), dpi=100)  # 10 3
-        ax1 = fig.add_subplot(111)
-        delta_t, corr_dict = self.parent.eta_class.new_correlation_analysis()
+        line_plot = LinePlot(fig)
+        line_plot.ax.set_title(f"G2 measurement")
+        line_plot.ax.set_xlabel('time [ns]', fontsize=10)
+        line_plot.ax.set_ylabel('coincidence', fontsize=10)
+        line_plot.ax.set_xlim([-30, 30])
+        if self.parent.eta_class.const['backend'] == 'numpy':
+            # every channel pair (see 'G2Engine'), one row of the (pair x delay) g2 array each, already normalized
+            # note: computed by the analysis job with the other histograms, see 'run_combined_analysis'
+            delta_t, labels, g2 = self.parent.eta_class.g2_results()
+            lookup = {label: label for label in labels}
+            corr_dict = dict(zip(labels, g2))
+            norm = {label: 1.0 for label in labels}
+            line_plot.ax.set_ylabel('g2', fontsize=10)
+            if labels:
+                active_plot.set(labels[0])
+        else:
+            delta_t, corr_dict = self.parent.eta_class.new_correlation_analysis()
+            norm = {key: np.mean(corr_dict[key]) for key in lookup}
+        # every coarser binning of the normalized curves, for the shown range and zoom level
+        pyramid = HistogramPyramid({key: corr_dict[key] / norm[key] for key in lookup}, binsize=delta_t[1] - delta_t[0],
+                                   x0=delta_t[0])
+        # zooming with the toolbar picks the matching resolution as well
+        line_plot.ax.callbacks.connect('xlim_changed', lambda ax: set_line(*ax.get_xlim()))
 
         update_plot()
 
@@ -250,29 +279,16 @@ class Plotting:
 
         def update_plot(scale=''):
 
-            fig.clear()
-            ax1 = fig.add_subplot(111)
-
-            #b = self.parent.eta_class.lifetime_bins_ns
-            ax1.set_title(f"Countrate")
-
             for i, thing in enumerate(self.ch_show_countrate.keys()):
-                if self.ch_show_countrate[thing].get() is False:
-                    print(f"{thing} is hidden")
-                    continue  # doesn't plot when hidden
-
-                ax1.plot(time_axis, count_dict[thing], c=self.ch_colors[thing], label=lookup[thing]+' (0.1s)')
+                line_plot.set_line(thing, time_axis, count_dict[thing], c=self.ch_colors[thing], label=lookup[thing]+' (0.1s)')
                 #ax1.axhline(y=np.sum(count_dict[thing])/1.4, c=self.ch_colors[thing], linestyle='--', label=lookup[thing]+' (1s)')
                 #ax1.axhline(y=np.sum(count_dict[thing]), c=self.ch_colors[thing], linestyle='-', label='TEMP: total accum')
                 # TODO REMOVE^ only applicable for the 1s measurement
+            line_plot.set_visible({thing: show.get() for thing, show in self.ch_show_countrate.items()})   # note: hidden channels are not drawn
 
-            ax1.legend()
-            ax1.set_xlabel('time [s]', fontsize=10)
-            ax1.set_ylabel('counts', fontsize=10)
-            #ax1.set_xlim([-30, 30])
-            ax1.legend()
-            ax1.grid()
-            fig.canvas.draw_idle()  # updates the canvas immediately?
+            line_plot.autoscale(visible_only=True)
+            line_plot.update_legend()
+            line_plot.redraw(full=False)
 
         lookup = {'ph1':'ch.1',
                   'ph2': 'ch.2',
@@ -300,7 +316,12 @@ class Plotting:
 
         # the figure that will contain the plot
         fig = plt.figure(figsize=(8, 5), dpi=100)  # 10 3
-        ax1 = fig.add_subplot(111)
+        line_plot = LinePlot(fig)
+        line_plot.ax.set_title(f"Countrate")
+        line_plot.ax.set_xlabel('time [s]', fontsize=10)
+        line_plot.ax.set_ylabel('counts', fontsize=10)
+        #line_plot.ax.set_xlim([-30, 30])
+        line_plot.ax.grid()
         time_axis, count_dict = self.parent.eta_class.new_countrate_analysis()
 
         update_plot()
@@ -433,73 +454,43 @@ class Plotting:
             update_plot(plot_mode.get())
 
         def update_plot(scale=''):
-            print("pressed update")
+            # note: the lines are created once and updated, only the changed parts of the figure are redrawn
             if scale == '':
                 scale = plot_mode.get()
             else:
                 plot_mode.set(scale)
 
-            fig.clear()
-            ax1 = fig.add_subplot(111)
-            plot_all = True  # FIXME note plotting too many value and trying to interact causes lag
-
-            b = self.parent.eta_class.lifetime_bins_ns
-
-            x = b  # [:-2]
-
             if x_min.get() >= x_max.get():
                 x_min.set(x_max.get() - 1)  # note: to ensure the min < max
 
-            if plot_all:
-                idx_min = 0
-                idx_max = -1
-            else:
-                # convert time to index??
-                idx_min = int(1000 * x_min.get() / self.parent.eta_class.const['binsize'])
-                idx_max = int(1000 * x_max.get() / self.parent.eta_class.const[
-                    'binsize']) + 1  # note: round in case int would have rounded down
-
-                if idx_min >= idx_max:
-                    x_min.set(x_max.get() - 1)  # note: to ensure the min < max
-                    idx_min = int(1000 * x_min.get() / self.parent.eta_class.const['binsize'])
-
-            print(self.ch_show_lifetime.keys())
-            for i, thing in enumerate(self.ch_show_lifetime.keys()):
-                if self.ch_show_lifetime[thing] is False:
-                    print(f"{thing} is hidden")
-                    continue  # doesn't plot when hidden
-
-                y = self.parent.eta_class.folded_countrate_pulses[thing]
-
-                if scale == 'linear':
-                    line_b, = ax1.plot(x[idx_min:idx_max], y[idx_min:idx_max],
-                                       label=f'{lookup[thing]["nm"]} nm (ch.{lookup[thing]["ch"]})',
-                                       #c=self.parent.eta_class.pix_dict[thing]["color"], alpha=0.8
-                                        )
-                elif scale == 'log':
-                    line_b, = ax1.semilogy(x[idx_min:idx_max], y[idx_min:idx_max],
-                                           label=f'{lookup[thing]["nm"]} nm (ch.{lookup[thing]["ch"]})',
-                                           #label=f'{self.parent.eta_class.pix_dict[thing]["wavelength"]} (c{thing})',
-                                           #c=self.parent.eta_class.pix_dict[thing]["color"], alpha=0.8
-                                           )
-
-                # elif scale == 'histo':
-                #    N, bins, bars = ax1.hist(x[idx_min:idx_max], bins=b[idx_min:idx_max], weights=y[idx_min:idx_max], rwidth=1, align='left')
-
-                ###plt.text(x[-1], y[-1], f'c{thing}')
-
             if scale == 'log':
                 if y_min.get() == 0.0:
                     y_min.set(1.0)
 
-            ax1.set_xlim([x_min.get(), x_max.get()])
-            ax1.set_ylim([y_min.get(), y_max.get()])
-            ax1.set_xlabel("time [ps]")
-            ax1.set_ylabel("counts")
-            ax1.set_title("Lifetime")
+            line_plot.set_limits(xlim=(x_min.get(), x_max.get()), ylim=(y_min.get(), y_max.get()), yscale=scale)
+            set_lines(x_min.get(), x_max.get())
+            line_plot.set_visible(self.ch_show_lifetime)   # note: hidden channels are not drawn
+            line_plot.update_legend()
+            line_plot.redraw(full=False)   # note: the axes are only redrawn if their limits changed
 
-            ax1.legend()
-            fig.canvas.draw_idle()  # updates the canvas immediately?
+        def set_lines(x_lo, x_hi):
+            # note: only the shown range, at the pyramid level with about one bin per pixel (counts per base bin)
+            x, rows = self.parent.eta_class.lifetime_pyramid.view(x_lo, x_hi, pixels=axis_pixels(line_plot.ax),
+                                                                  centered=True)
+            for i, thing in enumerate(self.ch_show_lifetime.keys()):
+                fitted = self.parent.eta_class.pix_dict.get(thing, {})
+                tau = f', tau {fitted["lifetime"]:.0f} ps' if fitted.get('lifetime ok') else ''
+                line_plot.set_line(thing, x, rows[thing],
+                                   label=f'{lookup[thing]["nm"]} nm (ch.{lookup[thing]["ch"]}){tau}',
+                                   #c=self.parent.eta_class.pix_dict[thing]["color"], alpha=0.8
+                                   )
+
+        def live_update():
+            # during a live scan: keep the axes (so only the lines are redrawn) until the counts outgrow them
+            max_count = np.max([np.max(lst) for lst in self.parent.eta_class.folded_countrate_pulses.values()])
+            if max_count > y_max.get():
+                y_max.set(round(1.5 * max_count))
+            update_plot()
 
         self.ch_show_lifetime = {'h4': True, 'h2': True, 'h3': True}
         x_min = tk.DoubleVar(value=4000.0)   # time
@@ -523,7 +514,13 @@ class Plotting:
 
         fig = plt.figure(figsize=(8, 5), dpi=100)  # fig, ax1 = plt.subplots(1, 1, figsize=(8, 5))
 
-        ax1 = fig.add_subplot(111)
+        line_plot = LinePlot(fig)
+        line_plot.ax.set_xlabel("time [ps]")
+        line_plot.ax.set_ylabel("counts")
+        line_plot.ax.set_title("Lifetime")
+        # zooming with the toolbar picks the matching resolution as well
+        line_plot.ax.callbacks.connect('xlim_changed', lambda ax: set_lines(*ax.get_xlim()))
+
         update_plot()  # TODO: check if we can use any of this
         reset_lims()
         plt_frame, canvas = gui.pack_plot(tab, fig)
@@ -532,6 +529,9 @@ class Plotting:
         plt_frame.grid(row=2, column=1, columnspan=1, sticky="news")
         butt_frm.grid(row=2, column=2, columnspan=1, sticky="news")
 
+        # handles for redrawing from outside ('reset' also rescales the axes to the data, 'live' only when needed)
+        self.plots['lifetime'] = {'fig': fig, 'update': update_plot, 'reset': reset_lims, 'live': live_update}
+
     def plot_lifetime_colorbar_widget(self, tab):
 
         def reset_lims():
@@ -695,103 +695,41 @@ class Plotting:
             else:
                 plot_mode.set(scale)
 
-            fig.clear()
-            ax1 = fig.add_subplot(111)
-            plot_all = False   # note plotting too many value and trying to interact causes lag
-
-            b = self.parent.eta_class.lifetime_bins_ns
-            x = b[:-2]
-
             if x_min.get() >= x_max.get():
                 x_min.set(x_max.get() - 1)  # note: to ensure the min < max
 
-            if plot_all:
-                idx_min = 0
-                idx_max = -1
+            if scale == 'log':
+                mx = y_max.get()    # np.log10(y_max.get())
+                mn = y_min.get()    # np.log10(max(1.0, y_min.get()))
             else:
-                # convert time to index??
-                idx_min = int(1000*x_min.get()/self.parent.eta_class.const['binsize'])
-                idx_max = int(1000*x_max.get()/self.parent.eta_class.const['binsize'])+1   # note: round in case int would have rounded down
+                mn = max(0.0, y_min.get())
+                mx = y_max.get()
 
-                if idx_min >= idx_max:
-                    x_min.set(x_max.get() - 1)  # note: to ensure the min < max
-                    idx_min = int(1000*x_min.get() / self.parent.eta_class.const['binsize'])
-            # COLORS
-            n_c = 256  # number of colors in gradient
+            color_plot.set_limits(xlim=(x_min.get(), x_max.get()))
+            set_rows(x_min.get(), x_max.get(), scale)
+            color_plot.set_clim(mn, mx)
+            color_plot.redraw(full=False)   # note: the axes and colorbar are only redrawn if they changed
 
-            # --
-            nr_shown_chs = 0
-            all_lines = []
-            #max_val = np.max([np.max(self.parent.eta_class.folded_countrate_pulses[c]) for c in self.ch_show_lifetime.keys()])
+        def set_rows(x_lo, x_hi, scale=None):
+            # note: only the shown range, at the pyramid level with about one bin per pixel (counts per base bin)
+            scale = scale or plot_mode.get()
+            time_vals, counts = self.parent.eta_class.lifetime_pyramid.view(x_lo, x_hi, pixels=axis_pixels(color_plot.ax))
 
+            rows = {}
             for i, thing in enumerate(self.ch_show_lifetime.keys()):
 
                 if self.ch_show_lifetime[thing] is False:
                     continue   # doesn't plot when hidden
 
-                nr_shown_chs += 1
-                time_vals = x[idx_min:idx_max]
-                n = len(time_vals)  #idx_max - idx_min - 1  # nr of plotted points
-                y_vals = list(np.ones(n)*nr_shown_chs)
-
                 if scale == 'log':
-                    mx = y_max.get()    # np.log10(y_max.get())
-                    mn = y_min.get()    # np.log10(max(1.0, y_min.get()))
-                    pre_counts = [max([1.0, c]) for c in self.parent.eta_class.folded_countrate_pulses[thing]+1]
-                    counts = np.log10(pre_counts)
-                    #if mx == mn:
-                    #    mx = np.max(counts)
-                    #y_max.set(mx)
-
-                    # ABSOLUTE FILTER
-                    """for l in range(len(counts)):
-                        if counts[l] > y_max.get():
-                            counts[l] = 0.0
-                        elif counts[l] < y_min.get():
-                            counts[l] = 0.0"""
-                    # ----
-
+                    rows[thing] = np.log10(np.maximum(1.0, counts[thing] + 1))
                 else:
-                    #max_val = np.max([np.max(result[c]) for c in channels])
-                    counts = self.parent.eta_class.folded_countrate_pulses[thing] # / max_val
-                    mn = max(0.0, y_min.get())
-                    mx = y_max.get()
-                    #print("LIN POST", counts)
-
-
-                # https://matplotlib.org/stable/gallery/lines_bars_and_markers/multicolored_line.html
-                # Create a continuous norm to map from data points to colors
-                norm = plt.Normalize(mn, mx) #counts.max())
-                #norm_counts = [min((2*c)+1, 50) for c in counts]
-                points = np.array([time_vals, y_vals]).T.reshape(-1, 1, 2)
-                segments = np.concatenate([points[:-1], points[1:]], axis=1)
-                lc = LineCollection(segments, cmap='plasma', norm=norm)  #, linewidths=norm_counts)
-                # Set the values used for colormapping
-                lc.set_array(counts[idx_min:idx_max])
-                line = ax1.add_collection(lc)
-                all_lines.append(lc)
-
-            for lc in all_lines:
-                lc.set_linewidth(line_thickness.get()/(len(all_lines)+1))
-
-            fig.colorbar(line, ax=ax1)
-
-            shown_ticks = []
-            for key in self.ch_show_lifetime.keys():
-                if self.ch_show_lifetime[key]:
-                    shown_ticks.append(f'{lookup[key]["nm"]} nm\nch.{lookup[key]["ch"]}   ')
-
-            ticks = [i + 1 for i in range(len(shown_ticks))]
-            ax1.set_yticks(ticks)
-            ax1.set_yticklabels(shown_ticks)  # note: this will be the amount of channels we are displaying
-            #y_max.set(len(ticks)+1)
-
-            ax1.set_xlim([x_min.get(), x_max.get()])
-            ax1.set_ylim([0.0, len(shown_ticks)+1.0])  # not applicable here anymore, used to change range on colorbar
-            ax1.set_xlabel("time [ps]")
-            ax1.set_title("Lifetime Color")
-            #ax1.legend()
-            fig.canvas.draw_idle()   # updates the canvas immediately?
+                    rows[thing] = counts[thing]  # / max_val
+
+            shown_ticks = {key: f'{lookup[key]["nm"]} nm\nch.{lookup[key]["ch"]}   ' for key in rows}
+
+            # note: the color rows are created once, here only their data is updated
+            return color_plot.set_rows(time_vals, rows, labels=shown_ticks, height=min(1.0, line_thickness.get() / 300))
 
         self.ch_show_lifetime = {'h4': True, 'h2': True, 'h3': True}
         x_min = tk.DoubleVar(value=0.0)
@@ -820,6 +758,12 @@ class Plotting:
         fig = plt.figure(figsize=(8, 5), dpi=100)   # fig, ax1 = plt.subplots(1, 1, figsize=(8, 5))
         fig.subplots_adjust(left=0.1, right=1)
 
+        color_plot = ColorRowPlot(fig, cmap='plasma')
+        color_plot.ax.set_xlabel("time [ps]")
+        color_plot.ax.set_title("Lifetime Color")
+        # zooming with the toolbar picks the matching resolution as well
+        color_plot.ax.callbacks.connect('xlim_changed', lambda ax: set_rows(*ax.get_xlim()))
+
         update_plot()
 
         plt_frame, canvas = gui.pack_plot(tab, fig)
@@ -1293,10 +1237,40 @@ class NewScanGroup:
             #TT.start_tt_neg(scan_time=scantime, scan_name="temp_test", folder_path="Data/")  # this one should be the correct one! Try it first
             #TT.start_tt_pos(scan_time=scantime, scan_name="temp_test", folder_path="Data/")
 
+        def press_live():
+            # live lifetime histograms of the file that is being written (or of simulated tags, for testing)
+            if self.live is not None and self.live.running:
+                self.live.stop()
+                btn_live.config(text="Live View")
+                self.write_log(f"Stopped live view ({self.live.n_records} tags)")
+                return
+
+            if live_demo.get():
+                source = SyntheticTagStream()
+            else:
+                # TT.start_tt_neg dumps to '<scan_name>temp.timeres' (negative channels, flipped by the tail) and
+                # renames it to the scan file at the end, the tail then goes on reading from there
+                file = self.params['file_name']['var'].get()
+                source = TimeresTail(temp_timeres_file(file), renamed_to=file)
+
+            self.live = LiveLifetime(gui.root, source, self.eta_class, on_update=lambda: self.plotting_class.plots['lifetime']['live']())
+            if 'lifetime' not in self.plotting_class.plots:
+                self.live.update()
+                gui.add_new_plot_tab(parent_class=self, parent_name='New', tab_name='Lifetime', init=True)
+            self.live.start()
+            btn_live.config(text="Stop Live View")
+            self.write_log(f"Started live view")
+
+        self.live = None
+        live_demo = tk.BooleanVar(value=False)
+
         frm_send = ttk.Frame(tab, relief=tk.FLAT, borderwidth=0)
         btn_start = ttk.Button(frm_send, text="Start Scan", command=press_start)
+        btn_live = ttk.Button(frm_send, text="Live View", command=press_live)
 
         btn_start.grid(row=0, column=0, sticky="nsew")
+        btn_live.grid(row=0, column=1, sticky="nsew")
+        ttk.Checkbutton(frm_send, text="Simulated tags", variable=live_demo).grid(row=0, column=2, sticky="nsew")
 
         return frm_send
 
@@ -1509,35 +1483,42 @@ class NewScanGroup:
     def analysis_newscan_widget(self, tab):
 
         def press_analyze():
+            # note: the analysis runs in the background, pressing again queues the file after the current one
+            file = self.params['file_name']['var'].get()
+            scantime = self.params['scantime']['var'].get()
+            # note: ETA recipes that aren't cached yet are compiled in the job, not here (see 'run_eta_analysis')
+            self.analysis_runner.submit(file,
+                                        run=lambda job: self.eta_class.run_combined_analysis(file, scantime=scantime, progress=job.progress,
+                                                                                             cancel=job.cancelled, log=job.log),
+                                        on_done=lambda job, results: show_results(file, results, scantime))
+
+        def show_results(file, results, scantime):
+            # called in the Tk thread once the analysis is done
+            self.eta_class.apply_combined_results(file, results, scantime=scantime)
             try:
-                analyze_btn.config(state='disabled')
-                self.write_log(f"Starting analysis")  # NOTE
-
-                scantime = self.params['scantime']['var'].get()
-                self.eta_class.load_all_engines(scantime=scantime)
-                self.eta_class.new_lifetime_analysis()
-
-                analyze_btn.config(state='normal')
+                self.write_log(f"Saved results: {self.eta_class.save_results(file)}")   # note: reopened by 'Load Scan'
+            except OSError as error:
+                self.write_log(f"Could not save the results: {error}")
 
-                for tab_nm in gui.tabs['New']['children'].keys():
-                    try:
-                        gui.add_new_plot_tab(parent_class=self, parent_name='New', tab_name=tab_nm, init=True)
-                    except:
-                        print(f"ERROR: FAILED TO LOAD TAB '{tab_nm}'")
-                        raise
+            for tab_nm in gui.tabs['New']['children'].keys():
+                try:
+                    gui.add_new_plot_tab(parent_class=self, parent_name='New', tab_name=tab_nm, init=True)
+                except:
+                    print(f"ERROR: FAILED TO LOAD TAB '{tab_nm}'")
+                    raise
 
-                analyzed_file_label.config(text=f"Analyzed file: {self.params['file_name']['var'].get()}")
+            analyzed_file_label.config(text=f"Analyzed file: {file}")
 
-            except:
-                self.write_log(f"Failed to analyze")
-                raise
+        self.analysis_runner = AnalysisRunner(gui.root, self.write_log)
 
         frm_anal_buttons = ttk.Frame(tab, borderwidth=0, relief=tk.FLAT)
         # strt stop analysis buttons:
         analyze_btn = ttk.Button(frm_anal_buttons, text="Analyze", command=press_analyze)
+        cancel_btn = ttk.Button(frm_anal_buttons, text="Cancel", command=lambda: self.analysis_runner.cancel())
         # shows which file we have analysed:
         analyzed_file_label = ttk.Label(frm_anal_buttons, text='', font="Helvetica 10 normal italic")
         analyze_btn.grid(row=3, column=0, sticky="ew")
+        cancel_btn.grid(row=3, column=1, sticky="w")
         analyzed_file_label.grid(row=4, column=1, columnspan=10, sticky='ew')
 
         return frm_anal_buttons
@@ -1578,47 +1559,84 @@ class LoadScanGroup:
     def acquisition_loadscan_tab(self, tab):
 
         def press_start():
-            try:
-                start_btn.config(state='disabled')
-                self.write_log(f"Starting analysis")
+            # note: the analysis runs in the background, pressing again queues the file after the current one
+            file = self.params['file_name']['var'].get()
+            scantime = self.params['scantime']['var'].get()
 
-                start_btn.config(state='normal')
+            # saved results of the same file and analysis parameters are shown right away (see 'ScanResults')
+            scan = None if reanalyze.get() else ScanResults.load(file)
+            if scan is not None and scan.matches_params(self.eta_class.analysis_params(scantime)):
+                self.eta_class.load_results(file, scan)
+                self.write_log(f"Opened saved results of {file} ({scan.info.get('saved', '')})")
+                show_plots(file)
+                return
 
-                scantime = self.params['scantime']['var'].get()
-                self.eta_class.load_all_engines(scantime=scantime)
-                self.eta_class.new_lifetime_analysis()
+            # note: ETA recipes that aren't cached yet are compiled in the job, not here (see 'run_eta_analysis')
+            self.analysis_runner.submit(file,
+                                        run=lambda job: self.eta_class.run_combined_analysis(file, scantime=scantime, progress=job.progress,
+                                                                                             cancel=job.cancelled, log=job.log),
+                                        on_done=lambda job, results: show_results(file, results, scantime))
 
-                for tab_nm in gui.tabs['Load']['children'].keys():
-                    try:
-                        gui.add_new_plot_tab(parent_class=self, parent_name='Load', tab_name=tab_nm, init=True)
-                    except:
-                        print(f"ERROR: FAILED TO LOAD TAB '{tab_nm}'")
-                        raise
+        def show_results(file, results, scantime):
+            # called in the Tk thread once the analysis is done
+            self.eta_class.apply_combined_results(file, results, scantime=scantime)
+            try:
+                self.write_log(f"Saved results: {self.eta_class.save_results(file)}")
+            except OSError as error:
+                self.write_log(f"Could not save the results: {error}")
+            show_plots(file)
 
-                analyzed_file_label.config(text=f"Analyzed file: {self.params['file_name']['var'].get()}")
-                # ------
-            except:
-                self.write_log(f"Failed to analyze")
-                raise
+        def show_plots(file):
+            for tab_nm in gui.tabs['Load']['children'].keys():
+                try:
+                    gui.add_new_plot_tab(parent_class=self, parent_name='Load', tab_name=tab_nm, init=True)
+                except:
+                    print(f"ERROR: FAILED TO LOAD TAB '{tab_nm}'")
+                    raise
+
+            analyzed_file_label.config(text=f"Analyzed file: {file}")
+            # ------
 
         def get_file():
             new_file = askopenfilename(filetypes=[("Timeres datafile", "*.timeres")])
             if new_file:
                 self.params['file_name']['var'].set(new_file)
+                show_channel_totals(new_file)
 
             frm_misc.children[list(frm_misc.children.keys())[-1]].destroy()
 
+        def show_channel_totals(file):
+            # instant if the sidecar index ('<file>.idx') is up to date, otherwise it is built once in a single pass
+            try:
+                totals = TimeresIndex.get(file).channel_totals()
+                channel_totals_label.config(text="Channel totals:  " + ",  ".join([f"ch.{ch}: {totals[ch]}" for ch in totals]))
+                self.write_log(f"Channel totals: {totals}")
+            except OSError:
+                channel_totals_label.config(text='')
+                self.write_log(f"Could not read channel totals from: {file}")
+
+        self.analysis_runner = AnalysisRunner(gui.root, self.write_log)
+
         frm_misc = ttk.Frame(tab, borderwidth=3, relief=tk.FLAT)
         frm_misc.grid(row=1, column=0, rowspan=15)
 
         # shows which file we have analysed:
         analyzed_file_label = ttk.Label(frm_misc, text='', font="Helvetica 10 normal italic")
         analyzed_file_label.grid(row=4, column=1, columnspan=10, sticky='ew')
+        # shows how many tags each channel has in the chosen file:
+        channel_totals_label = ttk.Label(frm_misc, text='', font="Helvetica 10 normal italic")
+        channel_totals_label.grid(row=5, column=1, columnspan=10, sticky='ew')
+        # stops the running analysis and any queued ones:
+        ttk.Button(frm_misc, text="Cancel", command=lambda: self.analysis_runner.cancel()).grid(row=1, column=3, sticky="ew")
         # ----
         ttk.Button(frm_misc, text="Datafile", command=get_file).grid(row=1, column=0, sticky="ew")
         file_entry = ttk.Entry(frm_misc, textvariable=self.params['file_name']['var'], width=65)
         file_entry.grid(row=1, column=1, sticky="ew")
 
+        # analyze the file even if it has saved results
+        reanalyze = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frm_misc, text="Re-analyze", variable=reanalyze, onvalue=True, offvalue=False).grid(row=2, column=2, sticky="ew")
+
         start_btn = ttk.Button(frm_misc, text="Analyze", command=press_start)
         start_btn.grid(row=1, column=2, sticky="ew")
 
@@ -1650,19 +1668,21 @@ ch5_nm = 728.5
 ch6_nm = 729.1
 ch7_nm = 730.0
 
-try:
-    #sq = WebSQController(domain='http://130.237.35.62/')
-    gui = GUI()
-    newScanClass = NewScanGroup()
-    loadScanClass = LoadScanGroup()
-    calibrationClass = Calibration()
-    gui.calibrationclass = calibrationClass
-    gui.init_build_tabs()
-    gui.root.mainloop()
-
-except:
-    print("some exception")
-    raise
-
-finally:
-    print('------\nExiting...')
+# note: guarded so that the analysis worker processes (see ParallelAnalysis) don't open the GUI when importing this file
+if __name__ == '__main__':
+    try:
+        #sq = WebSQController(domain='http://130.237.35.62/')
+        gui = GUI()
+        newScanClass = NewScanGroup()
+        loadScanClass = LoadScanGroup()
+        calibrationClass = Calibration()
+        gui.calibrationclass = calibrationClass
+        gui.init_build_tabs()
+        gui.root.mainloop()
+
+    except:
+        print("some exception")
+        raise
+
+    finally:
+        print('------\nExiting...')
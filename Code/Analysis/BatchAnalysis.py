@@ -0,0 +1,295 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+if __package__ in (None, ''):
+    # note: run as a script ('python Code/Analysis/BatchAnalysis.py ...'), the 'Code' package is two levels up
+    sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from Code.SpectroGUILibrary.HistogramEngines import LifetimeHistogram, CountrateHistogram, SignalCounter, \
+    LIFETIME_CHANNELS, COUNTRATE_CHANNELS
+from Code.SpectroGUILibrary.ParallelAnalysis import parallel_run_engines, default_workers
+from Code.SpectroGUILibrary.TimeresIndex import TimeresIndex
+from Code.SpectroGUILibrary.G2Engine import G2Matrix, choose_method, detector_channels
+from Code.SpectroGUILibrary.LifetimeFit import fit_lifetimes
+from Code.SpectroGUILibrary.ColumnStore import ColumnStore
+
+# Headless analysis of many '.timeres' files (e.g. a night of scans), no GUI and no plots:
+#     python Code/Analysis/BatchAnalysis.py Data/240614 --out Data/240614/results
+#     python Code/Analysis/BatchAnalysis.py "Data/**/*.timeres" --analyses lifetime g2 --workers 8
+# Every file is read once for all selected analyses (the same NumPy engines as the GUI, see 'HistogramEngines'),
+# files are analyzed in parallel in a process pool. The results go to a ColumnStore (one table per analysis, one
+# row per file and channel / pair, see 'ColumnStore'):
+#     files       file, sha1, size, mtime_ns, settings, n_records, duration_s, analyses, seconds, error
+#     lifetime    file, name, channel, counts, peak_time, tau, tau_err, tau_chi2, tau_ok, histogram (rows x bins)
+#     countrate   file, name, channel, histogram (rows x bins, NaN after the end of shorter scans)
+#     signal      file, channel, counts
+#     g2          file, pair, channel_a, channel_b, g2_zero, g2 (rows x 2 * bins, normalized)
+# The settings and the time axes are in store.meta. A file is skipped if the store has it with the same content
+# (sha1) and settings: its size and modification time are checked first, the content is only hashed if they changed
+# (or with --rehash), so a file that was touched or copied is not analyzed again.
+
+ANALYSES = ('lifetime', 'countrate', 'g2', 'signal')
+CHECKPOINT_S = 60       # the store is saved this often during a batch (and at the end)
+
+DEFAULT_SETTINGS = {
+    'lifetime_bins': 125 * 5, 'lifetime_binsize': 20, 'lifetime_det_delay': 12500,   # ps, same as the GUI
+    'lifetime_fit': 'mono', 'lifetime_method': 'mle',
+    'countrate_binsize': 10 ** 11,          # ps (0.1 s)
+    'g2_bins': 10000, 'g2_binsize': 20, 'g2_method': 'auto',
+}
+
+
+def file_sha1(file, chunk_size=2 ** 24):
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def settings_key(analyses, settings):
+    # short hash of everything that changes the results
+    return hashlib.sha1(json.dumps([sorted(analyses), settings], sort_keys=True).encode()).hexdigest()[:12]
+
+
+def find_files(targets, pattern='*.timeres'):
+    # '.timeres' files in the given directories (recursively), globs and files, sorted and without duplicates
+    files = []
+    for target in targets:
+        if os.path.isdir(target):
+            files += glob.glob(os.path.join(target, '**', pattern), recursive=True)
+        elif glob.has_magic(target):
+            files += glob.glob(target, recursive=True)
+        elif os.path.exists(target):
+            files.append(target)
+        else:
+            raise FileNotFoundError(target)
+    return sorted(set(os.path.abspath(f) for f in files if os.path.isfile(f)))
+
+
+def analyze_file(file, analyses, settings, known_sha1=None, n_workers=1):
+    """
+    All 'analyses' of one file in one pass, as rows of the store tables: {table: {column: values}}.
+    If the content hash equals 'known_sha1' nothing is analyzed and only the 'files' row comes back (with 'skipped').
+    Runs in a worker process, so it only takes and returns picklable data.
+    """
+    t_start = time.perf_counter()
+    stat = os.stat(file)
+    sha1 = file_sha1(file)
+    files_row = {'file': [file], 'sha1': [sha1], 'size': [stat.st_size], 'mtime_ns': [stat.st_mtime_ns],
+                 'settings': [settings_key(analyses, settings)], 'analyses': [','.join(analyses)]}
+    if sha1 == known_sha1:
+        return {'files': files_row, 'skipped': True}
+
+    index = TimeresIndex.get(file)
+    duration = max(index.t_last - index.t_first, 0)
+    engines = {}
+    if 'lifetime' in analyses:
+        engines['lifetime'] = LifetimeHistogram(bins=settings['lifetime_bins'], binsize=settings['lifetime_binsize'],
+                                                det_delay=settings['lifetime_det_delay'])
+    if 'countrate' in analyses:
+        engines['countrate'] = CountrateHistogram(bins=duration // settings['countrate_binsize'] + 1,
+                                                  binsize=settings['countrate_binsize'])
+    if 'g2' in analyses:
+        channels = detector_channels(file)
+        method = settings['g2_method']
+        if method == 'auto':
+            totals = index.channel_totals()
+            method = choose_method([totals.get(ch, 0) / max(duration * 1e-12, 1e-12) for ch in channels],
+                                   settings['g2_bins'], settings['g2_binsize'])
+        engines['g2'] = G2Matrix(channels, bins=settings['g2_bins'], binsize=settings['g2_binsize'], method=method)
+    if 'signal' in analyses:
+        engines['signal'] = SignalCounter()
+
+    results = dict(zip(engines.keys(), parallel_run_engines(file, list(engines.values()), n_workers=n_workers)))
+    rows = {'files': files_row}
+    files_row.update({'n_records': [index.n_records], 'duration_s': [duration * 1e-12]})
+
+    if 'lifetime' in results:
+        names = list(results['lifetime'].keys())
+        histograms = np.vstack([results['lifetime'][name] for name in names])
+        row = {'file': [file] * len(names), 'name': names, 'channel': [LIFETIME_CHANNELS[n] for n in names],
+               'counts': histograms.sum(axis=1),
+               'peak_time': np.argmax(histograms, axis=1) * settings['lifetime_binsize']}
+        if settings['lifetime_fit']:
+            fit = fit_lifetimes(histograms, settings['lifetime_binsize'], model=settings['lifetime_fit'],
+                                method=settings['lifetime_method'])
+            row.update({'tau': fit['tau'], 'tau_err': fit['tau_err'], 'tau_chi2': fit['chi2_red'], 'tau_ok': fit['ok']})
+        row['histogram'] = histograms
+        rows['lifetime'] = row
+
+    if 'countrate' in results:
+        names = [name for name, ch in COUNTRATE_CHANNELS.items() if ch is not None]
+        rows['countrate'] = {'file': [file] * len(names), 'name': names,
+                             'channel': [COUNTRATE_CHANNELS[name] for name in names],
+                             'histogram': np.vstack([results['countrate'][name] for name in names])}
+
+    if 'signal' in results:
+        totals = results['signal']
+        rows['signal'] = {'file': [file] * len(totals), 'channel': list(totals.keys()),
+                          'counts': list(totals.values())}
+
+    if 'g2' in results:
+        engine = engines['g2']
+        g2 = engine.normalized(results['g2'])
+        pairs = [(a, b) for i, a in enumerate(engine.channels) for b in engine.channels[i + 1:]]
+        rows['g2'] = {'file': [file] * len(pairs), 'pair': engine.labels(),
+                      'channel_a': [a for a, b in pairs], 'channel_b': [b for a, b in pairs],
+                      'g2_zero': g2[:, settings['g2_bins']] if len(pairs) else np.zeros(0),
+                      'g2': g2}
+
+    files_row['seconds'] = [time.perf_counter() - t_start]
+    return rows
+
+
+def failed_row(file, analyses, settings, error):
+    return {'files': {'file': [file], 'sha1': [''], 'settings': [settings_key(analyses, settings)],
+                      'analyses': [','.join(analyses)], 'error': [error]}}
+
+
+def up_to_date(store, files, analyses, settings, rehash=False):
+    """
+    (files to analyze, {file: known sha1 to compare with}) for 'files' against what the store has.
+    Files with the same size, modification time and settings are up to date without reading them.
+    """
+    known = store.read('files', [c for c in ('file', 'sha1', 'size', 'mtime_ns', 'settings', 'error')
+                                 if c in store.columns('files')])
+    key = settings_key(analyses, settings)
+    entries = {}
+    for i, file in enumerate(known.get('file', [])):
+        failed = 'error' in known and known['error'][i]
+        if known['settings'][i] == key and not failed:
+            entries[str(file)] = (str(known['sha1'][i]), int(known['size'][i]), int(known['mtime_ns'][i]))
+
+    todo, hashes = [], {}
+    for file in files:
+        entry = entries.get(file)
+        if entry is not None:
+            stat = os.stat(file)
+            if not rehash and (stat.st_size, stat.st_mtime_ns) == entry[1:]:
+                continue
+            hashes[file] = entry[0]
+        todo.append(file)
+    return todo, hashes
+
+
+def time_axes(settings):
+    # left bin edges in ps of the histogram columns (the countrate one is as long as the longest scan)
+    return {'lifetime': (np.arange(settings['lifetime_bins']) * settings['lifetime_binsize']).tolist(),
+            'g2': (np.arange(-settings['g2_bins'], settings['g2_bins']) * settings['g2_binsize']).tolist()}
+
+
+def run_batch(targets, out=None, analyses=ANALYSES, settings=None, workers=None, rehash=False, log=print):
+    """
+    Analyzes the '.timeres' files in 'targets' (directories, globs or files) that are not up to date in the store
+    'out' (default: 'batch_results' next to the first target). Returns (store, {'analyzed', 'skipped', 'failed'}).
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    analyses = [a for a in ANALYSES if a in analyses]
+    files = find_files(targets)
+    if out is None:
+        first = targets[0] if os.path.isdir(targets[0]) else os.path.dirname(files[0] if files else targets[0])
+        out = os.path.join(first or '.', 'batch_results')
+    store = ColumnStore(out)
+    todo, hashes = up_to_date(store, files, analyses, settings, rehash=rehash)
+    summary = {'analyzed': 0, 'skipped': len(files) - len(todo), 'failed': 0}
+    log(f"{len(files)} files, {len(todo)} to analyze ({', '.join(analyses)}), results in {out}")
+
+    workers = workers or default_workers()
+    # one file: its segments in parallel (see 'ParallelAnalysis'), several files: one file per process
+    inner_workers = workers if len(todo) == 1 else 1
+    t_start = t_saved = time.perf_counter()
+    n_done = 0
+    known_files = None
+
+    def collect(file, rows):
+        nonlocal n_done, known_files
+        n_done += 1
+        if rows.pop('skipped', False):
+            # same content: keep the results, only the new size / modification time (so it is not hashed again)
+            summary['skipped'] += 1
+            status = 'unchanged'
+            if known_files is None:
+                # note: read once, the row of a skipped file is the one from before the batch
+                known_files = store.read('files', mmap=False)
+            same = known_files['file'] == file
+            old = {column: values[same] for column, values in known_files.items()}
+            old.update((key, rows['files'][key]) for key in ('size', 'mtime_ns'))
+            rows = {'files': old}
+        elif rows['files'].get('error', [''])[0]:
+            summary['failed'] += 1
+            status = 'FAILED: ' + rows['files']['error'][0].strip().splitlines()[-1]
+        else:
+            summary['analyzed'] += 1
+            status = f"{rows['files']['seconds'][0]:.2f} s"
+        rows['files'].setdefault('error', [''])
+        for table, columns in rows.items():
+            store.upsert(table, 'file', columns)
+        log(f"[{n_done}/{len(todo)}] {os.path.basename(file)}: {status}")
+
+    def save():
+        nonlocal t_saved
+        t_saved = time.perf_counter()
+        store.meta.update({'settings': settings, 'analyses': analyses, 'time_axes': time_axes(settings)})
+        store.save()
+
+    try:
+        if len(todo) <= 1 or workers <= 1:
+            for file in todo:
+                try:
+                    rows = analyze_file(file, analyses, settings, hashes.get(file), n_workers=inner_workers)
+                except Exception:
+                    rows = failed_row(file, analyses, settings, traceback.format_exc())
+                collect(file, rows)
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+                futures = {pool.submit(analyze_file, file, analyses, settings, hashes.get(file)): file for file in todo}
+                for future in as_completed(futures):
+                    file = futures[future]
+                    try:
+                        rows = future.result()
+                    except Exception:
+                        rows = failed_row(file, analyses, settings, traceback.format_exc())
+                    collect(file, rows)
+                    if time.perf_counter() - t_saved > CHECKPOINT_S:
+                        save()      # note: a long batch that is interrupted keeps what was done
+    finally:
+        save()
+
+    log(f"done in {time.perf_counter() - t_start:.1f} s: {summary['analyzed']} analyzed, "
+        f"{summary['skipped']} up to date, {summary['failed']} failed")
+    return store, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch analysis of '.timeres' files (no GUI).")
+    parser.add_argument('targets', nargs='+', help="directories (searched recursively), globs or '.timeres' files")
+    parser.add_argument('--out', help="result store directory (default: 'batch_results' in the first target)")
+    parser.add_argument('--analyses', nargs='+', choices=ANALYSES, default=list(ANALYSES))
+    parser.add_argument('--workers', type=int, default=None, help="processes (default: number of cores)")
+    parser.add_argument('--rehash', action='store_true', help="hash every file, not only the changed ones")
+    parser.add_argument('--lifetime-fit', choices=('mono', 'bi', 'none'), default=DEFAULT_SETTINGS['lifetime_fit'])
+    parser.add_argument('--g2-bins', type=int, default=DEFAULT_SETTINGS['g2_bins'])
+    parser.add_argument('--g2-binsize', type=int, default=DEFAULT_SETTINGS['g2_binsize'], help="ps")
+    parser.add_argument('--g2-method', choices=('auto', 'merge', 'fft'), default=DEFAULT_SETTINGS['g2_method'])
+    args = parser.parse_args(argv)
+
+    settings = {'lifetime_fit': None if args.lifetime_fit == 'none' else args.lifetime_fit,
+                'g2_bins': args.g2_bins, 'g2_binsize': args.g2_binsize, 'g2_method': args.g2_method}
+    store, summary = run_batch(args.targets, out=args.out, analyses=args.analyses, settings=settings,
+                               workers=args.workers, rehash=args.rehash)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,17 @@
 #------IMPORTS-----
 #Packages for ETA backend
 import json
-import etabackend.eta #Available at: https://github.com/timetag/ETA, https://eta.readthedocs.io/en/latest/
-import etabackend.tk as etatk
+try:
+    import etabackend.eta #Available at: https://github.com/timetag/ETA, https://eta.readthedocs.io/en/latest/
+    import etabackend.tk as etatk
+except ImportError:
+    etabackend = None  # 'index_counter' works without ETA
 
 #Packages used for analysis
 #import numpy as np
 from pathlib import Path
 import os
+from Code.SpectroGUILibrary.TimeresIndex import TimeresIndex
 #from matplotlib import pyplot as plt
 
 
@@ -43,6 +47,18 @@ def eta_counter(timetag_file, recipe_file,  **kwargs):
 
 
 
+def index_counter(timetag_file):
+    # Same printout as 'eta_counter', but from the sidecar index ('<file>.idx') which is built in one pass and then reused
+    index = TimeresIndex.get(timetag_file)
+    totals = index.channel_totals()
+
+    print(f"Signals counts:")
+    for s in totals:
+        print(f"{s} : {totals[s]}")
+
+    return totals
+
+
 if __name__ == '__main__': 
     #file = 'K:/Microscope/Data/231103/nr_6_dup_marker_sineFreq(1.0)_numFrames(2)_sineAmp(0.3)_stepAmp(0.3)_stepDim(100)_date(231103)_time(14h48m42s).timeres'
     #recipe = 'signal_counter.eta'
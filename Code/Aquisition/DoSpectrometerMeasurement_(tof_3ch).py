@@ -3,57 +3,10 @@ import TimeTagger
 from datetime import date
 import signal_checker
 import os
-
-def flip_neg_channels(old_file, new_file, bad_ch):
-    if old_file == new_file:
-        print("\n*ERROR*\nProvided file names are the same:\n"
-              f"   -->  {old_file}\n"
-              "Please give two separate file names (old and new)")
-        exit()
-
-    # find out how many 16-byte entries there are in the 'input file'
-    temp_file = open(old_file, "rb")
-    temp_read = temp_file.read()        # read 16 bytes at a time
-    temp_file.close()
-    n_entries = int(len(temp_read)/16)
-
-    # opening read/write data files:
-    #print("\nInitializing datafile manipulation\nUsing data file:", old_file)
-    print('\nFixing Data ')
-    input_file = open(old_file, "rb")
-    output_file = open(new_file, "wb")
-
-    t = 0
-    # loop through all the data entries, extracting and potentially fixing channel value
-    for i in range(n_entries):
-
-        # read 16 bytes at a time (size of each record by timetagger)
-        binary_line = input_file.read(16)
-
-        # read off current channel number (before any changes)
-        channel_int = int.from_bytes(binary_line[4:8], 'little', signed=True)
-
-        # If channel int is in undesired list --> change it. otherwise write unchanged bytes
-        if channel_int in bad_ch:
-            t += 1
-
-            # Change channel number. Example: channel -1 --> 101
-            int_new = abs(channel_int)# + 100
-
-            # Convert new channel number to bytestring (4bytes)
-            bytes_new_ch = int_new.to_bytes(4, 'little', signed=True)
-
-            # Write new file entry (with changed data)
-            new_binary_line = binary_line[:4] + bytes_new_ch + binary_line[8:]
-            output_file.write(new_binary_line)
-        else:
-            output_file.write(binary_line)
-
-    # close files when done
-    input_file.close()
-    output_file.close()
-
-    print(f"--> Done fixing data!\n")
+import sys
+# note: this script runs from its own folder (for 'signal_checker'), the 'Code' package is two levels up
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from Code.SpectroGUILibrary.TimeresFile import flip_neg_channels  # vectorized, memory-mapped version
 
 def get_date():
     '''Returns todays date in the format yymmdd'''
@@ -13,6 +13,9 @@ import os
 
 
 from Code.RetinaFiles.src.WebSQController import WebSQController
+from Code.SpectroGUILibrary.WebSQStream import WebSQStream
+from Code.SpectroGUILibrary.CountHistory import CountHistory
+from Code.SpectroGUILibrary.Bunching import BunchingEngine
 
 async def websocket_client(base_url, callback, n=0, normalized=False):
     """
@@ -70,14 +73,24 @@ def create_retina_webserver():
     return sq
 
 class LiveCounts:
-    def __init__(self, base_url=None):
+    def __init__(self, base_url=None, timeout=5, history_capacity=36000, spill_dir=None):
+        self.stream = None
+        self.last_seq = 0   # seq of the last frame handed to 'get_live_counts'
+        self.n_missed = 0   # frames that were pushed out of the backlog of the stream before a poll got to them
+        self.average_time = None    # s, if set the shown counts are averaged over this long (else: the latest frame)
         if base_url:
             #loop = asyncio.get_event_loop()
 
             if base_url == 'http://localhost:8080/':   # TODO FIX
                 self.sq = create_retina_webserver()
 
-            loop.run_until_complete(websocket_client(base_url, self.get_active_channels, n=1))  # finds which channels we collect from Retina setup
+            # one websocket session that stays open (and reconnects) instead of connecting for every frame
+            self.stream = WebSQStream(base_url, columnar=True).start()
+            frame = self.stream.wait_frame(timeout=timeout)
+            if frame is None:
+                self.stream.stop()
+                raise ConnectionError(f"No counts received from {base_url}: {self.stream.last_error}")
+            self.get_active_channels(frame.payload)  # finds which channels we collect from Retina setup
             self.nr_chs = self.found_channels.shape[0]   # self.nr_chs = 24
             self.ch_numbers = self.found_channels.copy()  # FIXME
             self.active_chs = {}
@@ -85,13 +98,18 @@ class LiveCounts:
                 self.active_chs[i] = True
 
             self.X = np.array([i for i in self.ch_numbers]).reshape(-1, 1)  # for clustering
+            # every frame we receive, for rolling averages and the calibration (1 hour at 10 frames per second)
+            self.history = CountHistory(self.ch_numbers, capacity=history_capacity, spill_dir=spill_dir)
             self.reset_vars(n=10)   # TODO: check if we should use self.n below?
-            loop.run_until_complete(websocket_client(base_url, self.get_live_counts, n=10))
+            for frame in self.stream.frames(10, timeout=timeout):
+                self.get_live_counts(frame.payload)
+                self.last_seq = frame.seq
         else:
             self.nr_chs = 24
             self.ch_numbers = np.arange(1, self.nr_chs + 1, 1)
             self.active_chs = {c: True for c in self.ch_numbers}
             self.X = np.array([i for i in self.ch_numbers]).reshape(-1, 1)  # for clustering
+            self.history = CountHistory(self.ch_numbers, capacity=history_capacity)
             self.reset_vars(n=5)
 
     def reset_vars(self, n):
@@ -106,31 +124,43 @@ class LiveCounts:
 
         self.counts = {k: 0 for k in self.ch_numbers}  # FIXME: phase out
         self.copy_counts = {k: 0 for k in self.ch_numbers}  # FIXME: phase out
-        self.calibration_counts_dict_lists = {k: [] for k in self.ch_numbers}
-        self.averaged_calibration_counts = {k: 1 for k in self.ch_numbers}  # AVG OF ABOVE
+        self.averaged_calibration_counts = {k: 1 for k in self.ch_numbers}  # AVG OF THE LAST n FRAMES IN 'history'
 
         #print("done reset vars ")
 
+    def poll(self):
+        # hands every frame since the last poll to 'get_live_counts' (oldest first), so the history has all of them
+        # even when the GUI timer is slower than the integration time; returns False if there is no new frame
+        frames = self.stream.frames_since(self.last_seq) if self.stream else []
+        if not frames:
+            return False
+        self.n_missed += frames[0].seq - self.last_seq - 1
+        for frame in frames:
+            self.get_live_counts(frame.payload)
+        self.last_seq = frames[-1].seq
+        return True
+
     def get_live_counts(self, payload):
+        # payload: one row per channel, columns 'rank', 'counts', ... (see 'decode_counts_array')
 
         self.payload = payload
+        self.history.append_frame(payload)
+        ch_numbers = self.ch_numbers.tolist()
+        active = np.array([self.active_chs[ch] for ch in ch_numbers], dtype=bool)   # inactive channels count as 0
 
         if self.case == 'running':
 
-            for message in payload:  # for every channel
-
-                if self.active_chs[message['rank']] is False:
-                    self.counts[message['rank']] = 0
-                else:
-                    self.counts[message['rank']] = message['counts']
-
-                self.copy_counts[message['rank']] = message['counts']  # this is just to display text even when channel is deactivated
-
-                #thisapp._update()
+            if self.average_time:
+                raw_counts = self.history.mean(seconds=self.average_time)
+            else:
+                raw_counts = self.history.latest()
+            self.counts.update(zip(ch_numbers, np.where(active, raw_counts, 0).tolist()))
+            self.copy_counts.update(zip(ch_numbers, raw_counts.tolist()))  # this is just to display text even when channel is deactivated
 
         elif self.case == 'calibrate':
 
-            if self.norm_counter == self.n:
+            self.norm_counter += 1
+            if self.norm_counter >= self.n:
                 self.case = 'running'
                 print("")
                 try:
@@ -138,15 +168,9 @@ class LiveCounts:
                 except:
                     pass
 
-                for k in self.ch_numbers:
-                    self.averaged_calibration_counts[k] = np.max([np.mean(self.calibration_counts_dict_lists[k]), 1.0])
-            else:
-                self.norm_counter += 1
-                for message in payload:  # for every channel
-                    if self.active_chs[message['rank']] is False:  # If the channel is inactive we don't collect counts
-                        self.calibration_counts_dict_lists[message['rank']].append(0)
-                    else:
-                        self.calibration_counts_dict_lists[message['rank']].append(message['counts'])
+                # average of the last n frames (the ones received since the calibration started)
+                averages = np.maximum(np.where(active, self.history.mean(n=self.n), 0), 1.0)
+                self.averaged_calibration_counts.update(zip(ch_numbers, averages.tolist()))
 
             print(f"\r---sampling: {self.norm_counter}/{self.n}", end='')
 
@@ -156,7 +180,7 @@ class LiveCounts:
 
     def get_active_channels(self, payload):
         """
-            # --> how to use this function: "loop.run_until_complete(websocket_client(base_url, live_counts.get_active_channels, n=1))"
+            # --> how to use this function: "live_counts.get_active_channels(live_counts.stream.latest().payload)"
 
             message['mcuId']        # this is the retina driver number (e.g. mcuId = 1 or 2, if we have 2 retinas)
             message['cuId']         # for each driver, which channel number (cuId is between 1-12)
@@ -171,10 +195,10 @@ class LiveCounts:
         for message in payload:  # for every channel
             #if len(found_channels) > 15:
             #    continue
-            found_channels.append(message['rank'])
+            found_channels.append(int(message['rank']))
             print(message)
         try:
-            self.int_time = message['inttime']
+            self.int_time = int(message['inttime'])
             print("int time:", self.int_time)
         except:
             pass
@@ -191,6 +215,7 @@ class MainWindow:
 
         self.autoscale = False
         self.wavelengths = {i : i for i in self.livecounts.ch_numbers}
+        self.bunching = BunchingEngine(threshold=0.02)   # redo the bunching when 2% of the counts have moved
         self.acquired_wavelengths = False
 
         self.col_choice = [
@@ -227,7 +252,9 @@ class MainWindow:
             self.button_url.setDisabled(True)  # disable connect button if we succeed to connect
             self.entry_url.setReadOnly(True)   # disable connect entry text if we succeed to connect
             self.timer = QtCore.QTimer()
-            self.timer.setInterval(100)
+            # note: poll twice per integration time so a new frame is shown at most half a frame late
+            int_time = getattr(self.livecounts, 'int_time', 100) or 100
+            self.timer.setInterval(int(min(100, max(10, int_time / 2))))
             self.timer.timeout.connect(self.update_plot)
             self.timer.start()
 
@@ -288,6 +315,15 @@ class MainWindow:
         self.checkbox_norm.toggled.connect(self.clicked_normalized)
         lay.addWidget(self.checkbox_norm, 3, 0)
 
+        # ------ ROLLING AVERAGE OF THE SHOWN COUNTS ------
+        self.entry_average = QtWidgets.QLineEdit()
+        self.entry_average.editingFinished.connect(self.clicked_average)
+        validator_average = QtGui.QDoubleValidator()
+        validator_average.setLocale(QtCore.QLocale("en_US"))  # this is to use period as decimal instead of comma
+        self.entry_average.setValidator(validator_average)
+        self.entry_average.setPlaceholderText("Average (s)")
+        lay.addWidget(self.entry_average, 3, 1)
+
         # ---- REDO CALIBRATION SAMPLING FOR AVERAGE -----
         self.entry_calibrate = QtWidgets.QLineEdit()
         self.entry_calibrate.editingFinished.connect(self.clicked_recalibrate)
@@ -457,13 +493,16 @@ class MainWindow:
                 else:
                     raise
 
-    def clicked_bunch(self):
+    def clicked_bunch(self, force=True):
+        # force=False (every frame, from 'update_plot'): only redo the bunching if the counts changed enough
         if self.entry_bunch.text() == "":
             pass
         else:
             try:
-                # ---- K MEANS CLUSTERING ----
+                # ---- OPTIMAL 1D BUNCHING (exact weighted k-means, see 'Bunching.py') ----
                 n_bunch = int(eval(self.entry_bunch.text()))    # how many grouping we want
+                if n_bunch <= 0 or n_bunch > self.livecounts.nr_chs:
+                    raise ValueError(f"Number of bunches must be 1-{self.livecounts.nr_chs}")
 
                 X_weight = np.array([self.livecounts.counts[i] for i in self.livecounts.ch_numbers])
                 #X_weight = np.array([1 for i in self.livecounts.ch_numbers])
@@ -473,18 +512,20 @@ class MainWindow:
                     #,[self.livecounts.copy_counts[i] for i in self.livecounts.ch_numbers]
                     ]).T  #.reshape(-1, 1)   # NOTE CHANGED TO WL
 
-                result = cluster.k_means(X=X, n_clusters=n_bunch, sample_weight=X_weight, n_init=15)
+                result, recomputed = self.bunching.update(X[:, 0], X_weight, n_bunch, force=force)
+                if not recomputed:
+                    return   # same bunches as shown
 
-                #cluster_centers = result[0]         # [[98.76185137], [ 9.68747405], [61.48770616]]
-                #cluster_membership = result[1]      # [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 0, 0, 0, 0, 0, 0]
+                #result['centers']         # [9.68747405, 61.48770616, 98.76185137]   (in increasing wavelength)
+                #result['labels']          # [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2]
 
                 if True:
                     bunched_dict = {}
-                    for thing in range(n_bunch):
-                        bunched_dict[thing] = {'members': [], 'avg': round(result[0][thing][0], 5)}
+                    for thing in range(len(result['centers'])):
+                        bunched_dict[thing] = {'members': [], 'avg': round(result['centers'][thing], 5)}
 
                 # FOR EACH CHANNEL
-                for ch, parent_idx in enumerate(result[1]):
+                for ch, parent_idx in enumerate(result['labels']):
                     if self.livecounts.counts[ch+1] > 0:   # ...counts[...]
                         bunched_dict[parent_idx]['members'].append(ch+1)    # bunched_dict[int(round(result[0][mem][0]))]['members'].append(ch+1)
 
@@ -492,6 +533,8 @@ class MainWindow:
 
                 # Display the final text and assign colors
                 for i in bunched_dict.keys():
+                    if not bunched_dict[i]['members']:
+                        continue
                     try:
                         #print(bunched_dict)
                         peak_ch = int(np.mean(bunched_dict[i]['members']))
@@ -504,8 +547,6 @@ class MainWindow:
                         print(bunched_dict[i]['members'])
                         raise
 
-                # TODO FIX ME HERE: CRASHES AT LIKE 12 BUNCHES
-
             except:
                 print("ERROR BUNCHING!")
 
@@ -750,11 +791,20 @@ class MainWindow:
         else:
             self.entry_calibrate.setText(f"1")
             self.clicked_recalibrate()
+    def clicked_average(self):
+        # empty or 0 --> show the latest frame, else the average over the last given seconds
+        try:
+            average_time = float(self.entry_average.text())
+        except ValueError:
+            average_time = 0
+        self.livecounts.average_time = average_time if average_time > 0 else None
+
     def clicked_recalibrate(self):
         print('Clicked recalibrate')
         self.checkbox_norm.setChecked(True)
         try:
-            loop.run_until_complete(websocket_client(self.base_url, self.livecounts.get_active_channels, n=1))  # finds which channels we collect from Retina setup
+            frame = self.livecounts.stream.latest()
+            self.livecounts.get_active_channels(frame.payload)  # finds which channels we collect from Retina setup
 
             if self.livecounts.int_time:
                 sampletime = eval(self.entry_calibrate.text())
@@ -779,8 +829,9 @@ class MainWindow:
 
     def update_plot(self):
 
-        # Fetch new data
-        loop.run_until_complete(websocket_client(self.base_url, self.livecounts.get_live_counts, n=1))
+        # Fetch new data (nothing to redraw if the Retina has not sent a new frame since the last tick)
+        if not self.livecounts.poll():
+            return
 
         if self.livecounts.case == 'running':
             # Extract raw counts into list (ordered by ch number)
@@ -800,7 +851,7 @@ class MainWindow:
             # CALCULATE WEIGHTED AVERAGE
             if np.sum(all_cnts_raw) != 0:
 
-                main.clicked_bunch()
+                main.clicked_bunch(force=False)
 
                 #self.weighted_avg = round(np.sum(self.livecounts.ch_numbers * all_cnts_raw) / np.sum(all_cnts_raw), 2)  # FIXME
 
@@ -7,7 +7,9 @@ This project is licensed under the terms of the MIT license.
 Copyright (c) 2023 Single Quantum B. V. and Hielke Walinga
 """
 import json
+import socket
 import sys
+import threading
 import time
 import uuid
 from functools import reduce
@@ -17,14 +19,22 @@ from math import floor
 try:
     from urllib.parse import urlencode, urlsplit, urlunsplit
     from urllib.request import Request, urlopen
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
 except ImportError:
     from urllib import urlencode
 
     from urllib2 import Request, urlopen
     from urlparse import urlsplit, urlunsplit
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
 
 
 CU_INTTIME = 10  # The time (ms) of a cu (channel unit) cycle.
+SETTINGS_TTL = 0.5  # The time (s) a settings object from `getSettings` is reused.
+
+# JSON RPC methods that do not change anything on the websq, all others invalidate the cached settings.
+READ_ONLY_METHODS = frozenset([
+    'getSettings', 'getDevices', 'getBackend', 'getIvSettings', 'getIvFile', 'getLog', 'getIvData', 'IVStatus',
+])
 
 
 def merge(a, b, path=None):
@@ -66,12 +76,97 @@ def merge(a, b, path=None):
     return a
 
 
+class KeepAliveTransport(object):
+    """A small pool of persistent HTTP connections to one host.
+
+    Every call of `request` reuses an idle connection when there is one,
+    so consecutive JSON RPC calls do not each pay for a new TCP connection.
+    Safe to use from several threads, each request takes its own connection from the pool.
+    """
+
+    def __init__(self, url, timeout=10, pool_size=4):
+        """Initialize a KeepAliveTransport class.
+
+        Parameters
+        ----------
+        url : str
+            Any URL on the host, only the scheme and the network location are used.
+        timeout : float
+            Timeout (in seconds) of the socket operations.
+        pool_size : int
+            The maximum amount of idle connections that are kept open.
+        """
+        res = urlsplit(url)
+        self.connection_class = HTTPSConnection if res.scheme == 'https' else HTTPConnection
+        self.netloc = res.netloc
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.n_connects = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        self.n_connects += 1
+        connection = self.connection_class(self.netloc, timeout=self.timeout)
+        connection.connect()
+        # Small requests on a persistent connection should not wait for the ACK of the previous one (Nagle).
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends one HTTP request and reads the whole response.
+
+        If a reused connection turns out to be closed by the server (idle keep-alive timeout),
+        the request is sent once more on a new connection.
+
+        Returns
+        -------
+        tuple
+            The HTTP status, the Content-Type header and the body (bytes) of the response.
+        """
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self._new_connection()
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (socket.error, HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                connection, reused = None, False
+                continue
+            break
+
+        if response.getheader('Connection', '').lower() == 'close' or getattr(response, 'will_close', False):
+            connection.close()
+        else:
+            with self._lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+        return response.status, response.getheader('Content-Type', ''), data
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
 class JsonRpc(object):
     """This class takes the `api_url` and then can be used to send
     standard HTTP requests with `request` or json rpc requests with `jsonrpc`.
     """
 
-    def __init__(self, api_url, jsonrpc_version='2.0'):
+    def __init__(self, api_url, jsonrpc_version='2.0', keep_alive=True, timeout=10):
         """Initialize a JsonRpc class.
 
         Parameters
@@ -80,9 +175,15 @@ class JsonRpc(object):
             The URL of the api endpoint.
         jsonrpc_version : str
             The JSON RPC version this endpoint uses.
+        keep_alive : bool, default=True
+            Keep the HTTP connections open between requests (see `KeepAliveTransport`).
+            If False, every request opens a new connection with `urlopen`.
+        timeout : float
+            Timeout (in seconds) of the socket operations of the keep-alive connections.
         """
         self.api_url = api_url
         self.jsonrpc_version = jsonrpc_version
+        self.transport = KeepAliveTransport(api_url, timeout=timeout) if keep_alive else None
 
     def request(self, params=None, payload=None):
         """Perform a GET HTTP request, if given a payload a POST.
@@ -116,6 +217,9 @@ class JsonRpc(object):
             headers["Content-Type"] = "application/json; charset=UTF-8"
             request_data = json.dumps(payload).encode()
 
+        if self.transport is not None:
+            return self._transport_request(target, request_data, headers)
+
         http_request = Request(target, data=request_data, headers=headers)
         http_response = urlopen(http_request)
 
@@ -129,6 +233,19 @@ class JsonRpc(object):
 
         return json.loads(body)
 
+    def _transport_request(self, target, request_data, headers):
+        res = urlsplit(target)
+        path = res.path + ("?" + res.query if res.query else "")
+        status, content_type, data = self.transport.request(
+            "POST" if request_data is not None else "GET", path or "/", body=request_data, headers=headers)
+
+        content_charset = "utf-8"  # default
+        if "charset=" in content_type:
+            content_charset = content_type.split("charset=")[-1].split(";")[0].strip() or content_charset
+        assert status == 200, "Got HTTP " + str(status) + " with " + data.decode(content_charset, "replace")
+
+        return json.loads(data.decode(content_charset))
+
     def jsonrpc(self, method, **params):
         """Makes a JSON RPC request to the `self.api_url`.
 
@@ -165,6 +282,47 @@ class JsonRpc(object):
         else:
             raise ValueError(response_data['error']['data']['message'])
 
+    def jsonrpc_batch(self, calls):
+        """Makes several JSON RPC requests in one HTTP request (a JSON RPC batch).
+
+        Parameters
+        ----------
+        calls : list of tuple
+            The (method, params) of every call, where params is a dict (or None).
+
+        Returns
+        -------
+        list
+            The results in the same order as `calls`.
+
+        Raises
+        ------
+        ValueError
+            If any of the calls failed (with the message of the first failed one).
+        """
+        payload = []
+        for method, params in calls:
+            payload.append({
+                'method': method,
+                'params': params or [],
+                'jsonrpc': self.jsonrpc_version,
+                'id': str(uuid.uuid4()),
+            })
+        if not payload:
+            return []
+        response_data = self.request(payload=payload)
+        assert isinstance(response_data, list), "No jsonrpc batch response"
+        responses = dict((response.get('id'), response) for response in response_data)
+
+        results = []
+        for call in payload:
+            response = responses.get(call['id'])
+            assert response is not None, "Missing response for " + call['method']
+            if 'result' not in response:
+                raise ValueError(response['error']['data']['message'])
+            results.append(response['result'])
+        return results
+
 
 class WebSQController(JsonRpc):
     """This class can send requests to the websq via the JSON RPC protocol.
@@ -182,9 +340,14 @@ class WebSQController(JsonRpc):
 
     For some functionality you can provide the `asLists` argument.
     Setting this to True gives your data as lists as opposed to a list of dicts.
+
+    The settings object from `getSettings` is reused for `settings_ttl` seconds,
+    so helpers that need it several times in a row only retrieve it once.
+    Every JSON RPC call that is not in `READ_ONLY_METHODS` clears it.
+    The cache can be shared by several threads (e.g. the thread pool of AsyncWebSQController).
     """
 
-    def __init__(self, domain=None, api_url=None, cu_inttime=CU_INTTIME):
+    def __init__(self, domain=None, api_url=None, cu_inttime=CU_INTTIME, settings_ttl=SETTINGS_TTL, keep_alive=True):
         """Initialize a WebSQController class
 
         Parameters
@@ -198,11 +361,59 @@ class WebSQController(JsonRpc):
         cu_inttime : float
             The duration (ms) a cu (channel unit) cycle.
             The default is 10ms for Retina and 15ms for the backport.
+        settings_ttl : float
+            The time (s) the settings object is reused. Set to 0 to always retrieve it.
+        keep_alive : bool, default=True
+            Keep the HTTP connection to the websq open between requests.
         """
         res = urlsplit(domain)
         api_url = api_url or urlunsplit((res.scheme, res.netloc, '/api', '', ''))
         self.cu_inttime = cu_inttime
-        super(WebSQController, self).__init__(api_url)
+        self.settings_ttl = settings_ttl
+        self._settings = None
+        self._settings_time = 0.0
+        self._settings_generation = 0  # Counts the invalidations, see `_cacheSettings`.
+        self._settings_lock = threading.Lock()
+        super(WebSQController, self).__init__(api_url, keep_alive=keep_alive)
+
+    def jsonrpc(self, method, **params):
+        if method not in READ_ONLY_METHODS:
+            self.invalidateSettings()
+        result = super(WebSQController, self).jsonrpc(method, **params)
+        if method not in READ_ONLY_METHODS:
+            self.invalidateSettings()
+        return result
+
+    def jsonrpc_batch(self, calls):
+        writes = any(method not in READ_ONLY_METHODS for method, _ in calls)
+        if writes:
+            self.invalidateSettings()
+        generation = self._settings_generation
+        results = super(WebSQController, self).jsonrpc_batch(calls)
+        if writes:
+            self.invalidateSettings()
+        else:
+            for (method, _), result in zip(calls, results):
+                if method == 'getSettings':
+                    self._cacheSettings(result, generation)
+        return results
+
+    def invalidateSettings(self):
+        """Forget the cached settings, the next `getSettings` retrieves them again."""
+        with self._settings_lock:
+            self._settings = None
+            self._settings_generation += 1
+
+    def _cacheSettings(self, settings, generation):
+        """Cache `settings`, retrieved when the settings were at `generation`.
+
+        The methods can be called from several threads (e.g. the thread pool of AsyncWebSQController).
+        Settings retrieved while another thread changed them are not cached, as they can be from before the change.
+        """
+        with self._settings_lock:
+            if generation == self._settings_generation:
+                self._settings = settings
+                self._settings_time = time.time()
 
     def setSettings(self, **params):
         return self.jsonrpc('setSettings', **params)
@@ -265,16 +476,20 @@ class WebSQController(JsonRpc):
         settings : dict, optional
             The `settings` will be retrieved or can be provided with keyword argument `settings`.
         """
-        settings = settings or self.getSettings()
         channelLoc = channelLoc or self.getChannelLoc(selectedCus, settings)
+        changes = self._channelChanges(name, dict((rank, value) for rank in channelLoc), channelLoc)
+        self.setSettings(**changes)
+
+    def _channelChanges(self, name, values, channelLoc):
+        """The settings changes that set the configuration `name` to `values[rank]` for each rank in `values`."""
         changes = {"devices": {}}
-        for (mcuId, cuId) in channelLoc.values():
+        for rank, value in values.items():
+            mcuId, cuId = channelLoc[rank]
             mcuId, cuId = str(mcuId), str(cuId)
             if not changes['devices'].get(mcuId):
                 changes['devices'][mcuId] = {"channels": {}}
             changes['devices'][mcuId]['channels'][cuId] = {'configuration': {name: value}}
-
-        self.setSettings(**changes)
+        return changes
 
     def setTriggerV(self, value, channelLoc=None, selectedCus=None, settings=None):
         """ Sets the trigger level for the counters for each channel (all selected channels the same value).
@@ -374,16 +589,17 @@ class WebSQController(JsonRpc):
         -------
         None
         """
-        # list of dicts to address all the channels individually.
-        rank_map_list = [{key: value} for key, value in self.getRankMap().items()]
+        rankMap = self.getRankMap()
+        ranks = list(rankMap.keys())
 
-        for index, value in enumerate(values):
-            # print(f'Current value: {value}. {index+1}/{len(values)}.')
+        for value in values:
             # check input in range
             if abs(value) > 83:
                 raise ValueError('The value %f uA is outside the supported range (-83,83) uA' % value)
 
-            self.setChannelConfiguration('biasI', value * 1e-6, channelLoc=rank_map_list[index], selectedCus=None, settings=None)
+        # All channels in one setSettings request.
+        changes = self._channelChanges('biasI', dict((ranks[index], value * 1e-6) for index, value in enumerate(values)), rankMap)
+        self.setSettings(**changes)
 
     def setTriggerVMultiple(self, values):
         """ Sets the Trigger level for the counter for each channel given by the array values.
@@ -399,16 +615,17 @@ class WebSQController(JsonRpc):
         -------
         None
         """
-        # list of dicts to address all the channels individually.
-        rank_map_list = [{key: value} for key, value in self.getRankMap().items()]
+        rankMap = self.getRankMap()
+        ranks = list(rankMap.keys())
 
-        for index, value in enumerate(values):
-            # print(f'Current value: {value}. {index+1}/{len(values)}.')
+        for value in values:
             # check input in range
             if abs(value) > 10:
                 raise ValueError('The value %f V is outside the supported range (-10,10) V.' % value)
 
-            self.setChannelConfiguration('triggerV', value, channelLoc=rank_map_list[index], selectedCus=None, settings=None)
+        # All channels in one setSettings request.
+        changes = self._channelChanges('triggerV', dict((ranks[index], value) for index, value in enumerate(values)), rankMap)
+        self.setSettings(**changes)
 
     def getTriggerV(self, channelLoc=None, selectedCus=None, settings=None):
         """ Gets the trigger level for each channel.
@@ -492,8 +709,26 @@ class WebSQController(JsonRpc):
     def getBackend(self):
         return self.jsonrpc('getBackend')
 
-    def getSettings(self):
-        return self.jsonrpc('getSettings')
+    def getSettings(self, max_age=None):
+        """Get the settings object, reusing the last one if it is not older than `max_age` seconds.
+
+        Parameters
+        ----------
+        max_age : float, optional
+            Defaults to `settings_ttl`. Use 0 to always retrieve the settings (e.g. for fresh counts).
+
+        Notes
+        -----
+        The returned object can be shared with other calls, do not modify it.
+        """
+        max_age = self.settings_ttl if max_age is None else max_age
+        with self._settings_lock:
+            if self._settings is not None and max_age > 0 and time.time() - self._settings_time <= max_age:
+                return self._settings
+            generation = self._settings_generation
+        settings = self.jsonrpc('getSettings')
+        self._cacheSettings(settings, generation)
+        return settings
 
     def getIvSettings(self):
         return self.jsonrpc('getIvSettings')
@@ -524,8 +759,8 @@ class WebSQController(JsonRpc):
         settings = settings or self.getSettings()
         return settings['frontend']['rankMap']
 
-    def getRankByIds(self, mcuId, cuId):
-        rankmap = self.getRankMap()
+    def getRankByIds(self, mcuId, cuId, settings=None):
+        rankmap = self.getRankMap(settings=settings)
         ranks = [k for k, v in rankmap.items() if v == [mcuId, cuId]]
         if len(ranks) != 1:
             raise KeyError(f"Could not find rank for channel with Ids: {mcuId}.{cuId}!")
@@ -542,6 +777,7 @@ class WebSQController(JsonRpc):
         return self.RankMap(settings=settings).keys()
 
     def getCountsHistoryById(self, id, settings=None):
+        settings = settings or self.getSettings(max_age=0)  # the counts change every integration time
         return self.getChannelInformationById(id=id, kind='data', settings=settings)
 
     def getAllChannelUnits(self, settings=None):
@@ -558,7 +794,7 @@ class WebSQController(JsonRpc):
         return self.setSettings(backend={"intTime": intTime})
 
     def getTemperatures(self, settings=None, device='1'):
-        settings = settings or self.getSettings()
+        settings = settings or self.getSettings(max_age=0)  # measured every integration time, like the counts
         mcu_data = settings['devices'][device]['data']
         return [mcu_data['temp1'], mcu_data['temp2']]
 
@@ -580,7 +816,7 @@ class WebSQController(JsonRpc):
         dict
             A dictionary with the data of `kind` at that location.
         """
-        settings = settings or self.getSettings()
+        settings = settings or self.getSettings(max_age=0 if kind == 'data' else None)  # 'data' changes every integration time
         mcuId, cuId = settings['frontend']['rankMap'][str(id)]
         #print("kind:", settings['devices'][str(mcuId)]['channels'][str(cuId)].keys())
         return settings['devices'][str(mcuId)]['channels'][str(cuId)][kind]
@@ -604,7 +840,7 @@ class WebSQController(JsonRpc):
         dict
             A dictionary with the data of `kind` at that location.
         """
-        settings = settings or self.getSettings()
+        settings = settings or self.getSettings(max_age=0 if kind == 'data' else None)  # 'data' changes every integration time
         # JSON keys are always strings, even if rankMap tells you otherwise.
         """print(settings.keys())  # JULIA
 
@@ -696,7 +932,7 @@ class WebSQController(JsonRpc):
         """
         return self.jsonrpc('stopIV')
 
-    def getIvData(self, selectedCus=None, settings=None):
+    def getIvData(self, selectedCus=None, settings=None, batch=False):
         """Get the IV curves of the last measurement.
 
         Parameters
@@ -706,6 +942,9 @@ class WebSQController(JsonRpc):
             this action. If not provided, use all of them.
         settings : dict, optional
             The `settings` will be retrieved or can be provided with keyword argument `settings`.
+        batch : bool, default=False
+            Retrieve the settings and the IV data in one JSON RPC batch request.
+            If the websq does not answer the batch, they are retrieved one after the other.
 
         Returns
         -------
@@ -713,15 +952,21 @@ class WebSQController(JsonRpc):
             A dictionary that maps the location [mcuId, cuId] to a dictionary object
             that contains the `biasI`, `counts`, and `monitorV`.
         """
-        settings = settings or self.getSettings()
+        ivDataAll = None
+        if settings is None and batch:
+            try:
+                settings, ivDataAll = self.jsonrpc_batch([('getSettings', None), ('getIvData', None)])
+            except (AssertionError, ValueError, KeyError, TypeError, OSError):
+                pass  # No (valid) batch response, e.g. a websq version without batch support.
+        if ivDataAll is None:
+            settings = settings or self.getSettings()
+            ivDataAll = self.jsonrpc("getIvData")
         channelLoc = self.getChannelLoc(selectedCus=selectedCus, settings=settings)
         traces = {}
 
-        ivDataAll = self.jsonrpc("getIvData")
-
         for (mcuId, cuId) in channelLoc.values():
             ivData = {}
-            rank = self.getRankByIds(mcuId, cuId)
+            rank = self.getRankByIds(mcuId, cuId, settings=settings)
             populated_indices = [i for i, c in enumerate(ivDataAll['counts'][rank]) if c is not None]
 
             ivData['biasI'] = [ivDataAll['counts']['biasI'][i] for i in populated_indices]
@@ -833,10 +1078,11 @@ class WebSQController(JsonRpc):
             The timestamp in the returned data is since the server started.
             The counts are the counts during an integration time period.
         """
+        settings = settings or self.getSettings(max_age=0)  # the counts change every integration time
         channelLoc = channelLoc or self.getChannelLoc(selectedCus, settings)
         #print(channelLoc)  # JULIA
         return dict(
-            ((mcuId, cuId), self.getChannelInformationByLoc(mcuId, cuId, "data"))
+            ((mcuId, cuId), self.getChannelInformationByLoc(mcuId, cuId, "data", settings=settings))
             for (mcuId, cuId) in channelLoc.values()
         )
 
@@ -13,12 +13,101 @@ Copyright (c) 2023 Single Quantum B. V. and Hielke Walinga
 import asyncio
 import signal
 import struct
+import sys
+import time
 from sys import platform
 
+import numpy as np
 import websockets
 
+# Layout of the 32 bytes that one channel takes in a package (little endian, one padding byte after cuStatus).
+PACKET_DTYPE = np.dtype([
+    ("mcuId", "<u1"),
+    ("cuId", "<u1"),
+    ("cuStatus", "<u1"),
+    ("pad", "u1"),
+    ("monitorV", "<f4"),
+    ("biasI", "<f4"),
+    ("counts", "<u4"),
+    ("inttime", "<u4"),  # x 10 ms
+    ("rank", "<u4"),
+    ("time", "<f8"),
+])
+assert PACKET_DTYPE.itemsize == 32
 
-async def websocket_client(base_url, callback, n=0, normalized=False):
+# Decoded channels, with the same fields and units as the dicts from `decode_counts` (inttime in ms).
+COUNTS_DTYPE = np.dtype([
+    ("mcuId", "u1"),
+    ("cuId", "u1"),
+    ("cuStatus", "u1"),
+    ("monitorV", "f4"),
+    ("biasI", "f4"),
+    ("inttime", "u4"),
+    ("counts", "u8"),
+    ("rank", "u4"),
+    ("time", "f8"),
+])
+
+
+def decode_counts_array(message, normalized=False):
+    """
+    Decodes one package of the Retina websocket into a structured array
+    with one row per channel (see `COUNTS_DTYPE`), in one go with `np.frombuffer`.
+    Each field is a column, e.g. `channels["counts"]` or `channels["rank"]`.
+    If normalized, the counts are scaled to counts per second.
+    """
+    raw = np.frombuffer(message, dtype=PACKET_DTYPE, count=len(message) // PACKET_DTYPE.itemsize)
+    channels = np.empty(len(raw), dtype=COUNTS_DTYPE)
+    for name in COUNTS_DTYPE.names:
+        channels[name] = raw[name]
+    channels["inttime"] *= 10  # ms
+    if normalized:
+        inttime = channels["inttime"]
+        channels["counts"] *= np.where(inttime > 0, 1000 // np.maximum(inttime, 1), 0)
+    return channels
+
+
+def decode_counts(message, normalized=False):
+    """
+    Decodes one package of the Retina websocket into a list with a dict per channel.
+    If normalized, the counts are scaled to counts per second.
+    """
+    channels = decode_counts_array(message, normalized=normalized)
+    names = COUNTS_DTYPE.names
+    return [dict(zip(names, row)) for row in channels.tolist()]
+
+
+def decode_counts_struct(message, normalized=False):
+    """
+    The original decoder, one `struct.unpack` per value.
+    Only kept as a reference for `benchmark_decoders`.
+    """
+    channel_size = 32  # One channel gives 32 bytes of information.
+    payload = []
+    for offset in range(0, len(message), channel_size):
+        channel = message[offset:(offset + channel_size)]
+        inttime = struct.unpack("<I", channel[16:20])[0] * 10  # ms
+        payload.append(
+            {
+                "mcuId": struct.unpack("<B", channel[0:1])[0],
+                "cuId": struct.unpack("<B", channel[1:2])[0],
+                "cuStatus": struct.unpack("<B", channel[2:3])[0],
+                "monitorV": struct.unpack("<f", channel[4:8])[0],
+                "biasI": struct.unpack("<f", channel[8:12])[0],
+                "inttime": inttime,
+                "counts": (
+                    int(1000 / inttime) * struct.unpack("<I", channel[12:16])[0]
+                    if normalized
+                    else struct.unpack("<I", channel[12:16])[0]
+                ),
+                "rank": struct.unpack("<I", channel[20:24])[0],
+                "time": struct.unpack("<d", channel[24:])[0],
+            }
+        )
+    return payload
+
+
+async def websocket_client(base_url, callback, n=0, normalized=False, columnar=False):
     """
     Listens to the Retina websocket and processes every package.
     For each package `callback` is called.
@@ -26,6 +115,8 @@ async def websocket_client(base_url, callback, n=0, normalized=False):
     and the callback that is called everytime a package is received.
     A package contains the information for all the channels in an array.
     If given n, the callback is called around n times.
+    If columnar, the callback gets a structured array (see `decode_counts_array`)
+    instead of a list of dicts.
 
     Notes
     -----
@@ -41,28 +132,10 @@ async def websocket_client(base_url, callback, n=0, normalized=False):
         # Process messages received on the connection.
         i = 0
         async for message in websocket:
-            channel_size = 32  # One channel gives 32 bytes of information.
-            payload = []
-            for offset in range(0, len(message), channel_size):
-                channel = message[offset:(offset + channel_size)]
-                inttime = struct.unpack("<I", channel[16:20])[0] * 10  # ms
-                payload.append(
-                    {
-                        "mcuId": struct.unpack("<B", channel[0:1])[0],
-                        "cuId": struct.unpack("<B", channel[1:2])[0],
-                        "cuStatus": struct.unpack("<B", channel[2:3])[0],
-                        "monitorV": struct.unpack("<f", channel[4:8])[0],
-                        "biasI": struct.unpack("<f", channel[8:12])[0],
-                        "inttime": inttime,
-                        "counts": (
-                            int(1000 / inttime) * struct.unpack("<I", channel[12:16])[0]
-                            if normalized
-                            else struct.unpack("<I", channel[12:16])[0]
-                        ),
-                        "rank": struct.unpack("<I", channel[20:24])[0],
-                        "time": struct.unpack("<d", channel[24:])[0],
-                    }
-                )
+            if columnar:
+                payload = decode_counts_array(message, normalized=normalized)
+            else:
+                payload = decode_counts(message, normalized=normalized)
             callback(payload)
             i += 1
             if n and i >= n:
@@ -83,7 +156,47 @@ def print_counts(payload):
                   intTime: {inttime} ms""")
 
 
+def synthetic_package(n_channels=48, inttime=10, seed=None):
+    """
+    A package as the Retina sends it, with random counts for `n_channels` channels.
+    """
+    rng = np.random.default_rng(seed)
+    raw = np.zeros(n_channels, dtype=PACKET_DTYPE)
+    raw["mcuId"] = np.arange(n_channels) // 12 + 1
+    raw["cuId"] = np.arange(n_channels) % 12 + 1
+    raw["monitorV"] = rng.normal(0, 1e-3, n_channels)
+    raw["counts"] = rng.poisson(10 ** 4, n_channels)
+    raw["inttime"] = inttime
+    raw["rank"] = np.arange(1, n_channels + 1)
+    raw["time"] = time.time()
+    return raw.tobytes()
+
+
+def benchmark_decoders(n_channels=48, rate=100, seconds=10):
+    """
+    Decodes `seconds` worth of packages at `rate` packages per second
+    with the struct decoder, the dict decoder and the columnar decoder,
+    and prints the time per package and the fraction of one core used at that rate.
+    Both dict decoders must give the same result.
+    """
+    message = synthetic_package(n_channels)
+    assert decode_counts(message, normalized=True) == decode_counts_struct(message, normalized=True)
+    n = rate * seconds
+    for name, decoder in [("struct.unpack, dicts", decode_counts_struct),
+                          ("frombuffer, dicts", decode_counts),
+                          ("frombuffer, columnar", decode_counts_array)]:
+        t_start = time.perf_counter()
+        for _ in range(n):
+            decoder(message, normalized=True)
+        t_package = (time.perf_counter() - t_start) / n
+        print(f"{name:22s}: {t_package * 1e6:7.1f} us per package of {n_channels} channels, "
+              f"{t_package * rate:.2%} of a core at {rate} Hz")
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark_decoders()
+        sys.exit()
     # This should be the same URL/IP as the retina interface.
     #url = "192.168.1.1"
     url = "130.237.35.62"
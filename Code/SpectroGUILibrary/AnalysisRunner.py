@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+from pathlib import Path
+
+# Runs analysis jobs one at a time in a background thread, so the Tk mainloop never waits for an analysis.
+# The worker never touches Tk itself: log lines, progress and results are put on a queue that is read on the Tk
+# thread every 'poll_ms' ms (with root.after), where the job's 'on_done' callback then fills the plot tabs.
+#     runner = AnalysisRunner(root, write_log)
+#     runner.submit(file, run=lambda job: eta_class.run_combined_analysis(file, progress=job.progress,
+#                                                                          cancel=job.cancelled, log=job.log),
+#                   on_done=lambda job, result: ...)
+#     runner.cancel()      --> stops the running job (at its next progress update, or right away for analyses that
+#                              watch 'job.cancelled' like 'parallel_run_engines') and clears the queue
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class AnalysisJob:
+    def __init__(self, file, run, on_done=None, on_error=None, name=None):
+        self.file = file
+        self.run = run              # run(job) --> result, called in the worker thread
+        self.on_done = on_done      # on_done(job, result), called in the Tk thread
+        self.on_error = on_error    # on_error(job, exception), called in the Tk thread
+        self.name = name or Path(file).name
+        self.cancelled = threading.Event()
+        self.fraction = 0.0
+        self._messages = None       # set by the runner
+
+    def progress(self, fraction):
+        # called by the analysis with the fraction done, this is also where a cancelled job stops
+        if self.cancelled.is_set():
+            raise AnalysisCancelled(self.name)
+        self.fraction = fraction
+        self._messages.put(('progress', self, fraction))
+
+    def log(self, msg):
+        self._messages.put(('log', self, msg))
+
+
+class AnalysisRunner:
+
+    def __init__(self, root, write_log, poll_ms=100, log_step=0.1):
+        self.root = root
+        self.write_log = write_log
+        self.poll_ms = poll_ms
+        self.log_step = log_step    # progress is written to the log every 10%
+
+        self.jobs = queue.Queue()
+        self.messages = queue.Queue()
+        self.current = None
+        self.pending = []           # jobs that are submitted but not started yet (for display)
+        self._logged_fraction = {}
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        self.root.after(self.poll_ms, self.poll)
+
+    def submit(self, file, run, on_done=None, on_error=None, name=None):
+        job = AnalysisJob(file, run, on_done=on_done, on_error=on_error, name=name)
+        job._messages = self.messages
+        self.pending.append(job)
+        self.jobs.put(job)
+        if self.current is not None or len(self.pending) > 1:
+            self.write_log(f"Queued analysis of {job.name} ({len(self.pending)} waiting)")
+        return job
+
+    def cancel(self, job=None):
+        # cancels 'job', or the running job and everything in the queue
+        jobs = [job] if job else [self.current] + self.pending
+        for j in jobs:
+            if j is not None:
+                j.cancelled.set()
+
+    def busy(self):
+        return self.current is not None or len(self.pending) > 0
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            self.messages.put(('start', job, None))
+            if job.cancelled.is_set():
+                self.messages.put(('cancelled', job, None))
+                continue
+            t_start = time.perf_counter()
+            try:
+                result = job.run(job)
+            except AnalysisCancelled:
+                self.messages.put(('cancelled', job, None))
+            except Exception as e:
+                self.messages.put(('error', job, e))
+            else:
+                self.messages.put(('done', job, (result, time.perf_counter() - t_start)))
+
+    def poll(self):
+        # handles everything the worker has reported since the last poll (runs in the Tk thread)
+        try:
+            while True:
+                kind, job, value = self.messages.get_nowait()
+
+                if kind == 'start':
+                    if job in self.pending:
+                        self.pending.remove(job)
+                    self.current = job
+                    if not job.cancelled.is_set():
+                        self.write_log(f"Analyzing {job.name}")
+                elif kind == 'log':
+                    self.write_log(value)
+                elif kind == 'progress':
+                    last = self._logged_fraction.get(job, 0.0)
+                    if value - last >= self.log_step or (value >= 1.0 and last < 1.0):
+                        self._logged_fraction[job] = value
+                        self.write_log(f"   {job.name}: {value:.0%}")
+                elif kind == 'done':
+                    self._finish(job)
+                    result, t_elapsed = value
+                    self.write_log(f"Finished {job.name} in {t_elapsed:.1f} s")
+                    if job.on_done:
+                        job.on_done(job, result)
+                elif kind == 'cancelled':
+                    self._finish(job)
+                    self.write_log(f"Cancelled analysis of {job.name}")
+                elif kind == 'error':
+                    self._finish(job)
+                    self.write_log(f"Failed to analyze {job.name}: {value}")
+                    if job.on_error:
+                        job.on_error(job, value)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(self.poll_ms, self.poll)
+
+    def _finish(self, job):
+        self._logged_fraction.pop(job, None)
+        if self.current is job:
+            self.current = None
@@ -0,0 +1,176 @@
+import time
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from Code.RetinaFiles.src.WebSQController import WebSQController, urlsplit
+from Code.SpectroGUILibrary.WebSQStream import WebSQStream
+from Code.SpectroGUILibrary.CountCollector import SampleSchedule
+
+# asyncio version of WebSQController, so a GUI or script can talk to the Retina without blocking its event loop:
+#     async def main():
+#         sq = AsyncWebSQController('http://130.237.35.62/')
+#         print(await sq.getIntTime())                           --> every public WebSQController method, awaitable
+#         await sq.set_channel_values('biasI', {'1': 11e-6, '13': 10.5e-6})   --> one request per driver, concurrently
+#         traces = await sq.sweep_iv(8, 14, 0.5, 20)              --> polls the IV data instead of time.sleep
+#         async for t, counts in sq.collect_counts(runtime=10, interval=0.5):
+#             ...
+#         stream = sq.stream()                                    --> the counts websocket, on this same event loop
+#         frame = await stream.next_frame()
+#         await sq.aclose()
+# The JSON-RPC calls themselves are the (blocking) WebSQController ones, run in a small thread pool. With the
+# keep-alive connection pool of 'JsonRpc' every worker thread keeps its own open connection.
+
+# Note: what IVStatus answers on the Retina isn't documented (the 'running' / 'idle' of WebSQSimulator are made up),
+# so 'sweep_iv' decides from the data when a sweep is done, see 'iv_complete'.
+
+log = logging.getLogger(__name__)
+
+
+class AsyncWebSQController:
+
+    def __init__(self, domain=None, api_url=None, max_workers=8, **kwargs):
+        self.sq = WebSQController(domain, api_url=api_url, **kwargs)
+        self.domain = domain
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='websq')
+        if self.sq.transport is not None:
+            self.sq.transport.pool_size = max_workers
+        self._streams = []
+
+    async def call(self, function, *args, **kwargs):
+        # runs a blocking function (e.g. a WebSQController method) in the thread pool
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def __getattr__(self, name):
+        # every public WebSQController method as a coroutine function: 'await sq.getSettings()'
+        attribute = getattr(self.sq, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def method(*args, **kwargs):
+            return await self.call(attribute, *args, **kwargs)
+        return method
+
+    # ---- concurrent configuration ----
+
+    async def set_channel_values(self, name, values, settings=None):
+        """
+        Sets the channel configuration 'name' (e.g. 'biasI' in A, 'triggerV' in V) to values[rank] for every rank
+        in 'values' ({rank: value}), with one setSettings request per driver (mcu), sent concurrently.
+        """
+        settings = settings or await self.call(self.sq.getSettings)
+        channelLoc = self.sq.getChannelLoc(settings=settings)
+        per_mcu = {}
+        for rank, value in values.items():
+            mcuId = channelLoc[str(rank)][0]
+            per_mcu.setdefault(mcuId, {})[str(rank)] = value
+        requests = [self.call(self.sq.setSettings, **self.sq._channelChanges(name, mcu_values, channelLoc))
+                    for mcu_values in per_mcu.values()]
+        return await asyncio.gather(*requests)
+
+    async def configure(self, bias_uA=None, trigger_V=None):
+        # bias and/or trigger level of many channels at once: {rank: value}
+        settings = await self.call(self.sq.getSettings)
+        requests = []
+        if bias_uA:
+            for value in bias_uA.values():
+                if abs(value) > 83:
+                    raise ValueError('The value %f uA is outside the supported range (-83,83) uA' % value)
+            requests.append(self.set_channel_values('biasI', {r: v * 1e-6 for r, v in bias_uA.items()}, settings))
+        if trigger_V:
+            for value in trigger_V.values():
+                if abs(value) > 10:
+                    raise ValueError('The value %f V is outside the supported range (-10,10) V.' % value)
+            requests.append(self.set_channel_values('triggerV', dict(trigger_V), settings))
+        await asyncio.gather(*requests)
+
+    # ---- IV sweep ----
+
+    async def sweep_iv(self, biasIStart, biasIStop, biasIStep, intTime, channelLoc=None, selectedCus=None,
+                       poll=0.25, timeout=None, progress=None):
+        """
+        Same as WebSQController.sweepIv, but awaits the sweep instead of blocking: after the expected duration the
+        IV data is read every 'poll' s until it is complete (see 'iv_complete'), and then returned. If it is not
+        complete after 'timeout' s, a warning is logged and the data so far is returned.
+        progress(fraction) is called while waiting.
+        """
+        if selectedCus is None and channelLoc is not None:
+            selectedCus = list(channelLoc)    # note: only the data of the swept channels is complete
+        settings = await self.call(self.sq.getSettings, max_age=0)
+        started_before = settings['backend'].get('ivTimeStamp')
+        await self.call(self.sq.startIv, biasIStart, biasIStop, biasIStep, intTime,
+                        channelLoc=channelLoc, selectedCus=selectedCus)
+        steps = int(round((biasIStop - biasIStart) / biasIStep)) + 1
+        duration = intTime * steps / 1000
+        timeout = timeout if timeout is not None else 2 * duration + 10
+        t_start = time.monotonic()
+
+        while True:
+            elapsed = time.monotonic() - t_start
+            if progress:
+                progress(min(elapsed / duration, 1.0) if duration > 0 else 1.0)
+            if elapsed >= duration:
+                settings = await self.call(self.sq.getSettings, max_age=0)
+                traces = await self.call(self.sq.getIvData, selectedCus=selectedCus, settings=settings)
+                if self.iv_complete(traces, steps, settings['backend'].get('ivTimeStamp'), started_before):
+                    return traces
+                if elapsed > timeout:
+                    n_done = min((len(trace['biasI']) for trace in traces.values()), default=0)
+                    log.warning("IV sweep not complete after %.1f s (%d of %d steps), returning the data so far",
+                                elapsed, n_done, steps)
+                    return traces
+            await asyncio.sleep(poll if elapsed >= duration else min(poll, duration - elapsed))
+
+    @staticmethod
+    def iv_complete(traces, steps, started, started_before=None):
+        """
+        True if every channel of 'traces' (getIvData) has all 'steps', of a sweep that started after 'started_before'
+        (the 'ivTimeStamp' of the settings before startIv, where one is known): getIvData leaves out the steps that
+        are not measured yet, and until the new sweep starts it returns the last one.
+        """
+        if started_before is not None and started == started_before:
+            return False
+        return len(traces) > 0 and all(len(trace['biasI']) >= steps for trace in traces.values())
+
+    # ---- counts ----
+
+    async def collect_counts(self, runtime=None, interval=0.5, channelLoc=None, selectedCus=None, schedule=None):
+        """
+        Async generator of (time, counts) every 'interval' s (for 'runtime' s, or until the caller stops), where
+        counts is the getCounts dict. The sampling times are on a fixed grid from the start (see SampleSchedule), so
+        a slow request delays one sample but does not shift the ones after it (a grid point that has already passed
+        is skipped). 'schedule' can be given to read the late / missed statistics afterwards.
+        """
+        settings = await self.call(self.sq.getSettings)
+        channelLoc = channelLoc or self.sq.getChannelLoc(selectedCus=selectedCus, settings=settings)
+        schedule = (schedule or SampleSchedule(interval, runtime)).start()
+        while not schedule.finished():
+            await asyncio.sleep(schedule.wait())
+            if schedule.take() is None:
+                return
+            counts = await self.call(self.sq.getCounts, channelLoc=channelLoc)
+            yield time.time(), counts
+
+    # ---- websocket ----
+
+    def stream(self, base_url=None, **kwargs):
+        """
+        The '/counts' websocket (see WebSQStream), running as a task on the current event loop, call from a coroutine.
+        base_url defaults to ws:// on the same host as the JSON-RPC api.
+        """
+        if base_url is None:
+            base_url = "ws://" + urlsplit(self.domain or self.sq.api_url).netloc
+        stream = WebSQStream(base_url, **kwargs).start_async()
+        self._streams.append(stream)
+        return stream
+
+    async def aclose(self):
+        for stream in self._streams:
+            await stream.aclose()
+        self._streams = []
+        self.executor.shutdown(wait=False)
+        if self.sq.transport is not None:
+            self.sq.transport.close()
@@ -5,16 +5,30 @@ import time
 import TimeTagger
 import os
 import Code.Analysis.signal_counter as signal_counter
+from Code.SpectroGUILibrary.TimeresFile import flip_neg_channels, temp_timeres_file
 
 # >> ETA() Imports:
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 from pathlib import Path
-import etabackend.eta       # Available at: https://github.com/timetag/ETA, https://eta.readthedocs.io/en/latest/
+try:
+    import etabackend.eta   # Available at: https://github.com/timetag/ETA, https://eta.readthedocs.io/en/latest/
+except ImportError:
+    etabackend = None       # note: without ETA, the NumPy engines in 'HistogramEngines' are used where available
 import numpy as np
 from matplotlib import pyplot as plt
+from Code.SpectroGUILibrary.TimeresIndex import TimeresIndex
+from Code.SpectroGUILibrary.HistogramEngines import LifetimeHistogram, CountrateHistogram, CorrelationHistogram, SignalCounter, \
+    LIFETIME_CHANNELS, COUNTRATE_CHANNELS, CORRELATION_PAIRS
+from Code.SpectroGUILibrary.ParallelAnalysis import parallel_run_engines, default_workers
+from Code.SpectroGUILibrary.G2Engine import G2Matrix, g2_all_pairs, g2_engine
+from Code.SpectroGUILibrary.HistogramPyramid import HistogramPyramid
+from Code.SpectroGUILibrary.LifetimeFit import fit_lifetimes
+from Code.SpectroGUILibrary.ScanResults import ScanResults
 # >> LiveCounts() Imports:
-from Code.RetinaFiles.src.WebSQSocketController import websocket_client
-import asyncio
+from Code.SpectroGUILibrary.WebSQStream import WebSQStream
 
 
 class DebuggingFunctions:
@@ -123,64 +137,13 @@ class TT:
     @staticmethod
     def start_tt_neg(scan_time=10, scan_name="", folder_path=""):
 
-        def flip_neg_channels(old_file, new_file, bad_ch):
-            if old_file == new_file:
-                print("\n*ERROR*\nProvided file names are the same:\n"
-                      f"   -->  {old_file}\n"
-                      "Please give two separate file names (old and new)")
-                exit()
-
-            # find out how many 16-byte entries there are in the 'input file'
-            temp_file = open(old_file, "rb")
-            temp_read = temp_file.read()  # read 16 bytes at a time
-            temp_file.close()
-            n_entries = int(len(temp_read) / 16)
-
-            # opening read/write data files:
-            # print("\nInitializing datafile manipulation\nUsing data file:", old_file)
-            print('\nFixing Data ')
-            input_file = open(old_file, "rb")
-            output_file = open(new_file, "wb")
-
-            t = 0
-            # loop through all the data entries, extracting and potentially fixing channel value
-            for i in range(n_entries):
-
-                # read 16 bytes at a time (size of each record by timetagger)
-                binary_line = input_file.read(16)
-
-                # read off current channel number (before any changes)
-                channel_int = int.from_bytes(binary_line[4:8], 'little', signed=True)
-
-                # If channel int is in undesired list --> change it. otherwise write unchanged bytes
-                if channel_int in bad_ch:
-                    t += 1
-
-                    # Change channel number. Example: channel -1 --> 101
-                    int_new = abs(channel_int)  # + 100
-
-                    # Convert new channel number to bytestring (4bytes)
-                    bytes_new_ch = int_new.to_bytes(4, 'little', signed=True)
-
-                    # Write new file entry (with changed data)
-                    new_binary_line = binary_line[:4] + bytes_new_ch + binary_line[8:]
-                    output_file.write(new_binary_line)
-                else:
-                    output_file.write(binary_line)
-
-            # close files when done
-            input_file.close()
-            output_file.close()
-
-            print(f"--> Done fixing data!\n")
-
         if scan_name == "":  # if filename not given, create a new one
             todaydate = time.strftime("%y%m%d", time.localtime())
             todaytime = time.strftime("%Hh%Mm%Ss", time.localtime())
             scan_name = f"Spectrometer_no_name_{scan_time}s_({todaydate}_{todaytime})"
 
-        temp_file = folder_path + scan_name + f'temp.timeres'   # This file is used to take the initial data with negative channels
         file = folder_path + scan_name + '.timeres'             # This file will contain converted channel labels (from negative to positive channel names needed for ETA analysis)
+        temp_file = temp_timeres_file(file)                     # This file is used to take the initial data with negative channels ('<scan_name>temp.timeres')
 
         sync_ch = 1
         det_ch2 = -2
@@ -209,10 +172,82 @@ class TT:
         TimeTagger.freeTimeTagger(tagger)
 
         print('Done')
-        flip_neg_channels(temp_file, file, bad_ch=[-1, -2, -3, -4])
-        os.remove(temp_file)
+        flip_neg_channels(temp_file, bad_ch=[-1, -2, -3, -4], in_place=True)  # fix channel labels directly in the temp file...
+        os.replace(temp_file, file)                                            # ...and rename it, instead of copying every record
+
+        signal_counter.index_counter(file)  # This will check the file and print which channels are found (and build its sidecar index)
+
+
+class EngineCache:
+    """
+    LRU cache of compiled ETA engines, keyed on the recipe file content (hash) and the recipe parameters.
+    Shared by all ETA() instances, so re-analysing or switching files doesn't recompile recipes.
+    'get' is called from the analysis thread as well as the Tk thread, so lookups, compiles and evictions hold a lock
+    (a second caller of the same engine waits for the first compile instead of compiling it again).
+    """
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.engines = OrderedDict()   # key --> compiled engine, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.compile_times = {}        # key --> seconds it took to compile
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def recipe_hash(recipe):
+        with open(recipe, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def key(self, recipe, **kwargs):
+        # note: parameters are given to ETA as strings, so e.g. bins=625 and bins='625' are the same engine
+        return self.recipe_hash(recipe), tuple(sorted((arg, str(kwargs[arg])) for arg in kwargs))
+
+    def get(self, recipe, **kwargs):
+        # returns (engine, compile time in s), where compile time is None if the engine came from the cache
+        key = self.key(recipe, **kwargs)
+        with self.lock:
+            if key in self.engines:
+                self.hits += 1
+                self.engines.move_to_end(key)
+                return self.engines[key], None
+
+            self.misses += 1
+            t_start = time.perf_counter()
+            eta_engine = self.compile(recipe, **kwargs)
+            compile_time = time.perf_counter() - t_start
+            self.compile_times[key] = compile_time
+
+            self.engines[key] = eta_engine
+            while len(self.engines) > self.max_size:
+                old_key, _ = self.engines.popitem(last=False)   # evict least recently used
+                self.compile_times.pop(old_key, None)
+
+            return eta_engine, compile_time
+
+    @staticmethod
+    def compile(recipe, **kwargs):
+        print("LOADING ETA")
+
+        with open(recipe, 'r') as filehandle:
+            recipe_obj = json.load(filehandle)
+
+        eta_engine = etabackend.eta.ETA()
+        eta_engine.load_recipe(recipe_obj)
+
+        # Set parameters in the recipe
+        for arg in kwargs:
+            eta_engine.recipe.set_parameter(arg, str(kwargs[arg]))
+        eta_engine.load_recipe()
+
+        return eta_engine
+
+    def clear(self):
+        self.engines.clear()
+        self.compile_times.clear()
+
 
-        signal_counter.eta_counter(file, recipe_file='Code/ETARecipes/signal_counter.ETA')  # This will check the file and print which channels are found
+engine_cache = EngineCache()
 
 
 class ETA:
@@ -230,6 +265,12 @@ class ETA:
             'timetag_file': '',          #'Data/ToF_Duck_10MHz_det1_det2_5.0ms_[2.1, 3.9, -3.2, -4.8]_100x100_231220.timeres',
             'bins':          5000,
             'binsize':       20,     # bin width in ps
+            'backend':      'eta' if etabackend else 'numpy',    # 'numpy' --> analyses without ETA (see HistogramEngines)
+            'analyses':     ('lifetime', 'countrate', 'correlation', 'signal', 'g2'),   # run together by 'new_combined_analysis' ('g2' only with 'numpy')
+            'workers':      default_workers(),   # processes used for the NumPy engines (see ParallelAnalysis)
+            'g2_channels':  None,    # channels of the g2 matrix ('new_g2_analysis'), None --> all but the sync channel
+            'lifetime_fit':  'mono',    # decay fitted to the lifetime histograms: 'mono', 'bi' or None (see LifetimeFit)
+            'lifetime_method':  'mle',  # 'mle' (Poisson) or 'lsq'
             }
         self.folded_countrate_pulses = {}
         self.ch_colors = ['tab:purple', 'tab:pink', 'tab:orange']
@@ -247,30 +288,27 @@ class ETA:
         self.binsize_dict = {}
         self.bins_dict = {}
         self.lifetime_bins_ns = []
+        self.lifetime_pyramid = None   # HistogramPyramid of folded_countrate_pulses
         self.correlation_bins_ns = []
         self.countrate_bins_ns = []
         self.eta_engine = None
         self.eta_engine_corr = None
         self.eta_engine_lifetime = None
         self.eta_engine_spectrum = None
+        self.results = {}           # analysis name --> raw histograms from the last 'new_combined_analysis'
+        self.results_file = None    # file that 'self.results' belongs to
+        self.results_params = {}    # 'analysis_params' of 'self.results'
 
         #self.load_all_engines()
 
     def load_eta(self, recipe, **kwargs):
-        print("LOADING ETA")
-
-        with open(recipe, 'r') as filehandle:
-            recipe_obj = json.load(filehandle)
-
-        eta_engine = etabackend.eta.ETA()
-        eta_engine.load_recipe(recipe_obj)
-
-        # Set parameters in the recipe
-        for arg in kwargs:
-            eta_engine.recipe.set_parameter(arg, str(kwargs[arg]))
-        eta_engine.load_recipe()
+        # Returns a compiled engine for the recipe and parameters, only compiling if it's not already in the cache
+        eta_engine, compile_time = engine_cache.get(recipe, **kwargs)
 
-        #self.parent.write_log(f"Recipe loaded!")
+        if compile_time is None:
+            self.parent.write_log(f"Recipe '{Path(recipe).name}' loaded from cache")
+        else:
+            self.parent.write_log(f"Recipe '{Path(recipe).name}' compiled in {compile_time:.2f} s")
 
         return eta_engine
 
@@ -282,17 +320,163 @@ class ETA:
         #self.eta_engine_lifetime = self.load_eta(self.const["eta_recipe_lifetime"], bins=self.const["bins"], binsize=self.const["binsize"])  # NOTE: removed for test
         #self.eta_engine_spectrum = self.load_eta(self.const["eta_recipe_spectrum"], bins=self.const["bins"], binsize=self.const["binsize"])  # NOTE: removed for test
         print("LOADING ALL ETA ENGINES")
+        self.set_countrate_bins(scantime)
+        if etabackend is None:
+            print("ETA is not installed, skipping loading engines")
+            return
 
-        self.binsize_dict['counts'] = 10 * (10 ** 10)
-        self.bins_dict['counts'] = (scantime * 0.1) * (10 ** 2)
+        t_start = time.perf_counter()
+        compiled_before = engine_cache.misses
 
-        self.eta_engine_corr = self.load_eta(self.const["eta_recipe_corr"], bins=10000, binsize=20)
-        self.eta_engine_lifetime = self.load_eta(self.const["eta_recipe_lifetime"], bins=125*5, binsize=20, det_delay = 12500)
-        self.eta_engine = self.load_eta(self.const["eta_recipe_lifetime"], bins=125*5, binsize=20, det_delay = 12500)
-        self.eta_engine_spectrum = self.load_eta(self.const["eta_recipe_spectrum"], bins=self.bins_dict['counts'], binsize=self.binsize_dict['counts'])
+        recipes = self.eta_recipes(scantime)   # note: the same engines as 'run_eta_analysis' gets from the cache
+        self.eta_engine_corr = self.load_eta(recipes['correlation'][0], **recipes['correlation'][1])
+        self.eta_engine_lifetime = self.load_eta(recipes['lifetime'][0], **recipes['lifetime'][1])
+        self.eta_engine = self.eta_engine_lifetime   # note: same recipe and parameters as the lifetime engine
+        self.eta_engine_spectrum = self.load_eta(recipes['countrate'][0], **recipes['countrate'][1])
+
+        self.parent.write_log(f"Engines ready in {time.perf_counter() - t_start:.2f} s "
+                              f"({engine_cache.misses - compiled_before} compiled, {len(engine_cache.engines)} cached)")
+
+    @staticmethod
+    def countrate_bins(scantime=1):
+        # (bins, binsize in ps) of the countrate histograms, 0.1 s bins over the whole scan time
+        return (scantime * 0.1) * (10 ** 2), 10 * (10 ** 10)
+
+    def set_countrate_bins(self, scantime=1):
+        self.bins_dict['counts'], self.binsize_dict['counts'] = self.countrate_bins(scantime)
 
     # ---------------------------------
 
+    def new_combined_analysis(self, file=None, analyses=None, scantime=1):
+        """
+        Reads the file once and fills every analysis in 'analyses' from the same chunks of records,
+        instead of each 'new_*_analysis' reading the whole file again. With the 'numpy' backend it uses the engines
+        in 'HistogramEngines' (same histograms as the ETA recipes), where large files are split over 'workers'
+        processes. With the 'eta' backend the recipes run one after the other, on the engines of 'load_all_engines'.
+        The lifetime results are stored as usual, the rest is kept in 'self.results' where 'new_countrate_analysis',
+        'new_correlation_analysis' and 'signal_count' pick them up (as long as they are called for the same file).
+        """
+        print("STARTING COMBINED ANALYSIS")
+
+        if not file:
+            file = self.parent.params['file_name']['var'].get()
+
+        t_start = time.perf_counter()
+        results = self.run_combined_analysis(file, analyses=analyses, scantime=scantime)
+        self.parent.write_log(f"Analyzed {', '.join(results.keys())} in {time.perf_counter() - t_start:.2f} s")
+
+        self.apply_combined_results(file, results, scantime=scantime)
+        return results
+
+    def run_combined_analysis(self, file, analyses=None, scantime=1, progress=None, cancel=None, log=None):
+        # Only computes the histograms and returns them (no GUI calls), so it can run in a background thread.
+        # See 'new_combined_analysis', and 'apply_combined_results' to store them afterwards.
+        # 'cancel' (e.g. 'AnalysisJob.cancelled') also stops the worker processes of the NumPy engines right away,
+        # 'log' (e.g. 'AnalysisJob.log') gets messages for the GUI log, like how long the ETA recipes took to compile.
+        analyses = analyses or self.const['analyses']
+        if self.const['backend'] == 'eta':
+            return self.run_eta_analysis(file, analyses=analyses, scantime=scantime, progress=progress, log=log)
+
+        engines = {}
+        if 'lifetime' in analyses:
+            engines['lifetime'] = LifetimeHistogram(bins=125*5, binsize=20, det_delay=12500)
+        if 'countrate' in analyses:
+            bins, binsize = self.countrate_bins(scantime)
+            engines['countrate'] = CountrateHistogram(bins=bins, binsize=binsize)
+        if 'correlation' in analyses:
+            engines['correlation'] = CorrelationHistogram(bins=10000, binsize=20)
+        if 'signal' in analyses:
+            engines['signal'] = SignalCounter()
+        if 'g2' in analyses:
+            engines['g2'] = g2_engine(file, channels=self.const['g2_channels'], bins=10000, binsize=20)
+
+        results = parallel_run_engines(file, list(engines.values()), n_workers=self.const['workers'], progress=progress,
+                                       cancel=cancel)
+        results = dict(zip(engines.keys(), results))
+        if 'g2' in results:
+            results['g2']['channels'] = np.array(engines['g2'].channels)   # note: the pairs follow from these, see 'g2_results'
+        return results
+
+    def eta_recipes(self, scantime=1):
+        # analysis --> (recipe, parameters, histogram names), the same parameters as 'load_all_engines'
+        bins, binsize = self.countrate_bins(scantime)
+        return {'lifetime': (self.const["eta_recipe_lifetime"], dict(bins=125*5, binsize=20, det_delay=12500), LIFETIME_CHANNELS),
+                'countrate': (self.const["eta_recipe_spectrum"], dict(bins=bins, binsize=binsize), COUNTRATE_CHANNELS),
+                'correlation': (self.const["eta_recipe_corr"], dict(bins=10000, binsize=20), CORRELATION_PAIRS)}
+
+    def run_eta_analysis(self, file, analyses=None, scantime=1, progress=None, log=None):
+        # ETA version of 'run_combined_analysis': one recipe per analysis, with the compiled engines from the cache
+        # (see EngineCache). Recipes that aren't cached yet are compiled here, in the analysis thread, and the time
+        # that took goes to 'log'. The signal counts come from the sidecar index, 'signal_counter.eta' only reads
+        # qutag files.
+        analyses = analyses or self.const['analyses']
+        log = log or print
+        recipes = self.eta_recipes(scantime)
+        todo = [analysis for analysis in analyses if analysis in recipes]
+
+        results = {}
+        for k, analysis in enumerate(todo):
+            recipe, params, names = recipes[analysis]
+            eta_engine, compile_time = engine_cache.get(recipe, **params)
+            if compile_time is not None:
+                log(f"Recipe '{Path(recipe).name}' compiled in {compile_time:.2f} s")
+            cut = eta_engine.clips(Path(file), format=1)
+            result = eta_engine.run({"timetagger1": cut}, group='swabian')
+            results[analysis] = {name: np.asarray(result[name]) for name in names}
+            if progress:
+                progress((k + 1) / (len(todo) + ('signal' in analyses)))   # note: raises if the job was cancelled
+        if 'signal' in analyses:
+            results['signal'] = TimeresIndex.get(file).channel_totals()
+        return results
+
+    def analysis_params(self, scantime=1):
+        # everything that changes the histograms of 'run_combined_analysis' (saved with them, see 'save_results')
+        params = {'scantime': scantime, 'backend': self.const['backend'], 'analyses': list(self.const['analyses'])}
+        if self.const['backend'] == 'numpy':
+            params['g2_channels'] = self.const['g2_channels']
+        else:
+            params['recipes'] = {analysis: [Path(recipe).name, options]
+                                 for analysis, (recipe, options, names) in self.eta_recipes(scantime).items()}
+        return params
+
+    def apply_combined_results(self, file, results, scantime=1):
+        self.set_countrate_bins(scantime)
+        self.results = results
+        self.results_file = file
+        self.results_params = self.analysis_params(scantime)
+        if 'lifetime' in self.results:
+            self.set_lifetime_result(self.results['lifetime'], bins=125*5, binsize=20)
+
+    def save_results(self, file=None):
+        # saves the results of the last analysis, with pix_dict and the scan parameters, next to the '.timeres' file
+        file = file or self.results_file
+        axes = {'lifetime': self.lifetime_bins_ns,
+                'correlation': np.arange(-10000, 10000) * 20}    # note: of the concatenated pairs, e.g. h23 + h32
+        if 'countrate' in self.results:
+            axes['countrate'] = np.arange(self.bins_dict['counts']) * self.binsize_dict['counts']
+        if 'g2' in self.results:
+            axes['g2'] = np.arange(-10000, 10000) * 20
+        params = dict((key, param['var'].get()) for key, param in self.parent.params.items())
+        params.update(self.results_params)      # note: the scan time of the analysis, the entry may have changed since
+        return ScanResults(self.results, axes, self.pix_dict, params).save(file)
+
+    def load_results(self, file, scan=None):
+        # shows the saved results of 'file' (see 'save_results') instead of analyzing it again,
+        # returns the ScanResults, or None if there are none or the file has changed since.
+        # note: only the histograms are used, pix_dict (wavelengths, colors, fit) is computed from them with the
+        # current settings, like after an analysis
+        scan = scan or ScanResults.load(file)
+        if scan is None:
+            return None
+        self.apply_combined_results(file, scan.results, scantime=scan.params.get('scantime', 1))
+        return scan
+
+    def cached_result(self, analysis, file):
+        # result of 'new_combined_analysis' for this file, or None if it has to be analyzed again
+        if file == self.results_file:
+            return self.results.get(analysis)
+        return None
+
     def new_lifetime_analysis(self, ax=None, file=None):
         print("STARTING NEW LIFETIME ANALYSIS")
 
@@ -305,14 +489,29 @@ class ETA:
         if not file:
             file = self.parent.params['file_name']['var'].get()
 
-        cutfile = self.eta_engine_lifetime.clips(filename=file, format=1)
-        result = self.eta_engine_lifetime.run({"timetagger1": cutfile}, group='swabian')  # Runs the time tagging analysis and generates histograms
+        if self.const['backend'] == 'numpy':
+            result = parallel_run_engines(file, [LifetimeHistogram(bins=bins, binsize=binsize, det_delay=12500)],  # same histograms as the ETA recipe
+                                          n_workers=self.const['workers'])[0]
+        else:
+            cutfile = self.eta_engine_lifetime.clips(filename=file, format=1)
+            result = self.eta_engine_lifetime.run({"timetagger1": cutfile}, group='swabian')  # Runs the time tagging analysis and generates histograms
 
+        self.set_lifetime_result(result, bins, binsize)
+
+    def set_lifetime_result(self, result, bins, binsize):
         self.lifetime_bins_ns = np.arange(bins) * binsize
 
         channels = ['h4', 'h2', 'h3']
 
         self.folded_countrate_pulses = dict([(c, result[c]) for c in channels])
+        # every coarser binning (binsize * 2**k) for the plots, see HistogramPyramid
+        self.lifetime_pyramid = HistogramPyramid(self.folded_countrate_pulses, binsize)
+
+        # decay times of all channels in one go (tail fit after the peak)
+        fit = None
+        if self.const['lifetime_fit']:
+            fit = fit_lifetimes(np.vstack(list(self.folded_countrate_pulses.values())), binsize,
+                                model=self.const['lifetime_fit'], method=self.const['lifetime_method'])
 
         # --TODO CHECK BELOW--
         wavelens = self.get_wavelengths()
@@ -326,8 +525,19 @@ class ETA:
                 'color': self.gui_class.CIE_colors.get_rgb(wavelens[c]),
                 'counts': sum(self.folded_countrate_pulses[channel]),  # sum of channel
                 'peak idx': peak_idx,
-                'lifetime': self.lifetime_bins_ns[peak_idx],  # calculated max value
+                'peak time': self.lifetime_bins_ns[peak_idx],   # ps, time of the max value
+                'lifetime': self.lifetime_bins_ns[peak_idx],    # ps, fitted tau below (the peak time without a fit)
             }
+            if fit is not None:
+                self.pix_dict[channel].update({
+                    'lifetime': fit['tau_mean'][c],             # ps, amplitude weighted mean for 'bi'
+                    'lifetime err': fit['tau_mean_err'][c],
+                    'lifetimes': fit['tau'][c],                 # ps, one per exponential (short to long)
+                    'lifetimes err': fit['tau_err'][c],
+                    'amplitudes': fit['amplitude'][c],
+                    'lifetime chi2': fit['chi2_red'][c],
+                    'lifetime ok': bool(fit['ok'][c]),
+                })
 
         #return ax
 
@@ -340,7 +550,16 @@ class ETA:
         time_axis = np.arange(0, self.bins_dict['counts']) * self.binsize_dict['counts']
 
         if not file:
-            file = self.parent.params['file_name']['var'].get()
+            # note: the plot tabs show the last analyzed file, which may differ from the entry if jobs were queued
+            file = self.results_file or self.parent.params['file_name']['var'].get()
+
+        result = self.cached_result('countrate', file)
+        if result is not None:
+            return time_axis / (10**12), result
+
+        if self.const['backend'] == 'numpy':
+            engine = CountrateHistogram(bins=self.bins_dict['counts'], binsize=self.binsize_dict['counts'])
+            return time_axis / (10**12), parallel_run_engines(file, [engine], n_workers=self.const['workers'])[0]
 
         print(f'Starting ETA countrate analysis on file: {file}')
         cut = self.eta_engine_spectrum.clips(Path(file), format=1)
@@ -362,12 +581,17 @@ class ETA:
         #channels = ['h1', 'h2', 'h3', 'h4']
 
         if not file:
-            file = self.parent.params['file_name']['var'].get()
-
-        print(f'Starting ETA correlation analysis on file: {file}')
-        cut = self.eta_engine_corr.clips(Path(file), format=1)
-        result = self.eta_engine_corr.run({"timetagger1": cut}, group='swabian')
-        print('Finished ETA analysis')
+            # note: the plot tabs show the last analyzed file, which may differ from the entry if jobs were queued
+            file = self.results_file or self.parent.params['file_name']['var'].get()
+
+        result = self.cached_result('correlation', file)
+        if result is None and self.const['backend'] == 'numpy':
+            result = parallel_run_engines(file, [CorrelationHistogram(bins=bins, binsize=binsize)], n_workers=self.const['workers'])[0]
+        elif result is None:
+            print(f'Starting ETA correlation analysis on file: {file}')
+            cut = self.eta_engine_corr.clips(Path(file), format=1)
+            result = self.eta_engine_corr.run({"timetagger1": cut}, group='swabian')
+            print('Finished ETA analysis')
         # Result keys: dict_keys(['timetagger1', 'h23', 'h32', 'h24', 'h42', 'h43', 'h34'])
 
         g2_23 = np.concatenate((result['h23'], result['h32']))
@@ -388,8 +612,36 @@ class ETA:
         # TODO: RETURN FIGURES!!! OR SOMETHING TO PUT IN GUI
         return delta_t, {'h23' : g2_23, 'h24' : g2_24, 'h34' : g2_34}
 
-    def signal_count(self, file):
+    def new_g2_analysis(self, file=None, channels=None, bins=10000, binsize=20, method='auto'):
+        # g2 of every pair of channels (see 'G2Engine'): delays in ns, pair labels and the normalized (pair x delay) g2
+        if not file:
+            file = self.results_file or self.parent.params['file_name']['var'].get()
+        channels = channels or self.const['g2_channels']
+        print(f'Starting g2 analysis of all channel pairs on file: {file}')
+        delays, labels, g2 = g2_all_pairs(file, channels=channels, bins=bins, binsize=binsize, method=method,
+                                          n_workers=self.const['workers'])
+        print('Finished g2 analysis')
+        return delays * 1e-3, labels, g2
+
+    def g2_results(self, file=None):
+        # same as 'new_g2_analysis', from the g2 of the combined analysis (or saved results) if it has one
+        result = self.cached_result('g2', file or self.results_file)
+        if result is None:
+            return self.new_g2_analysis(file)
+        engine = G2Matrix(result['channels'], bins=10000, binsize=20)
+        return engine.time_axis() * 1e-3, engine.labels(), engine.normalized(result)
+
+    def signal_count(self, file, use_index=True):
         # help function to check how many counts each channel has in the timeres file
+        if use_index:
+            # note: per-channel totals are read from the sidecar index, which is only (re)built if the file changed
+            totals = self.cached_result('signal', file) or TimeresIndex.get(file).channel_totals()
+            self.parent.write_log(f"\n# : counts\n-------")
+            for ch in totals:
+                self.parent.write_log(f"{ch} : {totals[ch]}")
+            self.parent.write_log(f"done!")
+            return totals
+
         print("STARTING SIGNAL COUNT ANALYSIS???")
 
         def eta_counter_swab(recipe_file, timetag_file, **kwargs):
@@ -470,10 +722,16 @@ class ETA:
 
 
 class LiveCounts:
-    def __init__(self, base_url=None):
+    def __init__(self, base_url=None, timeout=5):
+        self.stream = None
         if base_url:
-            loop = asyncio.get_event_loop()
-            loop.run_until_complete(websocket_client(base_url, self.get_active_channels, n=1))  # finds which channels we collect from Retina setup
+            # one websocket session that stays open (and reconnects) for as long as we are connected to the Retina
+            self.stream = WebSQStream(base_url).start()
+            frame = self.stream.wait_frame(timeout=timeout)
+            if frame is None:
+                self.close()
+                raise ConnectionError(f"No counts received from {base_url}: {self.stream.last_error}")
+            self.get_active_channels(frame.payload)  # finds which channels we collect from Retina setup
             self.nr_chs = self.found_channels.shape[0]   # self.nr_chs = 24
             self.ch_numbers = self.found_channels.copy()
             self.active_chs = {}
@@ -502,4 +760,13 @@ class LiveCounts:
         found_channels.sort()
         self.found_channels = np.array(found_channels)
 
+    def latest_payload(self):
+        # newest package from the open websocket session (None if not connected or nothing received yet)
+        frame = self.stream.latest() if self.stream else None
+        return frame.payload if frame else None
+
+    def close(self):
+        if self.stream:
+            self.stream.stop()
+
 
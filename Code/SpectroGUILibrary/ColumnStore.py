@@ -0,0 +1,193 @@
+import os
+import json
+import numpy as np
+
+# A directory of tables stored column by column, one '.npy' file per column (plain NumPy, no extra packages):
+#     store = ColumnStore('batch_results')
+#     store.upsert('lifetime', 'file', {'file': [...], 'tau': [...], 'histogram': (rows x bins) array})
+#     store.meta['settings'] = {...}
+#     store.save()                                      --> writes the tables and 'manifest.json' (row counts, meta)
+#     store.read('lifetime', ['file', 'tau'])           --> {column: array}, memory mapped (only what is read is loaded)
+# Every column of a table has one entry per row: a string / number per row, or a (rows x n) array, e.g. a histogram.
+# 'upsert' replaces all rows whose key (e.g. the file name) is in the new rows, so re-analyzing a file does not
+# duplicate it. The upserted rows are kept in memory and each table is written once, by 'save' (or 'flush'), so adding
+# files one by one does not rewrite the whole table every time. Reading a table (or its columns / row count) writes
+# its rows first. Columns are written to a temporary file first and renamed, so a crash never leaves half a column.
+
+MANIFEST = 'manifest.json'
+STORE_VERSION = 1
+
+
+def _fill_value(dtype):
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind in 'US':
+        return ''
+    if dtype.kind == 'b':
+        return False
+    return 0
+
+
+def _concat(parts):
+    # rows of several blocks of one column, where 2D blocks can have a different width (padded with the fill value)
+    parts = [np.asarray(part) for part in parts if len(part)]
+    if not parts:
+        return np.zeros(0)
+    if parts[0].ndim == 1:
+        return np.concatenate(parts)
+    width = max(part.shape[1] for part in parts)
+    if any(part.shape[1] != width for part in parts):
+        dtype = np.result_type(*parts)
+        dtype = np.dtype(float) if dtype.kind in 'iub' else dtype   # note: integer columns are padded with NaN as floats
+        parts = [np.pad(part.astype(dtype), ((0, 0), (0, width - part.shape[1])), constant_values=_fill_value(dtype))
+                 for part in parts]
+    return np.concatenate(parts)
+
+
+def _merge(blocks):
+    # rows of several blocks ({column: values}) one after the other, columns that a block does not have are filled
+    names = list(dict.fromkeys(name for block in blocks for name in block))
+    merged = {}
+    for name in names:
+        example = next(block[name] for block in blocks if name in block)
+        parts = []
+        for block in blocks:
+            if name in block:
+                parts.append(block[name])
+            else:
+                n = len(next(iter(block.values()))) if block else 0
+                parts.append(np.full((n,) + example.shape[1:], _fill_value(example.dtype), dtype=example.dtype))
+        merged[name] = _concat(parts)
+    return merged
+
+
+class ColumnStore:
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.meta = {}
+        self._tables = {}    # table --> {'columns': [...], 'n_rows': n}
+        self._pending = {}   # table --> (key, [{column: values}, ...]) upserted, not written yet
+        manifest = os.path.join(self.path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                data = json.load(f)
+            if data.get('version') != STORE_VERSION:
+                raise ValueError(f"{self.path} is a version {data.get('version')} store, expected {STORE_VERSION}")
+            self._tables = data['tables']
+            self.meta = data.get('meta', {})
+
+    def tables(self):
+        self.flush()
+        return list(self._tables.keys())
+
+    def columns(self, table):
+        self.flush(table)
+        return list(self._tables[table]['columns']) if table in self._tables else []
+
+    def __len__(self):
+        self.flush()
+        return sum(t['n_rows'] for t in self._tables.values())
+
+    def n_rows(self, table):
+        self.flush(table)
+        return self._tables[table]['n_rows'] if table in self._tables else 0
+
+    def _column_file(self, table, column):
+        return os.path.join(self.path, table, column + '.npy')
+
+    # ---- reading ----
+
+    def read(self, table, columns=None, mmap=True):
+        # {column: array}, all columns by default (an unknown table gives {})
+        self.flush(table)
+        if table not in self._tables:
+            return {}
+        columns = self.columns(table) if columns is None else columns
+        return {column: np.load(self._column_file(table, column), mmap_mode='r' if mmap else None)
+                for column in columns}
+
+    def rows(self, table, key, value, columns=None):
+        # the rows where column 'key' equals 'value'
+        data = self.read(table, columns)
+        if not data:
+            return {}
+        keep = np.asarray(self.read(table, [key])[key]) == value
+        return {column: np.asarray(values[keep]) for column, values in data.items()}
+
+    # ---- writing ----
+
+    def write(self, table, columns):
+        # replaces the whole table with 'columns' ({name: one value per row}), at once
+        self._pending.pop(table, None)
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"columns of '{table}' have different numbers of rows: {sorted(lengths)}")
+        os.makedirs(os.path.join(self.path, table), exist_ok=True)
+        for name, values in columns.items():
+            if values.dtype.kind == 'O':
+                raise TypeError(f"column '{table}.{name}' has no fixed type (object array), store numbers or strings")
+            file = self._column_file(table, name)
+            with open(file + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(file + '.tmp', file)
+        old_columns = self._tables[table]['columns'] if table in self._tables else []
+        for name in set(old_columns) - set(columns):
+            os.remove(self._column_file(table, name))
+        self._tables[table] = {'columns': list(columns.keys()), 'n_rows': lengths.pop() if lengths else 0}
+
+    def upsert(self, table, key, columns):
+        """
+        Adds the rows in 'columns' to the table, after removing the rows whose 'key' value is one of the new ones.
+        Columns that only the old or only the new rows have are filled (NaN, 0, '' or False) for the others.
+        The rows are written by the next 'save' or 'flush' (or when the table is read).
+        """
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"columns of '{table}' have different numbers of rows: {sorted(lengths)}")
+        if key not in columns:
+            raise KeyError(f"the rows for '{table}' have no key column '{key}'")
+        for name, values in columns.items():
+            if values.dtype.kind == 'O':
+                raise TypeError(f"column '{table}.{name}' has no fixed type (object array), store numbers or strings")
+        if table in self._pending and self._pending[table][0] != key:
+            self.flush(table)
+        self._pending.setdefault(table, (key, []))[1].append(columns)
+
+    def flush(self, table=None):
+        # writes the upserted rows of 'table' (default: all tables), each table once
+        for table in [table] if table is not None else list(self._pending):
+            if table not in self._pending:
+                continue
+            key, blocks = self._pending.pop(table)
+            # a key in a later block replaces the same key in the earlier ones (and in the table)
+            new_keys = np.zeros(0)
+            for i in reversed(range(len(blocks))):
+                block = blocks[i]
+                if len(new_keys):
+                    keep = ~np.isin(block[key], new_keys)
+                    blocks[i] = {name: values[keep] for name, values in block.items()}
+                new_keys = np.concatenate((new_keys, block[key])) if len(new_keys) else block[key]
+            # note: not memory mapped, the column files are replaced while the old rows are still in use
+            old = self.read(table, mmap=False)
+            if old:
+                keep = ~np.isin(old[key], new_keys)
+                blocks.insert(0, {name: values[keep] for name, values in old.items()})
+            self.write(table, _merge(blocks))
+
+    def delete(self, table, key, values):
+        # removes the rows whose 'key' is in 'values' (at once)
+        old = self.read(table, mmap=False)
+        if old:
+            keep = ~np.isin(old[key], values)
+            self.write(table, {name: column[keep] for name, column in old.items()})
+
+    def save(self):
+        self.flush()
+        os.makedirs(self.path, exist_ok=True)
+        manifest = os.path.join(self.path, MANIFEST)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump({'version': STORE_VERSION, 'tables': self._tables, 'meta': self.meta}, f, indent=1)
+        os.replace(manifest + '.tmp', manifest)
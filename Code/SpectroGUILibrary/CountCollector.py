@@ -0,0 +1,288 @@
+import csv
+import sys
+import time
+import queue
+import threading
+import numpy as np
+
+# Long-running collection of the channel counts over the JSON-RPC api (what 'WebSQController.collectCounts' does, but
+# for hours instead of seconds):
+#     collector = CountCollector(sq, interval=0.5, file='counts.csv', on_sample=print).start()
+#     ...
+#     collector.metrics()          --> {'n_samples': ..., 'n_late': ..., 'n_missed': ..., ...}
+#     collector.stop()
+# - Samples are taken on a fixed grid of the monotonic clock (t_start + k * interval), so slow requests don't make
+#   the samples drift and a change of the system clock doesn't move them. A request that overruns the next grid
+#   point skips it, and the skipped points are counted ('n_missed') instead of a warning at the end.
+# - Every sample has the client times (request sent / answer received) and the server time of the counts, so
+#   'n_repeated' counts samples that got the same integration period as the one before.
+# - Samples are handed to the callback / file in a separate thread through a bounded queue, nothing is kept:
+#   memory stays the same however long it runs. If the consumer can't keep up, new samples are dropped
+#   ('n_dropped') instead of delaying the sampling.
+
+
+class SampleSchedule:
+    """
+    The grid t_start + k * interval on time.monotonic(), with the statistics of how well it was kept:
+        schedule = SampleSchedule(interval=0.5, runtime=60).start()
+        while not schedule.finished():
+            time.sleep(schedule.wait())
+            taken = schedule.take()         --> (tick, scheduled, lateness), None once the runtime has passed
+            ...
+    A sample that starts more than 'late_after' s (default: half an interval) after its grid point counts as late.
+    """
+
+    def __init__(self, interval, runtime=None, late_after=None):
+        if interval <= 0:
+            raise ValueError(f"interval must be positive, not {interval}")
+        self.interval = float(interval)
+        self.runtime = runtime
+        self.late_after = self.interval / 2 if late_after is None else late_after
+        self.t_start = None
+        self.k = 0                  # next grid point
+        self.n_taken = 0
+        self.n_late = 0
+        self.n_missed = 0
+        self.max_lateness = 0.0
+        self.sum_lateness = 0.0
+
+    def start(self, now=None):
+        self.t_start = time.monotonic() if now is None else now
+        self.k = 0
+        return self
+
+    def deadline(self):
+        return self.t_start + self.k * self.interval
+
+    def finished(self):
+        return self.runtime is not None and self.k * self.interval > self.runtime
+
+    def wait(self, now=None):
+        # seconds until the next grid point (0 if it has passed)
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.deadline() - now)
+
+    def take(self, now=None):
+        # the grid point of a sample that starts now: (tick, scheduled monotonic time, lateness in s), or None if
+        # the runtime has passed. Grid points that have passed without a sample are counted as missed.
+        now = time.monotonic() if now is None else now
+        behind = int((now - self.t_start) // self.interval)
+        if self.runtime is not None and behind * self.interval > self.runtime:
+            self.n_missed += max(0, int(self.runtime // self.interval) + 1 - self.k)
+            self.k = behind
+            return None
+        if behind > self.k:
+            self.n_missed += behind - self.k
+            self.k = behind
+        tick = self.k
+        scheduled = self.t_start + tick * self.interval
+        lateness = max(0.0, now - scheduled)
+        self.k += 1
+        self.n_taken += 1
+        self.sum_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness > self.late_after:
+            self.n_late += 1
+        return tick, scheduled, lateness
+
+
+class CountSample:
+    # one getCounts of all collected channels, in the order of 'CountCollector.ranks'
+    __slots__ = ('seq', 'tick', 'scheduled', 'lateness', 't_request', 't_response', 'server_time', 'counts',
+                 'monitorV')
+
+    def __init__(self, seq, tick, scheduled, lateness, t_request, t_response, server_time, counts, monitorV):
+        self.seq = seq                  # 0, 1, 2, ... samples taken
+        self.tick = tick                # grid point (tick * interval s after the start)
+        self.scheduled = scheduled      # time.monotonic() of the grid point
+        self.lateness = lateness        # s between the grid point and the request
+        self.t_request = t_request      # time.time() when the request was sent
+        self.t_response = t_response    # time.time() when the answer arrived
+        self.server_time = server_time  # ms since the server started, of the newest channel data
+        self.counts = counts            # np.array, one per channel
+        self.monitorV = monitorV
+
+
+class CountsFileWriter:
+    """
+    Appends samples to a .csv file (one line per sample, flushed every 'flush_every' samples):
+        seq, tick, lateness, t_request, t_response, server_time, counts_<rank>..., [monitorV_<rank>...]
+    read back with 'read_counts_file'.
+    """
+
+    def __init__(self, file, ranks, monitorV=False, flush_every=10):
+        self.file = str(file)
+        self.monitorV = monitorV
+        self.flush_every = flush_every
+        self._n = 0
+        self._handle = open(self.file, 'w', newline='')
+        self._writer = csv.writer(self._handle)
+        header = ['seq', 'tick', 'lateness', 't_request', 't_response', 'server_time']
+        header += [f'counts_{rank}' for rank in ranks]
+        if monitorV:
+            header += [f'monitorV_{rank}' for rank in ranks]
+        self._writer.writerow(header)
+
+    def __call__(self, sample):
+        self.write(sample)
+
+    def write(self, sample):
+        row = [sample.seq, sample.tick, f'{sample.lateness:.6f}', f'{sample.t_request:.6f}',
+               f'{sample.t_response:.6f}', sample.server_time]
+        row += sample.counts.tolist()
+        if self.monitorV:
+            row += sample.monitorV.tolist()
+        self._writer.writerow(row)
+        self._n += 1
+        if self._n % self.flush_every == 0:
+            self._handle.flush()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+
+def read_counts_file(file):
+    # {column name: np.array} of a file from 'CountsFileWriter'
+    data = np.genfromtxt(file, delimiter=',', names=True, ndmin=1)
+    return {name: data[name] for name in data.dtype.names}
+
+
+class CountCollector:
+
+    def __init__(self, sq, interval=0.5, runtime=None, channelLoc=None, selectedCus=None, on_sample=None, file=None,
+                 monitorV=False, late_after=None, queue_size=1000):
+        self.sq = sq                    # a WebSQController
+        self.interval = interval
+        self.runtime = runtime          # s, None: until 'stop'
+        self.channelLoc = channelLoc or sq.getChannelLoc(selectedCus=selectedCus)
+        self.ranks = list(self.channelLoc.keys())
+        self.locs = [tuple(self.channelLoc[rank]) for rank in self.ranks]
+        self.monitorV = monitorV
+        self.late_after = late_after
+
+        self.sinks = []
+        if on_sample is not None:
+            self.sinks.append(on_sample)
+        self.writer = None
+        if file is not None:
+            self.writer = CountsFileWriter(file, self.ranks, monitorV=monitorV)
+            self.sinks.append(self.writer.write)
+
+        self.schedule = None
+        self.n_dropped = 0          # samples the consumer thread had no room for
+        self.n_repeated = 0         # samples with the same server time as the one before
+        self.n_errors = 0           # failed requests (the collection goes on)
+        self.last_error = None
+        self.sum_request = 0.0
+        self.max_request = 0.0
+        self.latest = None          # the newest sample
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._sampler = None
+        self._consumer = None
+
+    # ---- running ----
+
+    def start(self):
+        self._stop.clear()
+        self._consumer = threading.Thread(target=self._consume, daemon=True)
+        self._consumer.start()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+        return self
+
+    def run(self):
+        # collects in the calling thread until 'runtime' has passed (or Ctrl+C), returns the metrics
+        self.start()
+        try:
+            while self._sampler.is_alive():
+                self._sampler.join(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return self.metrics()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join(timeout)
+        if self._consumer is not None:
+            self._queue.put(None)       # note: the consumer handles everything before this, then ends
+            self._consumer.join(timeout)
+            self._consumer = None
+        if self.writer is not None:
+            self.writer.close()
+
+    def running(self):
+        return self._sampler is not None and self._sampler.is_alive()
+
+    def _sample_loop(self):
+        self.schedule = schedule = SampleSchedule(self.interval, self.runtime, self.late_after).start()
+        last_server_time = None
+        seq = 0
+        while not schedule.finished():
+            if self._stop.wait(schedule.wait()):
+                break
+            taken = schedule.take()
+            if taken is None:
+                break
+            tick, scheduled, lateness = taken
+            t_request = time.time()
+            try:
+                data = self.sq.getCounts(channelLoc=self.channelLoc)
+            except Exception as error:     # e.g. the connection dropped: note it and keep going
+                self.n_errors += 1
+                self.last_error = repr(error)
+                continue
+            t_response = time.time()
+            self.sum_request += t_response - t_request
+            self.max_request = max(self.max_request, t_response - t_request)
+
+            channels = [data[loc] for loc in self.locs]
+            server_time = max(c['time'] for c in channels) if channels else None
+            if server_time == last_server_time:
+                self.n_repeated += 1
+            last_server_time = server_time
+            sample = CountSample(seq, tick, scheduled, lateness, t_request, t_response, server_time,
+                                 np.array([c['counts'] for c in channels]),
+                                 np.array([c['monitorV'] for c in channels]) if self.monitorV else None)
+            seq += 1
+            self.latest = sample
+            try:
+                self._queue.put_nowait(sample)
+            except queue.Full:
+                self.n_dropped += 1
+
+    def _consume(self):
+        while True:
+            sample = self._queue.get()
+            if sample is None:
+                return
+            for sink in self.sinks:
+                try:
+                    sink(sample)
+                except Exception as error:
+                    sys.stderr.write(f"CountCollector: {sink} failed on sample {sample.seq}: {error!r}\n")
+
+    # ---- metrics ----
+
+    def metrics(self):
+        schedule = self.schedule
+        n = schedule.n_taken if schedule else 0
+        n_ok = n - self.n_errors
+        return {
+            'n_samples': n_ok,
+            'n_late': schedule.n_late if schedule else 0,
+            'n_missed': schedule.n_missed if schedule else 0,
+            'n_dropped': self.n_dropped,
+            'n_repeated': self.n_repeated,
+            'n_errors': self.n_errors,
+            'max_lateness': schedule.max_lateness if schedule else 0.0,
+            'mean_lateness': schedule.sum_lateness / n if n else 0.0,
+            'max_request': self.max_request,
+            'mean_request': self.sum_request / n_ok if n_ok else 0.0,
+            'queued': self._queue.qsize(),
+        }
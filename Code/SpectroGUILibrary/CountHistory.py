@@ -0,0 +1,155 @@
+import os
+import glob
+import time
+import numpy as np
+
+# History of the live channel counts from the Retina, in a preallocated (time x channel) ring buffer:
+#     history = CountHistory(channels=[1, 2, ..., 24], capacity=36000)    --> 1 hour at 10 frames per second
+#     history.append_frame(payload)        --> a frame from 'decode_counts_array' (or history.append(counts, t))
+#     times, counts = history.last(50)     --> the last 50 frames, oldest first
+#     history.mean(seconds=5)              --> average count per channel over the last 5 s
+# Every row is written twice, at i and i + capacity, so the last n rows are always one contiguous block and
+# 'last' / 'since' return views (no copy) while 'append' stays O(1).
+# With 'spill_dir', every 'spill_chunk' rows are also saved to their own .npz file, so a run longer than the
+# buffer can be replayed afterwards with 'CountHistory.load_spill(spill_dir)'. The chunk files are numbered by the
+# first frame in them, counted over 'clear' and over earlier histories in the same 'spill_dir', so none is overwritten.
+
+
+class CountHistory:
+
+    def __init__(self, channels, capacity=36000, spill_dir=None, spill_chunk=3000, dtype=np.float64):
+        self.channels = np.asarray(channels)
+        self.capacity = int(capacity)
+        self.column = {int(ch): i for i, ch in enumerate(self.channels.tolist())}   # channel number --> column
+
+        self._times = np.zeros(2 * self.capacity, dtype=np.float64)
+        self._values = np.zeros((2 * self.capacity, len(self.channels)), dtype=dtype)
+        self._next = 0          # row the next frame is written to (0 <= _next < capacity)
+        self.n_total = 0        # frames appended since the start (also those that have been overwritten)
+
+        self.spill_dir = spill_dir
+        self.spill_chunk = int(spill_chunk)
+        self.n_spilled = 0      # frames saved to disk so far (since the last 'clear')
+        self._spill_offset = 0  # number of the first frame after 'clear', for the chunk file names
+        if spill_dir is not None:
+            if self.spill_chunk > self.capacity:
+                raise ValueError(f"spill_chunk ({spill_chunk}) can not be larger than the capacity ({capacity})")
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_offset = self.spilled_frames(spill_dir)
+
+    def __len__(self):
+        return min(self.n_total, self.capacity)
+
+    def append(self, values, t=None):
+        # values: one count per channel (in the order of 'channels'), t: time of the frame (default: now)
+        t = time.time() if t is None else t
+        i = self._next
+        self._times[i] = self._times[i + self.capacity] = t
+        self._values[i] = self._values[i + self.capacity] = values
+        self._next = i + 1 if i + 1 < self.capacity else 0
+        self.n_total += 1
+        if self.spill_dir is not None and self.n_total - self.n_spilled >= self.spill_chunk:
+            self.flush()
+
+    def append_frame(self, payload, field='counts'):
+        # payload: structured array with one row per channel (see 'decode_counts_array'),
+        # channels that are not in the payload get 0 and channels we don't know are left out
+        values = np.zeros(len(self.channels), dtype=self._values.dtype)
+        ranks = payload['rank'].tolist()
+        cols = [self.column.get(rank, -1) for rank in ranks]
+        known = [j for j, col in enumerate(cols) if col >= 0]
+        values[[cols[j] for j in known]] = payload[field][known]
+        t = float(payload['time'][0]) if len(payload) else None
+        self.append(values, t)
+
+    def last(self, n=None):
+        # (times, values) of the last 'n' frames (default: all in the buffer), oldest first, as views
+        n = len(self) if n is None else min(int(n), len(self))
+        stop = self._next + self.capacity
+        return self._times[stop - n:stop], self._values[stop - n:stop]
+
+    def since(self, t_start):
+        # (times, values) of the frames at or after 't_start', as views
+        times, values = self.last()
+        i = int(np.searchsorted(times, t_start, side='left'))
+        return times[i:], values[i:]
+
+    def window(self, n=None, seconds=None):
+        # the frames of the last 'seconds' seconds (counted from the newest frame), or else the last 'n' frames
+        if seconds is not None and len(self):
+            return self.since(self.latest_time() - seconds)
+        return self.last(n)
+
+    def latest(self):
+        # counts of the newest frame (None if empty)
+        return self.last(1)[1][0] if len(self) else None
+
+    def latest_time(self):
+        return self.last(1)[0][0] if len(self) else None
+
+    def mean(self, n=None, seconds=None):
+        # average per channel over the window (zeros if empty)
+        values = self.window(n, seconds)[1]
+        return values.mean(axis=0) if len(values) else np.zeros(len(self.channels))
+
+    def std(self, n=None, seconds=None):
+        values = self.window(n, seconds)[1]
+        return values.std(axis=0) if len(values) else np.zeros(len(self.channels))
+
+    def channel(self, ch, n=None, seconds=None):
+        # (times, counts) of one channel over the window
+        times, values = self.window(n, seconds)
+        return times, values[:, self.column[int(ch)]]
+
+    def clear(self):
+        self.flush()
+        self._spill_offset += self.n_spilled
+        self._next = 0
+        self.n_total = 0
+        self.n_spilled = 0
+
+    # ---- spill to disk ----
+
+    def flush(self):
+        # saves the frames that are not on disk yet (normally 'spill_chunk' of them) to a new chunk file
+        if self.spill_dir is None:
+            return
+        n_new = min(self.n_total - self.n_spilled, len(self))
+        if n_new <= 0:
+            return
+        times, values = self.last(n_new)
+        file = os.path.join(self.spill_dir, f"counts_{self._spill_offset + self.n_spilled:012d}.npz")
+        np.savez(file, times=times, values=values, channels=self.channels)
+        self.n_spilled = self.n_total
+
+    @staticmethod
+    def spilled_frames(spill_dir):
+        # number of frames in the chunks of 'spill_dir' (where the numbering of new chunks continues)
+        files = sorted(glob.glob(os.path.join(spill_dir, "counts_*.npz")))
+        if not files:
+            return 0
+        with np.load(files[-1]) as chunk:
+            return int(os.path.basename(files[-1])[len("counts_"):-len(".npz")]) + len(chunk['times'])
+
+    @staticmethod
+    def load_spill(spill_dir, t_start=None, t_stop=None):
+        # (times, values, channels) of all spilled chunks in 'spill_dir', optionally only from t_start to t_stop
+        times, values, channels = [], [], None
+        for file in sorted(glob.glob(os.path.join(spill_dir, "counts_*.npz"))):
+            with np.load(file) as chunk:
+                if t_start is not None and chunk['times'][-1] < t_start:
+                    continue
+                if t_stop is not None and chunk['times'][0] > t_stop:
+                    continue
+                times.append(chunk['times'])
+                values.append(chunk['values'])
+                channels = chunk['channels']
+        if not times:
+            return np.zeros(0), np.zeros((0, 0)), np.zeros(0)
+        times, values = np.concatenate(times), np.concatenate(values)
+        keep = np.ones(len(times), dtype=bool)
+        if t_start is not None:
+            keep &= times >= t_start
+        if t_stop is not None:
+            keep &= times <= t_stop
+        return times[keep], values[keep], channels
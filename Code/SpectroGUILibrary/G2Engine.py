@@ -0,0 +1,326 @@
+import time
+import numpy as np
+
+from Code.SpectroGUILibrary.HistogramEngines import TAG_TYPE, run_engines
+from Code.SpectroGUILibrary.ParallelAnalysis import parallel_run_engines
+from Code.SpectroGUILibrary.TimeresFile import write_synthetic_timeres
+from Code.SpectroGUILibrary.TimeresIndex import TimeresIndex
+
+# Cross-correlation (g2) of every pair of channels at once, instead of the three fixed pairs of the ETA recipe:
+#     delays, labels, g2 = g2_all_pairs(file, channels=range(2, 26), bins=10000, binsize=20)
+#     g2[k]           --> normalized g2 of pair labels[k] ('ch.2 - ch.3', ...) at 'delays' (ps, -bins .. bins-1 bins)
+# or as an engine next to the others (see 'HistogramEngines' / 'ParallelAnalysis'):
+#     engine = G2Matrix(channels=[2, 3, 4], bins=10000, binsize=20, method='merge')
+#     result = parallel_run_engines(file, [engine])[0]   --> {'g2': (pair x delay) coincidences, 'counts', 'duration',
+#                                                              'span': first and last tag time}
+#     engine.normalized(result)                           --> the same divided by the accidental coincidences
+#
+# Pair (i, j) with i before j in 'channels' counts the tags of j at a delay (bin of t_j) - (bin of t_i) from a tag of
+# i, so a photon on j after one on i is a positive delay. The timestamps are binned first (bin = time // binsize),
+# which is what makes the two methods give identical histograms:
+#     'merge'  all tags in time order, every tag is paired with the tags up to 'bins' bins before it (a few at a time
+#              for all tags at once). The work grows with the number of coincidences: for sparse data (photon counting
+#              with ps bins), where almost all time bins are empty.
+#     'fft'    the tags are put in dense (channel x time bin) blocks of 2 * bins bins, and every pair is correlated
+#              with one FFT per channel per block, summed over the blocks in the frequency domain. The work grows with
+#              the number of (non-empty) blocks: for dense data (high rates or wide bins).
+# 'choose_method' estimates which one is faster from the count rates.
+#
+# Normalization: for uncorrelated (Poisson) light the expected coincidences per bin are n_i * n_j * binsize / T,
+# so g2 = coincidences / (n_i * n_j * binsize / T) is 1 away from correlations (n: tags per channel, T: duration).
+
+MERGE_COST = 5e-8       # s per coincidence in the merge method (measured with 'benchmark_g2')
+FFT_COST = 2.5e-9       # s per FFT element (M log M per channel, M per pair) in the fft method
+
+
+class G2Matrix:
+
+    def __init__(self, channels, bins=10000, binsize=20, method='merge', auto=False, max_block_memory=2 ** 27):
+        if method not in ('merge', 'fft'):
+            raise ValueError(f"method must be 'merge' or 'fft', not '{method}' (see 'choose_method')")
+        self.channels = [int(ch) for ch in channels]
+        self.bins = int(bins)           # delays from -bins to bins - 1 bins
+        self.binsize = int(binsize)     # ps
+        self.method = method
+        self.auto = auto                # also the autocorrelation of every channel (pairs (i, i))
+        self.max_block_memory = max_block_memory   # bytes of dense blocks per FFT batch
+
+        n = len(self.channels)
+        first, second = np.triu_indices(n, k=0 if auto else 1)   # note: the pairs of one first channel are contiguous
+        self.pairs = list(zip(first.tolist(), second.tolist()))
+        self._first = first
+        self._pair_index = np.full((n, n), -1, dtype=np.int64)
+        self._pair_index[first, second] = np.arange(len(self.pairs))
+        order = np.argsort(self.channels)
+        self._sorted_channels = np.asarray(self.channels, dtype=np.int64)[order]
+        self._channel_index = order
+
+        self.histogram = np.zeros((len(self.pairs), 2 * self.bins), dtype=np.int64)
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.t_first = None
+        self.t_last = None
+
+        # tags (time bin, channel index) that can still pair with tags of a later chunk
+        self._t = np.zeros(0, dtype=np.int64)
+        self._c = np.zeros(0, dtype=np.int64)
+        # fft: which of them are recorded and not correlated yet, the summed spectra and the tags correlated per channel
+        self._x = np.zeros(0, dtype=bool)
+        self._fft_size = 4 * self.bins
+        self._spectrum = None
+        self._n_correlated = np.zeros(n, dtype=np.int64)
+
+    # ---- engine interface (see 'HistogramEngines') ----
+
+    def feed(self, records, record=True):
+        """
+        Adds a chunk of records (in time order, following the previous chunk).
+        With record=False the tags are only used as partners of recorded tags (context, see 'ParallelAnalysis').
+        """
+        if len(records) == 0:
+            return
+        tags = records[records['type'] == TAG_TYPE] if np.any(records['type'] != TAG_TYPE) else records
+        pos = np.searchsorted(self._sorted_channels, tags['channel'])
+        pos = np.minimum(pos, len(self._sorted_channels) - 1)
+        known = self._sorted_channels[pos] == tags['channel']
+        times = tags['time'][known].astype(np.int64)
+        t = times // self.binsize
+        c = self._channel_index[pos[known]]
+        t_end = int(records['time'][-1]) // self.binsize    # later tags are in this bin or after it
+
+        if record and len(t):
+            self.counts += np.bincount(c, minlength=len(self.channels))
+            self.t_first = int(times[0]) if self.t_first is None else self.t_first
+            self.t_last = int(times[-1])
+
+        if self.method == 'merge':
+            n_old = len(self._t)
+            self._t = np.concatenate((self._t, t))
+            self._c = np.concatenate((self._c, c))
+            if record and len(t):
+                self._merge_pairs(n_old)
+            keep = int(np.searchsorted(self._t, t_end - self.bins, side='left'))
+        else:
+            self._t = np.concatenate((self._t, t))
+            self._c = np.concatenate((self._c, c))
+            self._x = np.concatenate((self._x, np.full(len(t), bool(record))))
+            # tags whose whole window (up to bins - 1 bins later) has been seen
+            self._fft_pairs(int(np.searchsorted(self._t, t_end - self.bins, side='right')))
+            keep = int(np.searchsorted(self._t, t_end - 2 * self.bins, side='right'))
+            self._x = self._x[keep:]
+        self._t = self._t[keep:]
+        self._c = self._c[keep:]
+
+    def finish(self):
+        if self.method == 'fft':
+            self._fft_pairs(len(self._t))
+        return self.result()
+
+    def result(self):
+        histogram = self.histogram.copy()
+        if self._spectrum is not None:
+            correlation = np.fft.irfft(self._spectrum, self._fft_size, axis=-1)[:, :2 * self.bins]
+            histogram += np.rint(correlation).astype(np.int64)
+            # a tag is not its own coincidence: remove it from the zero delay of the autocorrelations
+            for i in range(len(self.channels)):
+                p = self._pair_index[i, i]
+                if p >= 0:
+                    histogram[p, self.bins] -= self._n_correlated[i]
+        span = np.zeros(0, dtype=np.int64) if self.t_first is None else np.array([self.t_first, self.t_last])
+        return {'g2': histogram, 'counts': self.counts.copy(), 'duration': self._duration(span), 'span': span}
+
+    @staticmethod
+    def _duration(span):
+        return np.array([span[1] - span[0] if len(span) else 0], dtype=np.int64)
+
+    @classmethod
+    def merge(cls, total, result):
+        # the result of two segments of a file (see 'ParallelAnalysis.merge_results'): the duration is from the first
+        # to the last tag of both, with the time between the segments, not the sum of the segments' durations
+        span = np.concatenate((total['span'], result['span'])).astype(np.int64)
+        span = np.array([span.min(), span.max()]) if len(span) else span
+        return {'g2': total['g2'] + result['g2'], 'counts': total['counts'] + result['counts'],
+                'duration': cls._duration(span), 'span': span}
+
+    @property
+    def context(self):
+        # merge: a tag pairs with earlier tags (lookback), fft: a recorded tag of a block pairs with tags on both sides
+        window = (self.bins + 1) * self.binsize     # note: delays are between bins, so up to one bin more
+        return (window, 0) if self.method == 'merge' else (window, window)
+
+    # ---- axes and normalization ----
+
+    def time_axis(self):
+        # delay of every histogram bin in ps, same as 'delta_t' of 'new_correlation_analysis' (there in ns)
+        return np.arange(-self.bins, self.bins) * self.binsize
+
+    def labels(self):
+        return [f'ch.{self.channels[i]} - ch.{self.channels[j]}' for i, j in self.pairs]
+
+    def normalized(self, result=None):
+        # (pair x delay) g2: coincidences divided by the accidental coincidences n_i * n_j * binsize / T
+        result = self.result() if result is None else result
+        counts = result['counts'].astype(float)
+        duration = float(result['duration'].sum())
+        first, second = np.array(self.pairs, dtype=int).reshape(-1, 2).T
+        expected = counts[first] * counts[second] * self.binsize / duration if duration > 0 else np.zeros(len(first))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(expected[:, None] > 0, result['g2'] / expected[:, None], 0.0)
+
+    # ---- merge ----
+
+    def _merge_pairs(self, first):
+        # pairs every tag from 'first' on with the tags up to 'bins' bins before it
+        t, c, W = self._t, self._c, self.bins
+        later = np.arange(first, len(t))
+        n_before = later - np.searchsorted(t, t[first:] - W, side='left')
+        flat = []
+        # k-th earlier tag of every tag at once, there are only a few within the window of each tag
+        for k in range(1, int(n_before.max(initial=0)) + 1):
+            b = later[n_before >= k]
+            a = b - k
+            delay = t[b] - t[a]
+            ca, cb = c[a], c[b]
+            p = self._pair_index[np.minimum(ca, cb), np.maximum(ca, cb)]
+            lag = np.where(ca <= cb, delay, -delay)     # the delay of the later channel of the pair
+            ok = (p >= 0) & (lag < W)
+            flat.append(p[ok] * 2 * W + lag[ok] + W)
+            same = (p >= 0) & (ca == cb)                 # an autocorrelation counts both ways
+            flat.append(p[same] * 2 * W - delay[same] + W)
+        if flat:
+            flat = np.concatenate(flat)
+            self.histogram += np.bincount(flat, minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    # ---- fft ----
+
+    def _fft_pairs(self, n_final):
+        # correlates the recorded tags among the first 'n_final' with all tags around them
+        x = np.flatnonzero(self._x[:n_final])
+        if len(x) == 0:
+            return
+        self._x[x] = False
+        W, n, M = self.bins, len(self.channels), self._fft_size
+        S = 2 * W                                           # block length, a block sees W bins on both sides
+        if self._spectrum is None:
+            self._spectrum = np.zeros((len(self.pairs), M // 2 + 1), dtype=np.complex128)
+        self._n_correlated += np.bincount(self._c[x], minlength=n)
+
+        xt, xc = self._t[x], self._c[x]
+        x_block = xt // S
+        blocks = np.unique(x_block)
+        # the (at most 2) blocks whose window [block * S - W, block * S + S + W) contains each tag
+        q = (self._t + W) // S
+        y_blocks = (q - 1, q)
+
+        batch = max(1, int(self.max_block_memory // (n * M * 8 * 2)))
+        for start in range(0, len(blocks), batch):
+            these = blocks[start:start + batch]
+            X = np.zeros((len(these), n, S))
+            Y = np.zeros((len(these), n, S + 2 * W))
+            in_batch = (x_block >= these[0]) & (x_block <= these[-1])
+            pos = np.searchsorted(these, x_block[in_batch])
+            np.add.at(X, (pos, xc[in_batch], xt[in_batch] - these[pos] * S), 1)
+            for yb in y_blocks:
+                pos = np.minimum(np.searchsorted(these, yb), len(these) - 1)
+                hit = these[pos] == yb
+                np.add.at(Y, (pos[hit], self._c[hit], self._t[hit] - (yb[hit] * S - W)), 1)
+
+            FX = np.conj(np.fft.rfft(X, M, axis=-1))
+            FY = np.fft.rfft(Y, M, axis=-1)
+            for i in range(n):
+                rows = np.flatnonzero(self._first == i)
+                if len(rows) == 0:
+                    continue
+                second = [self.pairs[p][1] for p in rows]
+                self._spectrum[rows] += np.einsum('bf,bjf->jf', FX[:, i], FY[:, second])
+
+
+def estimate_times(rates, bins, binsize, duration=1.0):
+    """
+    Expected time (s) of the (merge, fft) methods for 'duration' s of channels with count 'rates' (1/s each).
+    merge: total rate^2 * window coincidences per second, fft: the FFTs of one block of 4 * bins per 2 * bins bins
+    that has a tag.
+    """
+    rates = np.asarray(rates, dtype=float)
+    n = len(rates)
+    total = rates.sum()
+    window = bins * binsize * 1e-12                          # s
+    merge = MERGE_COST * total ** 2 * window
+    block = 2 * window
+    active = -np.expm1(-total * block) / block               # blocks per second that have a tag
+    M = 4 * bins
+    fft = FFT_COST * active * (2 * n * M * np.log2(M) + n * n * M / 4)
+    return merge * duration, fft * duration
+
+
+def choose_method(rates, bins, binsize):
+    # 'merge' or 'fft', whichever is expected to be faster (see 'estimate_times')
+    merge, fft = estimate_times(rates, bins, binsize)
+    return 'merge' if merge <= fft else 'fft'
+
+
+def detector_channels(file, sync_ch=1):
+    # the channels with tags in a '.timeres' file, except the sync channel
+    return [ch for ch, n in TimeresIndex.get(file).channel_totals().items() if ch != sync_ch and n > 0]
+
+
+def g2_engine(file, channels=None, bins=10000, binsize=20, method='auto', auto=False):
+    """
+    G2Matrix of all channel pairs for a '.timeres' file, e.g. to run with other engines in one pass.
+    channels: default all but the sync channel, method: 'merge', 'fft' or 'auto' (from the count rates).
+    """
+    channels = detector_channels(file) if channels is None else list(channels)
+    if method == 'auto':
+        index = TimeresIndex.get(file)
+        totals = index.channel_totals()
+        duration = max(index.t_last - index.t_first, 1) * 1e-12
+        method = choose_method([totals.get(ch, 0) / duration for ch in channels], bins, binsize)
+    return G2Matrix(channels, bins=bins, binsize=binsize, method=method, auto=auto)
+
+
+def g2_all_pairs(file, channels=None, bins=10000, binsize=20, method='auto', auto=False, normalize=True,
+                 n_workers=None, progress=None):
+    """
+    g2 of all channel pairs of a '.timeres' file: (delays in ps, pair labels, (pair x delay) array).
+    channels: default all but the sync channel, method: 'merge', 'fft' or 'auto' (from the count rates).
+    """
+    engine = g2_engine(file, channels=channels, bins=bins, binsize=binsize, method=method, auto=auto)
+    result = parallel_run_engines(file, [engine], n_workers=n_workers, progress=progress)[0]
+    g2 = engine.normalized(result) if normalize else result['g2']
+    return engine.time_axis(), engine.labels(), g2
+
+
+def benchmark_g2(n_records=2 * 10 ** 5, n_channels=(4, 12, 24), settings=((1000, 20), (100, 2000), (1000, 10000)),
+                 max_time=60, file="bench_g2.timeres"):
+    # time of both methods on a synthetic file (all channels at the same rate, ~1e8 tags/s in total) for every
+    # (bins, binsize) in 'settings', and a check that they agree. A method expected to take more than 'max_time' s
+    # is skipped: the fft with fine bins (sparse), the merge with long windows (many coincidences).
+    import os
+    try:
+        for n in n_channels:
+            write_synthetic_timeres(file, n_records, channels=tuple(range(1, n + 2)))
+            channels = list(range(2, n + 2))
+            index = TimeresIndex.get(file)
+            duration = (index.t_last - index.t_first) * 1e-12
+            rates = [index.channel_totals()[ch] / duration for ch in channels]
+            for bins, binsize in settings:
+                expected = dict(zip(('merge', 'fft'), estimate_times(rates, bins, binsize, duration)))
+                results, line = {}, f"{n} channels, {bins} x {binsize} ps:"
+                for method in ('merge', 'fft'):
+                    if expected[method] > max_time:
+                        line += f" {method} skipped (~{expected[method]:.0f} s),"
+                        continue
+                    t_start = time.perf_counter()
+                    engine = G2Matrix(channels, bins=bins, binsize=binsize, method=method, auto=True)
+                    results[method] = run_engines(file, [engine])[0]['g2']
+                    line += f" {method} {time.perf_counter() - t_start:.2f} s (~{expected[method]:.2f}),"
+                if len(results) == 2:
+                    line += " identical," if np.array_equal(results['merge'], results['fft']) else " MISMATCH,"
+                print(line + f" 'auto' picks {choose_method(rates, bins, binsize)}")
+    finally:
+        for f in (file, TimeresIndex.index_file(file)):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+if __name__ == '__main__':
+    benchmark_g2()
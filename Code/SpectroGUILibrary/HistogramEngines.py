@@ -0,0 +1,359 @@
+import numpy as np
+
+from Code.SpectroGUILibrary.TimeresFile import TimeresFile, DEFAULT_CHUNK_SIZE
+
+# Pure NumPy versions of the ETA recipes in 'Code/ETARecipes/', working directly on the raw '.timeres' records.
+# Each engine is an accumulator that is fed chunks of records in time order and keeps whatever state is needed
+# across chunk boundaries, so a file of any size is processed in one streaming pass with bounded memory.
+
+TAG_TYPE = 0   # record type of a normal time tag (other types are overflow/error markers and are skipped)
+
+LIFETIME_CHANNELS = {'h2': 2, 'h3': 3, 'h4': 4}   # histogram name --> detector channel (same as the ETA recipe)
+COUNTRATE_CHANNELS = {'h1': None, 'h2': 2, 'h3': 3, 'h4': 4}   # note: 'h1' exists in the ETA recipe but is never filled
+COUNTRATE_START_CHS = (0, 1, 2, 3, 4, 5)   # channels read by the countrate recipe, the first of these starts the clock
+# histogram name --> (start channel, stop channel), same state machines as 'Correlation-swabian_spectrometer.eta'
+CORRELATION_PAIRS = {'h23': (3, 2), 'h32': (2, 3), 'h24': (4, 2), 'h42': (2, 4), 'h34': (4, 3), 'h43': (3, 4)}
+
+
+class LifetimeHistogram:
+    """
+    Start-stop histograms, same as 'Lifetime-swabian_spectrometer.eta':
+        every detector tag (+ det_delay) is paired with the preceding sync tag (+ sync_delay),
+        and the delay is binned into 'bins' bins of 'binsize' ps (delays outside of the histogram are dropped).
+    Usage:
+        engine = LifetimeHistogram(bins=125*5, binsize=20, det_delay=12500)
+        for chunk in TimeresFile(file).iter_chunks():
+            engine.feed(chunk)
+        result = engine.finish()    --> {'h2': array, 'h3': array, 'h4': array}
+    """
+
+    def __init__(self, bins=125*5, binsize=20, sync_ch=1, det_chs=None, sync_delay=0, det_delay=12500):
+        self.bins = int(bins)
+        self.binsize = int(binsize)
+        self.sync_ch = sync_ch
+        self.det_chs = dict(LIFETIME_CHANNELS if det_chs is None else det_chs)
+        self.sync_delay = int(sync_delay)
+        self.det_delay = int(det_delay)
+
+        self.histograms = {name: np.zeros(self.bins, dtype=np.int64) for name in self.det_chs}
+        self._last_sync = None    # (delayed) time of the latest sync seen so far
+        # (delayed) detector times that may still pair with a sync in a later chunk:
+        self._pending = {name: np.zeros(0, dtype=np.int64) for name in self.det_chs}
+
+    def feed(self, records, record=True):
+        """
+        Adds a chunk of records (in time order, following the previous chunk).
+        With record=False only the sync tags are used, which is used to give the engine context before or after
+        the part of the file it is responsible for (see 'ParallelAnalysis').
+        """
+        if len(records) == 0:
+            return
+        tags = records[records['type'] == TAG_TYPE] if np.any(records['type'] != TAG_TYPE) else records
+        times = tags['time']
+        channels = tags['channel']
+
+        syncs = times[channels == self.sync_ch] + self.sync_delay
+        if self._last_sync is not None:
+            syncs = np.concatenate(([self._last_sync], syncs))
+
+        # Any sync in a later chunk arrives (delayed) at or after this time, so detector tags before it are final
+        horizon = int(records['time'][-1]) + self.sync_delay
+
+        for name, ch in self.det_chs.items():
+            dets = self._pending[name]
+            if record:
+                dets = np.concatenate((dets, times[channels == ch] + self.det_delay))
+            if len(dets) == 0:
+                continue
+            n_final = int(np.searchsorted(dets, horizon, side='left'))
+            self._record(name, dets[:n_final], syncs)
+            self._pending[name] = dets[n_final:]
+
+        if len(syncs):
+            self._last_sync = int(syncs[-1])
+
+    def _record(self, name, dets, syncs):
+        if len(dets) == 0 or len(syncs) == 0:
+            return
+        idx = np.searchsorted(syncs, dets, side='right') - 1   # preceding sync (a sync at the same time counts)
+        valid = idx >= 0
+        delay_bins = (dets[valid] - syncs[idx[valid]]) // self.binsize
+        delay_bins = delay_bins[delay_bins < self.bins]         # note: delays are never negative
+        self.histograms[name] += np.bincount(delay_bins, minlength=self.bins)
+
+    def finish(self):
+        # no more syncs will come: pending detector tags pair with the last sync we have
+        syncs = np.zeros(0, dtype=np.int64) if self._last_sync is None else np.array([self._last_sync], dtype=np.int64)
+        for name in self.det_chs:
+            self._record(name, self._pending[name], syncs)
+            self._pending[name] = np.zeros(0, dtype=np.int64)
+        return self.result()
+
+    def result(self):
+        # copy of the current histograms (pending tags, at most 'det_delay' ps worth, are not included yet)
+        return {name: hist.copy() for name, hist in self.histograms.items()}
+
+    def time_axis(self):
+        # left bin edges in ps, same as ETA.lifetime_bins_ns
+        return np.arange(self.bins) * self.binsize
+
+    @property
+    def context(self):
+        # (lookback, lookahead) in ps of records needed around a time segment to analyze it on its own:
+        # detector tags near the end of a segment pair with syncs up to 'det_delay' later
+        return max(0, self.sync_delay - self.det_delay), max(0, self.det_delay - self.sync_delay)
+
+
+class CountrateHistogram:
+    """
+    Countrate over time, same as 'Countrate-swabian_spectrometer.eta':
+        the first tag (on any of 'start_chs') starts the clock and is not counted itself,
+        every later detector tag is binned by its time since that start ('bins' bins of 'binsize' ps).
+    't_zero' can be given to use a known start time instead (e.g. when only feeding a later part of the file),
+    in which case no tag is skipped.
+    """
+
+    def __init__(self, bins, binsize, channels=None, start_chs=COUNTRATE_START_CHS, t_zero=None):
+        self.bins = int(bins)
+        self.binsize = int(binsize)
+        self.channels = dict(COUNTRATE_CHANNELS if channels is None else channels)
+        self.start_chs = np.asarray(start_chs, dtype=np.int32)
+        self.t_zero = None if t_zero is None else int(t_zero)
+
+        self.histograms = {name: np.zeros(self.bins, dtype=np.int64) for name in self.channels}
+
+    def feed(self, records, record=True):
+        if len(records) == 0:
+            return
+        tags = records[records['type'] == TAG_TYPE] if np.any(records['type'] != TAG_TYPE) else records
+
+        if self.t_zero is None:
+            first = np.flatnonzero(np.isin(tags['channel'], self.start_chs))
+            if len(first) == 0:
+                return
+            self.t_zero = int(tags['time'][first[0]])
+            tags = tags[first[0] + 1:]     # the starting tag only starts the clock
+
+        if not record:
+            return
+        times = tags['time']
+        channels = tags['channel']
+        for name, ch in self.channels.items():
+            if ch is None:
+                continue
+            delay_bins = (times[channels == ch] - self.t_zero) // self.binsize
+            delay_bins = delay_bins[delay_bins < self.bins]
+            self.histograms[name] += np.bincount(delay_bins, minlength=self.bins)
+
+    def finish(self):
+        return self.result()
+
+    def result(self):
+        return {name: hist.copy() for name, hist in self.histograms.items()}
+
+    def time_axis(self):
+        return np.arange(self.bins) * self.binsize
+
+    @property
+    def context(self):
+        return 0, 0    # note: segments other than the first need 't_zero' of the whole file instead
+
+
+class CorrelationHistogram:
+    """
+    Start-stop correlation histograms, same as 'Correlation-swabian_spectrometer.eta':
+        for each pair (start_ch, stop_ch) every stop tag is paired with the latest start tags before it,
+        i.e. 'CLOCK(c, 100, 1)' + 'record_all', and delays within 'bins' * 'binsize' ps are binned.
+    The starts of an ETA clock are kept in a ring buffer of 'clock_size' slots, which holds at most clock_size - 1
+    of them, and once it has wrapped around 'record_all' skips the start in slot 0 (unless the latest start is in
+    the last slot). This is done here as well (by the number of each start tag in the file), so that the
+    histograms are identical to the ETA ones.
+    The start tags that can still pair with a later stop are kept between chunks.
+    """
+
+    def __init__(self, bins=10000, binsize=20, pairs=None, clock_size=100):
+        self.bins = int(bins)
+        self.binsize = int(binsize)
+        self.window = self.bins * self.binsize
+        self.pairs = dict(CORRELATION_PAIRS if pairs is None else pairs)
+        self.clock_size = int(clock_size)
+
+        self.histograms = {name: np.zeros(self.bins, dtype=np.int64) for name in self.pairs}
+        self._starts = {start_ch: np.zeros(0, dtype=np.int64) for start_ch, _ in self.pairs.values()}
+        self._first = {start_ch: 0 for start_ch in self._starts}   # number (in the file) of the first kept start tag
+
+    @property
+    def counted_channels(self):
+        # channels of which the number of tags before a segment is needed, see 'seek'
+        return tuple(self._starts.keys())
+
+    def seek(self, tag_counts):
+        # tag_counts: {channel: number of tags in the file before the first record that will be fed}
+        for ch in self._first:
+            self._first[ch] = int(tag_counts.get(ch, 0))
+
+    def feed(self, records, record=True):
+        """
+        With record=False the chunk only provides start tags, which is used to give the engine the tags just
+        before the part of the file it is responsible for (see 'ParallelAnalysis').
+        """
+        if len(records) == 0:
+            return
+        tags = records[records['type'] == TAG_TYPE] if np.any(records['type'] != TAG_TYPE) else records
+        times = tags['time']
+        channels = tags['channel']
+
+        starts = {ch: np.concatenate((old, times[channels == ch])) for ch, old in self._starts.items()}
+
+        if record:
+            for name, (start_ch, stop_ch) in self.pairs.items():
+                self._record(name, starts[start_ch], self._first[start_ch], times[channels == stop_ch])
+
+        # later stops are at or after the last time in this chunk, so older starts are out of the window
+        t_last = int(records['time'][-1])
+        for ch, s in starts.items():
+            i_keep = max(int(np.searchsorted(s, t_last - self.window, side='right')), len(s) - self.clock_size)
+            self._starts[ch] = s[i_keep:]
+            self._first[ch] += i_keep
+
+    def _record(self, name, starts, first, stops):
+        if len(starts) == 0 or len(stops) == 0:
+            return
+        hi = np.searchsorted(starts, stops, side='right')                  # starts at or before each stop
+        lo = np.searchsorted(starts, stops - self.window, side='right')    # ... that are within the histogram
+        n_pairs = np.minimum(hi - lo, self.clock_size - 1)
+        # ETA skips slot 0 of the wrapped ring buffer, unless the latest start is in the last slot
+        skip_slot_0 = (first + hi - 1) % self.clock_size != self.clock_size - 2
+        # j-th latest start of every stop at once, there are only a few starts per stop within the window
+        for j in range(1, int(n_pairs.max(initial=0)) + 1):
+            has_j = n_pairs >= j
+            number = first + hi - j
+            has_j &= ~(skip_slot_0 & (number >= self.clock_size) & (number % self.clock_size == 0))
+            delay_bins = (stops[has_j] - starts[hi[has_j] - j]) // self.binsize
+            self.histograms[name] += np.bincount(delay_bins, minlength=self.bins)
+
+    def finish(self):
+        return self.result()
+
+    def result(self):
+        return {name: hist.copy() for name, hist in self.histograms.items()}
+
+    def time_axis(self):
+        return np.arange(self.bins) * self.binsize
+
+    @property
+    def context(self):
+        # stop tags at the start of a segment pair with start tags up to one histogram width earlier
+        return self.window, 0
+
+
+class SignalCounter:
+    # Number of tags per channel, same as 'signal_counter.eta'
+
+    def __init__(self):
+        self.counts = {}
+
+    def feed(self, records, record=True):
+        if not record or len(records) == 0:
+            return
+        tags = records[records['type'] == TAG_TYPE] if np.any(records['type'] != TAG_TYPE) else records
+        chs, n = np.unique(tags['channel'], return_counts=True)
+        for ch, c in zip(chs.tolist(), n.tolist()):
+            self.counts[ch] = self.counts.get(ch, 0) + c
+
+    def finish(self):
+        return self.result()
+
+    def result(self):
+        return dict(sorted(self.counts.items()))
+
+    @property
+    def context(self):
+        return 0, 0
+
+
+def run_engines(file, engines, chunk_size=DEFAULT_CHUNK_SIZE, t_start=None, t_stop=None, progress=None):
+    # Streams the file once and feeds every chunk to each engine ('progress' is called with the fraction done)
+    tf = TimeresFile(file)
+    i_start = 0 if t_start is None else tf.index_of_time(t_start)
+    i_stop = len(tf) if t_stop is None else tf.index_of_time(t_stop)
+    n_done = 0
+    for chunk in tf.iter_chunks(chunk_size, start=i_start, stop=i_stop):
+        for engine in engines:
+            engine.feed(chunk)
+        n_done += len(chunk)
+        if progress:
+            progress(n_done / (i_stop - i_start))
+    results = [engine.finish() for engine in engines]
+    tf.close()
+    return results
+
+
+def lifetime_histogram(file, bins=125*5, binsize=20, det_delay=12500, sync_delay=0, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+    # NumPy replacement for running 'Lifetime-swabian_spectrometer.eta' on a file
+    return run_engines(file, [LifetimeHistogram(bins=bins, binsize=binsize, det_delay=det_delay, sync_delay=sync_delay, **kwargs)],
+                       chunk_size=chunk_size)[0]
+
+
+def cross_check_eta(file, eta_result, names=None, engine=None, **kwargs):
+    """
+    Compares the histograms of a NumPy engine on 'file' against stored ETA results.
+        eta_result  --> dict of ETA histograms (e.g. the 'result' of eta_engine.run) or path to a '.npz' with them
+        engine      --> engine to compare (default: LifetimeHistogram(**kwargs)), with the same settings as the recipe
+    Returns {name: True/False}, and prints the largest difference of any histogram that does not match exactly.
+    """
+    if isinstance(eta_result, str):
+        with np.load(eta_result) as data:
+            eta_result = {key: data[key] for key in data.files}
+
+    numpy_result = run_engines(file, [engine])[0] if engine is not None else lifetime_histogram(file, **kwargs)
+    names = names or list(numpy_result.keys())
+
+    matches = {}
+    for name in names:
+        expected = np.asarray(eta_result[name])
+        matches[name] = bool(expected.shape == numpy_result[name].shape and np.array_equal(expected, numpy_result[name]))
+        if matches[name]:
+            print(f"{name}: OK ({np.sum(expected)} counts)")
+        else:
+            diff = np.max(np.abs(expected - numpy_result[name])) if expected.shape == numpy_result[name].shape else 'shape'
+            print(f"{name}: MISMATCH (max difference = {diff})")
+    return matches
+
+
+def run_eta_recipe(file, recipe, names, group='swabian', **kwargs):
+    # Runs an ETA recipe on 'file' with the parameters in kwargs and returns the histograms 'names' (needs etabackend)
+    import json
+    import etabackend.eta
+
+    with open(recipe, 'r') as filehandle:
+        recipe_obj = json.load(filehandle)
+    eta_engine = etabackend.eta.ETA()
+    eta_engine.load_recipe(recipe_obj)
+    for arg, value in kwargs.items():
+        eta_engine.recipe.set_parameter(arg, str(value))
+    eta_engine.load_recipe()
+
+    cutfile = eta_engine.clips(filename=file, format=1)
+    result = eta_engine.run({"timetagger1": cutfile}, group=group)
+    return {name: np.asarray(result[name]) for name in names}
+
+
+def cross_check_eta_recipe(file, recipe='Code/ETARecipes/Lifetime-swabian_spectrometer.eta', bins=125*5, binsize=20, det_delay=12500, save_as=None):
+    # Runs the ETA recipe on 'file' and compares it with the NumPy engine (needs etabackend).
+    # Optionally saves the ETA result to 'save_as' (.npz) so it can be checked later on machines without ETA.
+    eta_result = run_eta_recipe(file, recipe, LIFETIME_CHANNELS, bins=bins, binsize=binsize, det_delay=det_delay)
+    if save_as:
+        np.savez(save_as, **eta_result)
+    return cross_check_eta(file, eta_result, bins=bins, binsize=binsize, det_delay=det_delay)
+
+
+if __name__ == '__main__':
+    import sys
+    # python -m Code.SpectroGUILibrary.HistogramEngines <file.timeres> [<stored_eta_result.npz>]
+    if len(sys.argv) == 3:
+        cross_check_eta(sys.argv[1], sys.argv[2])
+    elif len(sys.argv) == 2:
+        cross_check_eta_recipe(sys.argv[1])
+    else:
+        print("Usage: python -m Code.SpectroGUILibrary.HistogramEngines <file.timeres> [<stored_eta_result.npz>]")
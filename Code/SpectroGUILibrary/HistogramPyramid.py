@@ -0,0 +1,121 @@
+import time
+import numpy as np
+
+# Histograms with every coarser binning precomputed, so a plot can show any time range at about one bin per pixel
+# without slicing (and drawing) the full resolution arrays or running the analysis again with another binsize:
+#     pyramid = HistogramPyramid({'h2': h2, 'h3': h3}, binsize=20)      --> levels of 20, 40, 80, 160, ... ps bins
+#     x, rows = pyramid.view(4000, 8500, pixels=axis_pixels(ax))        --> the level that fits the range and the axis
+#     pyramid.rebinned(80)                                              --> all histograms in 80 ps bins (summed)
+# Level k sums 2 bins of level k-1, so building all levels costs about one pass over the data (and about as much
+# memory again). 'view' returns the counts per base bin (the mean over the merged bins), so the y-axis of a plot
+# stays the same when the level changes with the zoom.
+
+
+def axis_pixels(ax):
+    # width of a matplotlib axis in screen pixels
+    return max(1, int(ax.get_window_extent().width))
+
+
+class HistogramPyramid:
+
+    def __init__(self, histograms, binsize, x0=0.0, min_bins=16):
+        # histograms: {name: counts} or one array, all with the same bins, x0: left edge of the first bin
+        if isinstance(histograms, dict):
+            self.names = list(histograms.keys())
+            base = np.vstack([np.asarray(histograms[name], dtype=float) for name in self.names]) if self.names else \
+                np.zeros((0, 0))
+        else:
+            base = np.atleast_2d(np.asarray(histograms, dtype=float))
+            self.names = list(range(len(base)))
+        self.binsize = binsize
+        self.x0 = x0
+        self.n_bins = base.shape[1]
+
+        self.levels = [base]
+        while self.levels[-1].shape[1] > min_bins:
+            finer = self.levels[-1]
+            if finer.shape[1] % 2:
+                # note: the last bin of the next level only covers one bin (its mean is scaled for that in 'view')
+                finer = np.concatenate((finer, np.zeros((len(finer), 1))), axis=1)
+            self.levels.append(finer[:, 0::2] + finer[:, 1::2])
+
+    def __len__(self):
+        return len(self.levels)
+
+    def level_binsize(self, level):
+        return self.binsize * 2 ** level
+
+    def time_axis(self, level=0):
+        # left bin edges of a level
+        return self.x0 + np.arange(self.levels[level].shape[1]) * self.level_binsize(level)
+
+    def level_for(self, x_min, x_max, pixels):
+        # the coarsest level that still has at least one bin per pixel over [x_min, x_max]
+        bins_per_pixel = (x_max - x_min) / (max(1, pixels) * self.binsize)
+        if not bins_per_pixel >= 2:
+            return 0
+        return int(min(np.floor(np.log2(bins_per_pixel)), len(self.levels) - 1))
+
+    def view(self, x_min=None, x_max=None, pixels=None, level=None, mean=True, centered=False):
+        """
+        (bin left edges, {name: values}) over [x_min, x_max] (default: everything), on 'level' or else the level
+        that fits 'pixels'. With mean=True the values are per base bin, else the summed counts of the level.
+        centered=True puts x in the middle of the base bins that each value covers, so that a line plot does not
+        shift sideways when the level changes.
+        """
+        x_min = self.x0 if x_min is None else x_min
+        x_max = self.x0 + self.n_bins * self.binsize if x_max is None else x_max
+        if level is None:
+            level = self.level_for(x_min, x_max, pixels) if pixels else 0
+        size = self.level_binsize(level)
+        values = self.levels[level]
+        i_min = int(np.clip(np.floor((x_min - self.x0) / size), 0, values.shape[1]))
+        i_max = int(np.clip(np.ceil((x_max - self.x0) / size) + 1, i_min, values.shape[1]))
+        x = self.x0 + np.arange(i_min, i_max) * size
+        if centered:
+            x = x + (size - self.binsize) / 2
+        rows = values[:, i_min:i_max]
+        if mean and level > 0:
+            # number of base bins in each bin (only the last one can be short)
+            widths = np.minimum(2 ** level, self.n_bins - np.arange(i_min, i_max) * 2 ** level)
+            rows = rows / np.maximum(widths, 1)
+        return x, dict(zip(self.names, rows))
+
+    def rebinned(self, binsize):
+        # {name: counts} in bins of 'binsize' (a multiple of the base binsize), from the nearest finer level
+        factor = int(round(binsize / self.binsize))
+        if factor < 1 or not np.isclose(factor * self.binsize, binsize):
+            raise ValueError(f"binsize {binsize} is not a multiple of {self.binsize}")
+        level = min(int(np.log2(factor)), len(self.levels) - 1)
+        while factor % 2 ** level:
+            level -= 1
+        values = self.levels[level]
+        step = factor // 2 ** level
+        n = -(-values.shape[1] // step) * step
+        padded = np.concatenate((values, np.zeros((len(values), n - values.shape[1]))), axis=1)
+        return dict(zip(self.names, padded.reshape(len(values), -1, step).sum(axis=2)))
+
+
+def benchmark_pyramid(n_bins=20000, n_rows=(3, 276), pixels=800, repeat=50):
+    # build time, and the time of one view at full range and zoomed in, compared with slicing the full arrays
+    rng = np.random.default_rng(0)
+    for n in n_rows:
+        histograms = {k: rng.poisson(100, n_bins).astype(float) for k in range(n)}
+        t_start = time.perf_counter()
+        pyramid = HistogramPyramid(histograms, binsize=20, x0=-n_bins * 10)
+        t_build = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        for _ in range(repeat):
+            x, rows = pyramid.view(pixels=pixels)
+        t_full = (time.perf_counter() - t_start) / repeat
+        t_start = time.perf_counter()
+        for _ in range(repeat):
+            x_zoom, rows = pyramid.view(-30000, 30000, pixels=pixels)
+        t_zoom = (time.perf_counter() - t_start) / repeat
+        print(f"{n} histograms of {n_bins} bins: build {t_build * 1e3:.1f} ms ({len(pyramid)} levels), "
+              f"view all {t_full * 1e3:.3f} ms ({len(x)} points instead of {n_bins}), "
+              f"view zoomed {t_zoom * 1e3:.3f} ms ({len(x_zoom)} points)")
+
+
+if __name__ == '__main__':
+    benchmark_pyramid()
@@ -0,0 +1,190 @@
+import time
+import asyncio
+import numpy as np
+
+from Code.SpectroGUILibrary.AsyncWebSQController import AsyncWebSQController
+
+# Re-tuning the bias current of all SNSPD channels from IV sweeps (with light on the detectors):
+#     tuner = IvTuner(AsyncWebSQController('http://130.237.35.62/'))
+#     result = tuner.run(6, 16, 0.1, 20, apply=True)     --> sweep 6..16 uA in 0.1 uA steps of 20 ms, then set the bias
+#     result['bias'], result['ic'], result['ok']          --> one per channel (in the order of result['rank'])
+# All channels of a group sweep at the same time (one startIv), so with the default single group every channel is
+# tuned in the time of one sweep. Groups are for channels that should not sweep together (e.g. crosstalk) and run one
+# after the other, because the Retina keeps one IV buffer: as soon as the IV data of a group is complete it is read
+# and the next group starts, while the previous one is fitted.
+#
+# The fit ('fit_bias_points') works on the (channel x step) arrays of all channels at once:
+#     switching current ic   the first step where the monitor voltage jumps above the linear (superconducting) IV,
+#                            or the counts collapse after the peak
+#     optimal bias           on the plateau (counts >= 'min_fraction' of the maximum, at least 'margin' uA below ic),
+#                            the step where the smoothed log(counts) changes least with the bias: the detection
+#                            efficiency has saturated and the dark counts have not taken off yet
+
+
+def iv_arrays(traces, channelLoc):
+    """
+    (ranks, bias in uA (steps), counts (channels x steps), monitorV (channels x steps)) from a getIvData result.
+    Steps that a channel has no data for are NaN.
+    """
+    ranks = list(channelLoc.keys())
+    locs = [tuple(channelLoc[rank]) for rank in ranks]
+    # note: the sweep is set in uA (startIv) but getIvData gives biasI in A; rounded to pA so the steps of all
+    # channels line up
+    bias_uA = dict((loc, np.round(np.asarray(traces[loc]['biasI'], dtype=float) * 1e6, 6)) for loc in locs
+                   if loc in traces)
+    bias = np.unique(np.concatenate(list(bias_uA.values()) or [np.zeros(0)]))
+    counts = np.full((len(ranks), len(bias)), np.nan)
+    monitorV = np.full((len(ranks), len(bias)), np.nan)
+    for i, loc in enumerate(locs):
+        if loc not in bias_uA or not len(bias_uA[loc]):
+            continue
+        steps = np.searchsorted(bias, bias_uA[loc])
+        counts[i, steps] = traces[loc]['counts']
+        monitorV[i, steps] = traces[loc]['monitorV']
+    return ranks, bias, counts, monitorV
+
+
+def _moving_average(values, n):
+    # along the last axis, ignoring NaN (a window with no data stays NaN)
+    if n <= 1:
+        return values
+    known = ~np.isnan(values)
+    kernel = np.ones(n)
+    sums = np.apply_along_axis(np.convolve, -1, np.where(known, values, 0.0), kernel, mode='same')
+    weights = np.apply_along_axis(np.convolve, -1, known.astype(float), kernel, mode='same')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(known, sums / weights, np.nan)
+
+
+def fit_bias_points(bias, counts, monitorV=None, margin=0.5, min_fraction=0.8, latch_voltage=0.05, smooth=9):
+    """
+    Optimal bias current and switching current of every channel from its IV sweep, all channels at once.
+    bias: (steps,) uA, counts / monitorV: (channels, steps), NaN where there is no data.
+    Returns {'bias': uA, 'ic': uA (NaN if it did not switch), 'counts': smoothed counts at the bias,
+             'slope': d log(counts) / d bias there (1/uA), 'ok': a plateau was found}, one value per channel.
+    """
+    bias = np.asarray(bias, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    n_channels, n_steps = counts.shape
+    step_index = np.arange(n_steps)
+    known = ~np.isnan(counts)
+
+    # switching: the monitor voltage leaves the line V = R I of the superconducting part (R from the lowest third)
+    latched = np.zeros(counts.shape, dtype=bool)
+    if monitorV is not None and n_steps:
+        monitorV = np.asarray(monitorV, dtype=float)
+        low = bias <= bias[0] + (bias[-1] - bias[0]) / 3
+        with np.errstate(invalid='ignore', divide='ignore'):
+            resistance = np.nanmedian(np.where(bias[low] != 0, monitorV[:, low] / bias[low], np.nan), axis=1)
+            latched |= (monitorV - resistance[:, None] * bias) > latch_voltage
+    # ... or the counts collapse after their maximum
+    filled = np.where(known, counts, -np.inf)
+    peak = np.argmax(filled, axis=1) if n_steps else np.zeros(n_channels, dtype=int)
+    peak_counts = filled[np.arange(n_channels), peak] if n_steps else np.zeros(n_channels)
+    latched |= known & (step_index > peak[:, None]) & (counts < 0.01 * peak_counts[:, None])
+
+    switched = latched.any(axis=1)
+    i_switch = np.where(switched, np.argmax(latched, axis=1), n_steps)
+    ic = np.where(switched, bias[np.minimum(i_switch, n_steps - 1)] if n_steps else np.nan, np.nan)
+
+    # plateau: far enough below the switching current, and close to the highest counts before it
+    step = np.median(np.diff(bias)) if n_steps > 1 else 1.0
+    margin_steps = int(np.ceil(margin / step)) if step > 0 else 0
+    usable = known & (step_index[None, :] < (i_switch - margin_steps)[:, None])
+    plateau_max = np.max(np.where(usable, counts, -np.inf), axis=1, initial=-np.inf)
+    candidate = usable & (counts >= min_fraction * plateau_max[:, None]) & (counts > 0)
+
+    log_counts = _moving_average(np.log(np.where(known, np.maximum(counts, 1.0), np.nan)), smooth)
+    slope = np.gradient(log_counts, bias, axis=1) if n_steps > 1 else np.zeros(counts.shape)
+    best = np.argmin(np.where(candidate & ~np.isnan(slope), np.abs(slope), np.inf), axis=1) if n_steps else \
+        np.zeros(n_channels, dtype=int)
+    ok = candidate.any(axis=1)
+
+    rows = np.arange(n_channels)
+    return {
+        'bias': np.where(ok, bias[best] if n_steps else np.nan, np.nan),
+        'ic': ic,
+        'counts': np.where(ok, np.exp(log_counts[rows, best]) if n_steps else np.nan, np.nan),
+        'slope': np.where(ok, slope[rows, best] if n_steps else np.nan, np.nan),
+        'ok': ok,
+    }
+
+
+class IvTuner:
+    """
+    Runs the IV sweeps of channel groups and fits the optimal bias of every channel:
+        tuner = IvTuner(asq, groups=[['1', '3', ...], ['2', '4', ...]])     --> default: all channels in one sweep
+        result = await tuner.tune(6, 16, 0.1, 20)                           --> in asyncio code, or
+        result = tuner.run(6, 16, 0.1, 20, apply=True)                      --> blocking
+    Fit options (margin, min_fraction, ...) are passed on to 'fit_bias_points'.
+    """
+
+    def __init__(self, asq, groups=None, poll=0.1, **fit_options):
+        self.asq = asq if isinstance(asq, AsyncWebSQController) else AsyncWebSQController(asq)
+        self.groups = groups
+        self.poll = poll
+        self.fit_options = fit_options
+        self.timings = {}       # group nr --> (sweep s, fit s), from the last 'tune'
+
+    async def tune(self, biasIStart, biasIStop, biasIStep, intTime, apply=False, progress=None):
+        """
+        Sweeps every group from biasIStart to biasIStop uA (intTime ms per step), and returns the fit of all channels
+        as in 'fit_bias_points', plus 'rank' and the IV arrays ('sweep_bias', 'sweep_counts', 'sweep_monitorV').
+        With 'apply' the bias of the channels with a plateau is set (in one request per driver).
+        progress(group nr, fraction of that sweep) is called while sweeping.
+        """
+        settings = await self.asq.call(self.asq.sq.getSettings)
+        channelLoc = self.asq.sq.getChannelLoc(settings=settings)
+        groups = self.groups or [list(channelLoc.keys())]
+        self.timings = {}
+
+        fits = []
+        for g, group in enumerate(groups):
+            group_loc = dict((str(rank), channelLoc[str(rank)]) for rank in group)
+            t_start = time.perf_counter()
+            traces = await self.asq.sweep_iv(
+                biasIStart, biasIStop, biasIStep, intTime, channelLoc=group_loc, selectedCus=list(group_loc),
+                poll=self.poll, progress=(lambda fraction, g=g: progress(g, fraction)) if progress else None)
+            t_sweep = time.perf_counter() - t_start
+            # note: the fit of this group runs in the thread pool while the next group sweeps
+            fits.append(asyncio.ensure_future(self.asq.call(self._fit_group, traces, group_loc, g, t_sweep)))
+        fits = await asyncio.gather(*fits)
+
+        result = self._merge(fits)
+        if apply:
+            values = dict((rank, bias * 1e-6) for rank, bias, ok in zip(result['rank'], result['bias'], result['ok'])
+                          if ok)
+            if values:
+                await self.asq.set_channel_values('biasI', values)
+        return result
+
+    def run(self, *args, **kwargs):
+        # 'tune' from blocking code
+        return asyncio.run(self.tune(*args, **kwargs))
+
+    def _fit_group(self, traces, group_loc, g, t_sweep):
+        t_start = time.perf_counter()
+        ranks, bias, counts, monitorV = iv_arrays(traces, group_loc)
+        fit = fit_bias_points(bias, counts, monitorV, **self.fit_options)
+        fit.update({'rank': ranks, 'sweep_bias': bias, 'sweep_counts': counts, 'sweep_monitorV': monitorV})
+        self.timings[g] = (t_sweep, time.perf_counter() - t_start)
+        return fit
+
+    @staticmethod
+    def _merge(fits):
+        if len(fits) == 1:
+            return fits[0]
+        result = {'rank': sum((fit['rank'] for fit in fits), [])}
+        for key in ('bias', 'ic', 'counts', 'slope', 'ok'):
+            result[key] = np.concatenate([fit[key] for fit in fits])
+        # the groups share the bias steps, unless a sweep was cut short
+        bias = np.unique(np.concatenate([fit['sweep_bias'] for fit in fits]))
+        for key in ('sweep_counts', 'sweep_monitorV'):
+            rows = []
+            for fit in fits:
+                block = np.full((len(fit['rank']), len(bias)), np.nan)
+                block[:, np.searchsorted(bias, fit['sweep_bias'])] = fit[key]
+                rows.append(block)
+            result[key] = np.concatenate(rows)
+        result['sweep_bias'] = bias
+        return result
@@ -0,0 +1,244 @@
+import time
+import numpy as np
+
+# Fluorescence lifetimes of all channel histograms at once, from the decay after the peak (tail fit, no IRF):
+#     fit = fit_lifetimes(histograms, binsize=20)                  --> histograms: (channels x bins) counts
+#     fit['tau'][:, 0], fit['tau_err'][:, 0]                       --> ps (same unit as binsize), one per channel
+#     fit = fit_lifetimes(histograms, binsize=20, model='bi')      --> fit['tau'][:, 0] < fit['tau'][:, 1]
+# Models, with t from the first fitted bin ('skip' bins after the peak, so the IRF is mostly left out):
+#     'mono'   B + A exp(-t / tau)
+#     'bi'     B + A1 exp(-t / tau1) + A2 exp(-t / tau2)
+# Methods:
+#     'mle'    maximum likelihood for Poisson counts (right for low counts, where least squares is biased)
+#     'lsq'    least squares weighted with 1 / counts (Neyman chi2)
+# Both are solved with the same Levenberg-Marquardt iteration for every channel at the same time: each step is a
+# batch of small (parameter x parameter) linear systems (for the MLE this is Fisher scoring, weights 1 / model).
+# Channels that have converged keep their parameters while the others go on. The uncertainties are from the inverse
+# of the Fisher (or J^T W J) matrix at the optimum.
+# Speed (benchmark_lifetime_fit, 24 channels x 625 bins): not much faster than a loop of scipy's curve_fit over the
+# channels. Mono takes 6-8 ms against 10-15 ms for the (mono, least squares) curve_fit loop, bi 10-12 ms, i.e. about
+# the same as that loop (10.2 against 9.9 ms on one machine). What it adds is the Poisson MLE, the bi-exponential
+# model with starting values that need no tuning, and the same fit (and the same failures: 'ok') for every channel.
+
+MODELS = {'mono': 1, 'bi': 2}   # number of exponentials
+
+
+def _evaluate(theta, t, n_exp):
+    # model (channels x bins) and its Jacobian (channels x bins x parameters), theta = A1, k1, [A2, k2], B (per bin)
+    mu = np.repeat(theta[:, -1:], t.shape[1], axis=1)
+    jac = np.empty(t.shape + (theta.shape[1],))
+    for e in range(n_exp):
+        amplitude, rate = theta[:, 2 * e, None], theta[:, 2 * e + 1, None]
+        decay = np.exp(-rate * t)
+        mu = mu + amplitude * decay
+        jac[:, :, 2 * e] = decay
+        jac[:, :, 2 * e + 1] = -amplitude * t * decay
+    jac[:, :, -1] = 1.0
+    return mu, jac
+
+
+def _objective(mu, y, mask, weights, method):
+    if method == 'mle':
+        # Poisson deviance, 0 for a perfect fit
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(y > 0, y * np.log(y / mu), 0.0) - (y - mu)
+        return 2 * np.sum(np.where(mask, terms, 0.0), axis=1)
+    return np.sum(np.where(mask, weights * (y - mu) ** 2, 0.0), axis=1)
+
+
+def _initial_guess(y, mask, t, n_exp):
+    # background from the end of the window, tau from the mean time of the counts above it
+    n_points = mask.sum(axis=1)
+    last = np.where(mask, np.arange(y.shape[1]), -1).max(axis=1)
+    tail = mask & (np.arange(y.shape[1]) > (last - np.maximum(5, n_points // 10))[:, None])
+    background = np.maximum(np.sum(np.where(tail, y, 0.0), axis=1) / np.maximum(tail.sum(axis=1), 1), 0.1)
+    above = np.where(mask, np.maximum(y - background[:, None], 0.0), 0.0)
+    tau = np.sum(above * t, axis=1) / np.maximum(above.sum(axis=1), 1e-12)
+    tau = np.clip(tau, 0.5, np.maximum(n_points, 2))
+    first = np.argmax(mask, axis=1)
+    amplitude = np.maximum(y[np.arange(len(y)), first] - background, 1.0)
+
+    theta = np.empty((len(y), 2 * n_exp + 1))
+    if n_exp == 1:
+        theta[:, 0], theta[:, 1] = amplitude, 1 / tau
+    else:
+        # note: a fast and a slow part around the single exponential, the fit sorts out the split
+        theta[:, 0], theta[:, 1] = amplitude / 2, 2 / tau
+        theta[:, 2], theta[:, 3] = amplitude / 2, 0.5 / tau
+    theta[:, -1] = background
+    return theta
+
+
+def fit_lifetimes(histograms, binsize=1.0, model='mono', method='mle', skip=2, start=None, stop=None,
+                  max_iter=200, tol=1e-9):
+    """
+    Tail fit of every row of 'histograms' (channels x bins, counts per bin of 'binsize').
+    The fit starts 'skip' bins after the peak of each row (or at bin 'start', one or one per row) and ends at bin
+    'stop' (default: the last bin).
+    Returns {'tau', 'tau_err', 'amplitude', 'amplitude_err': (channels x exponentials), tau in the unit of binsize and
+             sorted from short to long, amplitude in counts per bin at the first fitted bin,
+             'tau_mean': amplitude weighted mean of tau, 'tau_mean_err',
+             'background', 'background_err': counts per bin, 'start': first fitted bin,
+             'chi2_red': deviance (mle) or chi2 (lsq) per degree of freedom, 'n_iter', 'ok'}, arrays over channels.
+    """
+    if model not in MODELS:
+        raise ValueError(f"model must be one of {tuple(MODELS)}, not '{model}'")
+    if method not in ('mle', 'lsq'):
+        raise ValueError(f"method must be 'mle' or 'lsq', not '{method}'")
+    n_exp = MODELS[model]
+    y = np.atleast_2d(np.asarray(histograms, dtype=float))
+    n_channels, n_bins = y.shape
+    n_par = 2 * n_exp + 1
+
+    # the fitted window of each row, t in bins from its start
+    if start is None:
+        start = np.argmax(y, axis=1) + skip
+    start = np.broadcast_to(np.asarray(start, dtype=int), (n_channels,))
+    stop = n_bins if stop is None else min(stop, n_bins)
+    index = np.arange(n_bins)
+    mask = (index >= start[:, None]) & (index < stop)
+    t = np.where(mask, index - start[:, None], 0).astype(float)
+    n_points = mask.sum(axis=1)
+    weights = 1.0 / np.maximum(y, 1.0)      # for 'lsq' (fixed), 'mle' uses 1 / model
+
+    theta = _initial_guess(y, mask, t, n_exp)
+    mu, jac = _evaluate(theta, t, n_exp)
+    objective = _objective(mu, y, mask, weights, method)
+    damping = np.full(n_channels, 1e-3)
+    active = n_points > n_par
+    n_iter = np.zeros(n_channels, dtype=int)
+    lower = np.zeros(n_par)
+    lower[-1] = 1e-6        # note: the background keeps the model > 0 (log in the likelihood)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        rows = np.flatnonzero(active)
+        w = np.where(mask[rows], 1.0 / mu[rows] if method == 'mle' else weights[rows], 0.0)
+        jw = jac[rows] * w[:, :, None]
+        hessian = np.matmul(jw.transpose(0, 2, 1), jac[rows])
+        gradient = np.matmul(jw.transpose(0, 2, 1), (y[rows] - mu[rows])[:, :, None])[:, :, 0]
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+        damped = hessian + damping[rows, None, None] * (diagonal[:, :, None] * np.eye(n_par))
+        try:
+            step = np.linalg.solve(damped, gradient[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:     # e.g. a channel without counts
+            step = np.matmul(np.linalg.pinv(damped), gradient[:, :, None])[:, :, 0]
+        trial = np.maximum(theta[rows] + step, lower)
+        trial_mu, trial_jac = _evaluate(trial, t[rows], n_exp)
+        trial_objective = _objective(trial_mu, y[rows], mask[rows], weights[rows], method)
+
+        better = np.isfinite(trial_objective) & (trial_objective <= objective[rows])
+        improved = rows[better]
+        change = objective[improved] - trial_objective[better]
+        theta[improved], mu[improved], jac[improved] = trial[better], trial_mu[better], trial_jac[better]
+        objective[improved] = trial_objective[better]
+        damping[improved] = np.maximum(damping[improved] / 10, 1e-12)
+        damping[rows[~better]] *= 10
+        n_iter[rows] += 1
+
+        # converged: the objective (or the parameters) hardly change any more, or the damping has run away
+        small_step = np.all(np.abs(step) <= tol * (np.abs(theta[rows]) + tol), axis=1)
+        done = np.zeros(len(rows), dtype=bool)
+        done[better] = change <= tol * (np.abs(trial_objective[better]) + tol)
+        active[rows[done | small_step | (damping[rows] > 1e12)]] = False
+
+    # uncertainties from the undamped matrix at the optimum
+    w = np.where(mask, 1.0 / mu if method == 'mle' else weights, 0.0)
+    jw = jac * w[:, :, None]
+    hessian = np.matmul(jw.transpose(0, 2, 1), jac)
+    covariance = np.full((n_channels, n_par, n_par), np.nan)
+    invertible = np.linalg.cond(hessian) < 1e14
+    if invertible.any():
+        covariance[invertible] = np.linalg.inv(hessian[invertible])
+    errors = np.sqrt(np.abs(np.diagonal(covariance, axis1=1, axis2=2)))
+
+    amplitude, rate = theta[:, 0:-1:2], theta[:, 1:-1:2]
+    amplitude_err, rate_err = errors[:, 0:-1:2], errors[:, 1:-1:2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = 1 / rate
+        tau_err = rate_err / rate ** 2
+    order = np.argsort(tau, axis=1)
+    tau, tau_err = np.take_along_axis(tau, order, 1), np.take_along_axis(tau_err, order, 1)
+    amplitude, amplitude_err = np.take_along_axis(amplitude, order, 1), np.take_along_axis(amplitude_err, order, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the mean and its error only from the taus (the amplitudes are strongly correlated with them)
+        fractions = amplitude / amplitude.sum(axis=1, keepdims=True)
+        tau_mean = np.sum(fractions * tau, axis=1)
+        tau_mean_err = np.sqrt(np.sum((fractions * tau_err) ** 2, axis=1))
+        chi2_red = objective / (n_points - n_par)
+    ok = (n_points > n_par) & np.all(np.isfinite(tau_err), axis=1) & np.all(amplitude > 0, axis=1) & \
+        np.all(tau < 10 * n_points[:, None], axis=1)
+
+    return {
+        'tau': tau * binsize,
+        'tau_err': tau_err * binsize,
+        'amplitude': amplitude,
+        'amplitude_err': amplitude_err,
+        'tau_mean': tau_mean * binsize,
+        'tau_mean_err': tau_mean_err * binsize,
+        'background': theta[:, -1],
+        'background_err': errors[:, -1],
+        'start': start.copy(),
+        'chi2_red': chi2_red,
+        'n_iter': n_iter,
+        'ok': ok,
+    }
+
+
+def synthetic_decays(n_channels=24, bins=625, binsize=20, tau=None, peak=1000, amplitude=2000, background=10,
+                     fraction=None, tau2=None, seed=0):
+    # Poisson lifetime histograms (peak at 'peak' ps, then the decay on a flat background), and the true taus
+    rng = np.random.default_rng(seed)
+    x = np.arange(bins) * binsize
+    tau = rng.uniform(300, 3000, n_channels) if tau is None else np.broadcast_to(tau, (n_channels,))
+    rise = np.exp(-0.5 * ((x - peak) / 60) ** 2)
+    expected = np.empty((n_channels, bins))
+    for c in range(n_channels):
+        decay = np.exp(-np.maximum(x - peak, 0) / tau[c])
+        if tau2 is not None:
+            decay = (1 - fraction) * decay + fraction * np.exp(-np.maximum(x - peak, 0) / tau2)
+        expected[c] = background + amplitude * np.where(x < peak, rise, decay)
+    return rng.poisson(expected).astype(float), tau
+
+
+def benchmark_lifetime_fit(n_channels=24, bins=625, binsize=20, repeat=20):
+    # time of fitting all channels at once, against a loop of scipy's curve_fit (if installed)
+    histograms, tau = synthetic_decays(n_channels, bins, binsize)
+    # note: a bi-exponential fit of a single exponential has no unique answer, so 'bi' gets 2 decays (500 and 2500 ps)
+    histograms_bi, _ = synthetic_decays(n_channels, bins, binsize, tau=500, tau2=2500, fraction=0.3, amplitude=5000)
+    for model in MODELS:
+        for method in ('mle', 'lsq'):
+            data = histograms if model == 'mono' else histograms_bi
+            t_start = time.perf_counter()
+            for _ in range(repeat):
+                fit = fit_lifetimes(data, binsize, model=model, method=method)
+            t_fit = (time.perf_counter() - t_start) / repeat
+            line = f"{model:4s} {method}: {t_fit * 1e3:6.2f} ms for {n_channels} x {bins} bins, " \
+                   f"{int(fit['ok'].sum())} ok, max iterations {fit['n_iter'].max()}"
+            if model == 'mono':
+                pull = (fit['tau'][:, 0] - tau) / fit['tau_err'][:, 0]
+                line += f", tau - true: {np.mean(np.abs(fit['tau'][:, 0] - tau) / tau) * 100:.2f} % " \
+                        f"(mean / std of the pulls {pull.mean():+.2f} / {pull.std():.2f})"
+            else:
+                line += f", tau {np.mean(fit['tau'], axis=0).round()} +- {np.mean(fit['tau_err'], axis=0).round()}"
+            print(line)
+
+    try:
+        from scipy.optimize import curve_fit
+    except ImportError:
+        return
+    # note: averaged over 'repeat' like the fits above (a single first loop is slower, it pays scipy's warm-up)
+    t_start = time.perf_counter()
+    for _ in range(repeat):
+        for c in range(n_channels):
+            start = np.argmax(histograms[c]) + 2
+            t = np.arange(bins - start) * binsize
+            curve_fit(lambda t, a, tau, b: b + a * np.exp(-t / tau), t, histograms[c, start:],
+                      p0=(histograms[c, start], 1000, 10), sigma=np.sqrt(np.maximum(histograms[c, start:], 1)))
+    print(f"scipy curve_fit loop (mono lsq): {(time.perf_counter() - t_start) / repeat * 1e3:6.2f} ms")
+
+
+if __name__ == '__main__':
+    benchmark_lifetime_fit()
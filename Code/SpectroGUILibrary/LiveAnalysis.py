@@ -0,0 +1,189 @@
+import os
+import time
+import numpy as np
+
+from Code.SpectroGUILibrary.TimeresFile import TIMERES_DTYPE, RECORD_SIZE
+from Code.SpectroGUILibrary.HistogramEngines import LifetimeHistogram
+
+# Live lifetime histograms while a scan is running:
+#   - 'TimeresTail' reads the records that 'TimeTagger.Dump' has appended to the file since the last read
+#     (the temporary '<scan_name>temp.timeres' of 'TT.start_tt_neg', and the final file once it is renamed)
+#   - 'SyntheticTagStream' is a stand-in for the timetagger (no hardware needed) with the same interface
+#   - 'LiveLifetime' is polled from the Tk loop, feeds new records to a 'LifetimeHistogram' in fixed-size chunks,
+#     and updates 'ETA.folded_countrate_pulses' and the Lifetime tab at most 'max_fps' times per second
+
+LIVE_CHUNK_SIZE = 2 ** 18   # records per read (4 MB)
+
+
+class TimeresTail:
+    """
+    Reads a '.timeres' file while it is being written.
+        tail = TimeresTail(temp_timeres_file(file), renamed_to=file)
+        records = tail.read()   --> up to 'chunk_size' new complete records (empty if nothing new yet)
+    Negative (falling edge) channels in 'flip_channels' are made positive, same as 'flip_neg_channels' does
+    after the scan, so the records can go straight into the histogram engines.
+    'renamed_to' is where the file is moved once the scan is done ('TT.start_tt_neg' flips the channels of the temp
+    file and renames it), reading then goes on in that file from the same record. The file is only opened during
+    a read, so it can be renamed in between (also on Windows).
+    """
+
+    def __init__(self, file, chunk_size=LIVE_CHUNK_SIZE, flip_channels=(-1, -2, -3, -4), renamed_to=None):
+        self.file = str(file)
+        self.renamed_to = None if renamed_to is None else str(renamed_to)
+        self.chunk_size = chunk_size
+        self.flip_channels = np.asarray(flip_channels, dtype=np.int32)
+        self.offset = 0       # bytes read so far (always a whole number of records)
+        self._seen = False    # note: 'renamed_to' is only followed after 'file' existed, it may be an older scan
+
+    def _follow_rename(self):
+        if os.path.exists(self.file):
+            self._seen = True
+        elif self._seen and self.renamed_to and os.path.exists(self.renamed_to):
+            self.file, self.renamed_to = self.renamed_to, None
+
+    def available(self):
+        # number of complete records written but not read yet
+        self._follow_rename()
+        try:
+            return max(0, (os.path.getsize(self.file) - self.offset) // RECORD_SIZE)
+        except OSError:
+            return 0          # note: the file is only created once the dump has started
+
+    def read(self):
+        n_records = min(self.chunk_size, self.available())
+        if n_records == 0:
+            return np.zeros(0, dtype=TIMERES_DTYPE)
+        try:
+            with open(self.file, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(n_records * RECORD_SIZE)
+        except OSError:
+            return np.zeros(0, dtype=TIMERES_DTYPE)    # note: renamed just now, read from the new name next time
+        n_records = len(data) // RECORD_SIZE
+        records = np.frombuffer(data[:n_records * RECORD_SIZE], dtype=TIMERES_DTYPE).copy()
+        self.offset += n_records * RECORD_SIZE
+
+        if len(self.flip_channels):
+            mask = np.isin(records['channel'], self.flip_channels)
+            records['channel'][mask] = np.abs(records['channel'][mask])
+        return records
+
+    def close(self):
+        pass
+
+
+class SyntheticTagStream:
+    """
+    Stand-in for the timetagger with the same 'read()' as 'TimeresTail', producing tags in real time:
+    each detector tag comes with the sync tag it belongs to (like the conditional filter in 'TT.start_tt_neg'),
+    with an exponential decay of 'tau' ps after 'peak' ps in the (det_delay shifted) lifetime histogram.
+    """
+
+    def __init__(self, rate=10 ** 5, det_chs=(2, 3, 4), tau=(800, 1200, 2000), peak=5000, sync_period=10 ** 5,
+                 det_delay=12500, chunk_size=LIVE_CHUNK_SIZE, seed=None):
+        self.rate = rate                   # detector tags per second, per channel
+        self.det_chs = np.asarray(det_chs, dtype=np.int32)
+        self.tau = np.asarray(tau, dtype=float)
+        self.peak = peak
+        self.sync_period = sync_period     # ps (10 MHz laser)
+        self.det_delay = det_delay
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+
+        self.max_spread = 10 ** 6          # ps, a detector and its sync tag are never further apart than this
+        self.t_start = time.perf_counter()
+        self.t_generated = self.max_spread   # ps, tags have been generated up to this (stream) time
+        self._pending = np.zeros(0, dtype=TIMERES_DTYPE)
+
+    def read(self):
+        t_now = int((time.perf_counter() - self.t_start) * 1e12) + self.max_spread
+        n_events = self.rng.poisson(self.rate * len(self.det_chs) * (t_now - self.t_generated) * 1e-12)
+        n_events = min(n_events, self.chunk_size // 2)
+
+        which = self.rng.integers(0, len(self.det_chs), n_events)
+        syncs = self.rng.integers(self.t_generated, t_now, n_events, endpoint=True) // self.sync_period * self.sync_period
+        delays = self.peak + np.minimum(self.rng.exponential(self.tau[which]), self.max_spread // 2)
+        dets = syncs + delays.astype(np.int64) - self.det_delay
+        self.t_generated = t_now
+
+        new = np.zeros(2 * n_events, dtype=TIMERES_DTYPE)
+        new['channel'][:n_events] = 1
+        new['time'][:n_events] = syncs
+        new['channel'][n_events:] = self.det_chs[which]
+        new['time'][n_events:] = dets
+
+        # tags are only final once no later-generated tag can come before them
+        records = np.concatenate((self._pending, new))
+        records = records[np.argsort(records['time'], kind='stable')]
+        n_final = int(np.searchsorted(records['time'], self.t_generated - self.max_spread, side='left'))
+        self._pending = records[n_final:]
+        return records[:n_final]
+
+    def close(self):
+        pass
+
+
+class LiveLifetime:
+    """
+    Incremental lifetime analysis during a scan, polled from the Tk loop (with root.after):
+        live = LiveLifetime(gui.root, TimeresTail(file), eta_class, on_update=plotting_class.plots['lifetime']['reset'])
+        live.start()
+        ...
+        live.stop()     --> also includes the last detector tags that were still waiting for a sync
+    Every poll reads at most 'max_chunks' chunks, so the GUI stays responsive even if the file grows faster.
+    """
+
+    def __init__(self, root, source, eta_class, on_update=None, poll_ms=50, max_fps=5, max_chunks=8,
+                 bins=125*5, binsize=20, det_delay=12500):
+        self.root = root
+        self.source = source
+        self.eta_class = eta_class
+        self.on_update = on_update
+        self.poll_ms = poll_ms
+        self.min_frame_time = 1 / max_fps
+        self.max_chunks = max_chunks
+        self.bins = bins
+        self.binsize = binsize
+
+        self.engine = LifetimeHistogram(bins=bins, binsize=binsize, det_delay=det_delay)
+        self.running = False
+        self.n_records = 0
+        self._t_last_update = 0.0
+        self._new_data = False
+
+    def start(self):
+        self.running = True
+        self.root.after(self.poll_ms, self.poll)
+
+    def stop(self):
+        self.running = False
+        self.poll_source()    # whatever was written since the last poll
+        self.update(self.engine.finish())
+        self.source.close()
+
+    def poll_source(self):
+        for _ in range(self.max_chunks):
+            records = self.source.read()
+            if len(records) == 0:
+                break
+            self.engine.feed(records)
+            self.n_records += len(records)
+            self._new_data = True
+
+    def poll(self):
+        if not self.running:
+            return
+        try:
+            self.poll_source()
+            if self._new_data and time.perf_counter() - self._t_last_update >= self.min_frame_time:
+                self.update()
+        finally:
+            if self.running:
+                self.root.after(self.poll_ms, self.poll)
+
+    def update(self, result=None):
+        self.eta_class.set_lifetime_result(self.engine.result() if result is None else result, self.bins, self.binsize)
+        self._t_last_update = time.perf_counter()
+        self._new_data = False
+        if self.on_update:
+            self.on_update()
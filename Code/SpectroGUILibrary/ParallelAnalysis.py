@@ -0,0 +1,237 @@
+import os
+import copy
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from Code.SpectroGUILibrary.TimeresFile import TimeresFile, count_records, write_synthetic_timeres, DEFAULT_CHUNK_SIZE
+from Code.SpectroGUILibrary.HistogramEngines import (run_engines, TAG_TYPE, LifetimeHistogram, CountrateHistogram,
+                                                     CorrelationHistogram, SignalCounter)
+from Code.SpectroGUILibrary.AnalysisRunner import AnalysisCancelled
+
+# Runs the NumPy histogram engines (see 'HistogramEngines') on time segments of one '.timeres' file in parallel:
+#   1. the file is split into about equally long time segments, each starting on a sync tag
+#   2. every worker process feeds its engines the records of its own segment, plus the records just before and
+#      after it as context (e.g. the start tags of a correlation that began in the previous segment)
+#   3. the histograms of all segments are summed (engines with a 'merge' method combine their results themselves)
+# There are a few segments per worker, and only two per worker are submitted at a time, so the progress is updated
+# during the run and cancelling does not have to wait for segments that have not started. Running segments check a
+# shared stop event between chunks, so they stop as well instead of finishing in the background.
+# Every tag is recorded by exactly one segment, so the result is the same as one pass over the whole file.
+# Engines with 'counted_channels' (the correlation clocks of ETA) also need to know how many tags of those channels
+# come before their segment, these are counted first and passed on through 'seek'.
+
+MIN_SEGMENT_RECORDS = 2 ** 22   # files smaller than 2 segments of this size are analyzed in this process
+SEARCH_SIZE = 2 ** 16           # records read at a time when looking for the next sync tag
+SEGMENTS_PER_WORKER = 4         # number of segments = this x number of workers (if the file is large enough)
+POLL_S = 0.1                    # how often 'cancel' is checked while waiting for segments
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def _next_tag(tf, i, channels):
+    # index of the first time tag on any of 'channels' at or after record 'i' (or len(tf) if there is none)
+    while i < len(tf):
+        chunk = tf.records[i:i + SEARCH_SIZE]
+        hits = np.flatnonzero(np.isin(chunk['channel'], channels) & (chunk['type'] == TAG_TYPE))
+        if len(hits):
+            return i + int(hits[0])
+        i += SEARCH_SIZE
+    return len(tf)
+
+
+def sync_aligned_boundaries(file, n_segments, sync_ch=1):
+    # record indices [0, i_1, ..., n_records] of 'n_segments' (or fewer) segments of about equal duration,
+    # where every segment except the first starts on a sync tag
+    with TimeresFile(file) as tf:
+        if len(tf) == 0:
+            return [0, 0]
+        t_first = tf.first_time
+        duration = tf.duration
+        boundaries = [0]
+        for k in range(1, n_segments):
+            i = _next_tag(tf, tf.index_of_time(t_first + duration * k // n_segments), [sync_ch])
+            if boundaries[-1] < i < len(tf):
+                boundaries.append(i)
+        boundaries.append(len(tf))
+    return boundaries
+
+
+def first_tag_time(file, channels):
+    # time of the first tag on any of 'channels', or None
+    with TimeresFile(file) as tf:
+        i = _next_tag(tf, 0, channels)
+        return int(tf.records['time'][i]) if i < len(tf) else None
+
+
+def count_tags(file, channels, i_start, i_stop, chunk_size=DEFAULT_CHUNK_SIZE):
+    # {channel: number of time tags} in the records [i_start, i_stop)
+    counts = dict.fromkeys(channels, 0)
+    with TimeresFile(file) as tf:
+        for chunk in tf.iter_chunks(chunk_size, start=i_start, stop=i_stop):
+            tags = chunk['channel'][chunk['type'] == TAG_TYPE]
+            for ch in channels:
+                counts[ch] += int(np.count_nonzero(tags == ch))
+    return counts
+
+
+def counted_channels(engines):
+    return sorted({ch for engine in engines for ch in getattr(engine, 'counted_channels', ())})
+
+
+def analyze_segment(file, engines, i_start, i_stop, chunk_size=DEFAULT_CHUNK_SIZE, tag_counts=None, stop=None):
+    # Feeds 'engines' the records [i_start, i_stop) of the file (run in a worker, the engines are copies),
+    # tag_counts: {channel: number of tags before i_start} for the engines that need it (see 'counted_channels')
+    # stop: shared event, once it is set the segment stops after the current chunk and returns None
+    lookback = max(engine.context[0] for engine in engines)
+    lookahead = max(engine.context[1] for engine in engines)
+
+    with TimeresFile(file) as tf:
+        i_back = i_start
+        if i_start > 0 and lookback > 0:
+            i_back = tf.index_of_time(int(tf.records['time'][i_start]) - lookback)
+        if tag_counts:
+            # the first record fed is at i_back, the context tags before i_start are not counted yet
+            context = count_tags(file, list(tag_counts), i_back, i_start, chunk_size)
+            for engine in engines:
+                if hasattr(engine, 'seek'):
+                    engine.seek({ch: n - context[ch] for ch, n in tag_counts.items()})
+        if i_back < i_start:
+            for chunk in tf.iter_chunks(chunk_size, start=i_back, stop=i_start):
+                for engine in engines:
+                    engine.feed(chunk, record=False)
+
+        for chunk in tf.iter_chunks(chunk_size, start=i_start, stop=i_stop):
+            if stop is not None and stop.is_set():
+                return None
+            for engine in engines:
+                engine.feed(chunk)
+
+        if i_stop < len(tf) and lookahead > 0:
+            i_ahead = tf.index_of_time(int(tf.records['time'][i_stop - 1]) + lookahead, side='right')
+            for chunk in tf.iter_chunks(chunk_size, start=i_stop, stop=i_ahead):
+                for engine in engines:
+                    engine.feed(chunk, record=False)
+
+        results = [engine.finish() for engine in engines]
+    return results
+
+
+def merge_results(segment_results, engines=None):
+    # sums the results of all segments, engine by engine (histograms and counts alike), or combines them with the
+    # engine's 'merge(total, result)' for results that don't add up (e.g. the duration of 'G2Matrix')
+    merged = list(segment_results[0])
+    for results in segment_results[1:]:
+        for e, result in enumerate(results):
+            merge = getattr(engines[e], 'merge', None) if engines is not None else None
+            if merge is not None:
+                merged[e] = merge(merged[e], result)
+                continue
+            total = merged[e] = dict(merged[e])
+            for name, value in result.items():
+                total[name] = total[name] + value if name in total else value
+    return merged
+
+
+def parallel_run_engines(file, engines, n_workers=None, chunk_size=DEFAULT_CHUNK_SIZE, min_segment_records=MIN_SEGMENT_RECORDS, sync_ch=1, progress=None, cancel=None):
+    """
+    Same as 'run_engines', but splits the file into time segments that are analyzed in a process pool.
+    The engines passed in are only used as templates (they are copied to each worker and are not fed themselves).
+        n_workers           --> number of processes (default: number of cores)
+        min_segment_records --> files are not split into segments smaller than this, small files run in this process
+        progress            --> called with the fraction done (per finished segment), if it raises the remaining
+                                segments are cancelled and the exception is passed on
+        cancel              --> event (e.g. 'AnalysisJob.cancelled'), checked every POLL_S s while waiting: once it
+                                is set the running segments stop after their current chunk and AnalysisCancelled
+                                is raised
+    """
+    def check_progress(fraction):
+        if cancel is not None and cancel.is_set():
+            raise AnalysisCancelled(str(file))
+        if progress:
+            progress(fraction)
+
+    n_workers = n_workers or default_workers()
+    n_segments = min(n_workers * SEGMENTS_PER_WORKER, count_records(file) // min_segment_records)
+    if n_segments <= 1:
+        return run_engines(file, engines, chunk_size=chunk_size, progress=check_progress)
+
+    boundaries = sync_aligned_boundaries(file, n_segments, sync_ch=sync_ch)
+
+    # countrate histograms count from the first tag of the whole file, which only the first segment sees
+    later_engines = copy.deepcopy(engines)
+    for engine in later_engines:
+        if isinstance(engine, CountrateHistogram) and engine.t_zero is None:
+            engine.t_zero = first_tag_time(file, engine.start_chs)
+
+    segments = list(zip(boundaries[:-1], boundaries[1:]))
+    n_workers = min(n_workers, len(segments))
+    manager = multiprocessing.Manager()
+    stop = manager.Event()     # note: a Manager event, since it is passed to the worker processes with every segment
+    pool = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        # number of tags before each segment, for the engines that need it (summed over the segments before it)
+        tag_counts = [None] * len(segments)
+        channels = counted_channels(engines)
+        if channels:
+            counts = list(pool.map(count_tags, *zip(*[(file, channels, i_start, i_stop, chunk_size)
+                                                      for i_start, i_stop in segments[:-1]])))
+            total = dict.fromkeys(channels, 0)
+            for k in range(1, len(segments)):
+                total = {ch: total[ch] + counts[k - 1][ch] for ch in channels}
+                tag_counts[k] = total
+        check_progress(0.0)
+
+        segment_results = [None] * len(segments)
+        waiting = list(enumerate(segments))
+        running = {}
+        n_done = 0
+        while waiting or running:
+            while waiting and len(running) < 2 * n_workers:
+                k, (i_start, i_stop) = waiting.pop(0)
+                running[pool.submit(analyze_segment, file, engines if k == 0 else later_engines, i_start, i_stop,
+                                    chunk_size, tag_counts[k], stop)] = k
+            done, _ = wait(running, timeout=POLL_S, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = running.pop(future)
+                segment_results[k] = future.result()
+                n_done += boundaries[k + 1] - boundaries[k]
+            check_progress(n_done / boundaries[-1])
+    finally:
+        stop.set()      # note: only does something if we stopped early, the running segments return after one chunk
+        pool.shutdown(wait=True, cancel_futures=True)
+        manager.shutdown()
+
+    return merge_results(segment_results, engines)
+
+
+def benchmark_parallel(n_records=10 ** 8, workers=(1, 2, 4, 8, 16), file="bench_parallel.timeres", chunk_size=DEFAULT_CHUNK_SIZE):
+    # Compares a single pass with the process pool on a synthetic file, and checks that the histograms are identical
+    def make_engines():
+        return [LifetimeHistogram(), CountrateHistogram(bins=100, binsize=10 ** 10), CorrelationHistogram(), SignalCounter()]
+
+    try:
+        write_synthetic_timeres(file, n_records, channels=(1, 2, 3, 4))
+
+        t_start = time.perf_counter()
+        expected = run_engines(file, make_engines(), chunk_size=chunk_size)
+        t_serial = time.perf_counter() - t_start
+        print(f"single pass: {t_serial:.2f} s")
+
+        for n in workers:
+            t_start = time.perf_counter()
+            results = parallel_run_engines(file, make_engines(), n_workers=n, chunk_size=chunk_size,
+                                           min_segment_records=min(MIN_SEGMENT_RECORDS, n_records // n))
+            t_elapsed = time.perf_counter() - t_start
+            same = all(np.array_equal(result[name], expect[name]) for result, expect in zip(results, expected) for name in expect)
+            print(f"{n} workers: {t_elapsed:.2f} s  -->  {t_serial / t_elapsed:.1f}x, {'identical' if same else 'MISMATCH'}")
+    finally:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+if __name__ == '__main__':
+    benchmark_parallel()
@@ -0,0 +1,444 @@
+import time
+import numpy as np
+from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.collections import LineCollection   # note: only used for the 'fig.clear()' reference in the benchmark
+
+# Plots whose artists (lines, color images, colorbar, legend) are created once and then only updated with
+# set_data / set_clim, instead of 'fig.clear()' and re-plotting everything on every change.
+# The figure is drawn in layers, and a change only redraws the layers from the lowest one it changed (blitting):
+#   base:      figure, axes background, spines and title, only drawn by a full draw (new figure, resize)
+#   layers:    the y axis, then the x axis (and the colorbar), see 'layers'; each is saved together with the state it
+#              was drawn for (limits, scale), so e.g. a new x range only redraws the x axis
+#   animated:  the artists that change with the data (lines, images)
+#   overlay:   slow to draw but seldom changed artists on top of the animated ones (the legend), see 'overlay';
+#              drawn once into an image, which every redraw pastes on top of the animated artists
+# The tick labels and legend texts are most of the time of a full draw, so changing the data, the shown lines, or the
+# limits of one axis with 'redraw(full=False)' is much faster than a full draw. Only new artists outside of these
+# layers (e.g. a new colorbar) or a resize need 'redraw()' (a full draw).
+
+
+class ArtistPlot:
+
+    def __init__(self, fig, ax=None):
+        self.fig = fig
+        self.ax = ax if ax is not None else fig.add_subplot(111)
+        self._base = None
+        self._saved = []     # [(state, saved region)] of the layers drawn on the base
+        self._overlay = None  # (state, image, (x, y) of its lower left corner) of the overlay
+        self._cid = None
+        self._connected_canvas = None
+        self.ax.xaxis.set_animated(True)   # note: animated artists are left out of a full draw, see '_on_draw'
+        self.ax.yaxis.set_animated(True)
+
+    def animated_artists(self):
+        return []
+
+    def layers(self):
+        """
+        [(artists, state)] drawn on the base in this order (the ones changed most often last): a layer is redrawn
+        (with all layers above it) when its state differs from when it was saved.
+        """
+        return [([self.ax.yaxis], (tuple(self.ax.get_ylim()), self.ax.get_yscale())),
+                ([self.ax.xaxis], (tuple(self.ax.get_xlim()), self.ax.get_xscale()))]
+
+    def overlay(self):
+        """
+        (artists, state) drawn on top of the animated artists, or None. They're drawn into an image again only when
+        the state (or the figure size) changed, otherwise every redraw only pastes that image.
+        """
+        return None
+
+    def _connect(self):
+        # note: the canvas changes when the figure is packed into the GUI, so (re)connect lazily
+        canvas = self.fig.canvas
+        if canvas is not self._connected_canvas:
+            if self._cid is not None:
+                self._connected_canvas.mpl_disconnect(self._cid)
+            self._cid = canvas.mpl_connect('draw_event', self._on_draw)
+            self._connected_canvas = canvas
+            self.invalidate()
+
+    def invalidate(self):
+        # the next redraw is a full draw (e.g. after adding a colorbar, which moves the axes)
+        self._base = None
+        self._saved = []
+        self._overlay = None
+
+    def _render_overlay(self, artists):
+        # draws 'artists' on a transparent renderer of the figure's size, returns the part they cover and its corner
+        width, height = int(self.fig.bbox.width), int(self.fig.bbox.height)
+        renderer = RendererAgg(width, height, self.fig.dpi)
+        for artist in artists:
+            artist.draw(renderer)
+        # note: the part they cover is where they drew (alpha > 0), a legend's 'get_window_extent' would place it again
+        buffer = np.asarray(renderer.buffer_rgba())
+        drawn = buffer[:, :, 3] > 0
+        rows, cols = np.flatnonzero(drawn.any(axis=1)), np.flatnonzero(drawn.any(axis=0))
+        if len(rows) == 0:
+            return None, (0, 0)
+        # note: the buffer's first row is the top of the figure, 'draw_image' wants the bottom row first
+        image = buffer[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1][::-1].copy()
+        return image, (int(cols[0]), height - 1 - int(rows[-1]))
+
+    def _draw_animated(self, renderer, cached=True):
+        # draws the animated artists, then the overlay on top of them (from its image if 'cached')
+        for artist in self.animated_artists():
+            if artist.get_visible():
+                artist.draw(renderer)
+        overlay = self.overlay()
+        if overlay is None:
+            return
+        artists = [artist for artist in overlay[0] if artist.get_visible()]
+        if not cached:
+            for artist in artists:
+                artist.draw(renderer)
+            return
+        state = (overlay[1], tuple(self.fig.bbox.bounds), tuple(self.ax.bbox.bounds))
+        if self._overlay is None or self._overlay[0] != state:
+            self._overlay = (state,) + (self._render_overlay(artists) if artists else (None, (0, 0)))
+        _, image, (x, y) = self._overlay
+        if image is not None:
+            gc = renderer.new_gc()
+            renderer.draw_image(gc, x, y, image)
+            gc.restore()
+
+    def _draw_layers(self, renderer, start=0, save=True):
+        # draws the layers from 'start' on (saving each), then the animated artists and overlay on top of them
+        saved = self._saved[:start]
+        for artists, state in self.layers()[start:]:
+            for artist in artists:
+                if artist.get_visible():
+                    artist.draw(renderer)
+            if save:
+                saved.append((state, self.fig.canvas.copy_from_bbox(self.fig.bbox)))
+        if save:
+            self._saved = saved
+        self._draw_animated(renderer, cached=save)
+
+    def _on_draw(self, event):
+        # after every full draw: save the base, then draw the other layers on top of it
+        # (also when saving the figure, which draws on a different canvas and dpi, so without the overlay's image)
+        save = event.canvas is self._connected_canvas and hasattr(event.canvas, 'copy_from_bbox')
+        if save:
+            self._base = event.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_layers(event.renderer, save=save)
+
+    def changed_layer(self):
+        # index of the lowest layer that changed since it was saved, None if none did
+        for i, (_, state) in enumerate(self.layers()):
+            if i >= len(self._saved) or self._saved[i][0] != state:
+                return i
+        return None
+
+    def redraw(self, full=True):
+        # full=False only redraws the animated artists and the layers that changed (limits, scale), see 'layers'
+        self._connect()
+        canvas = self.fig.canvas
+        if full or self._base is None:
+            canvas.draw_idle()
+            return
+        start = self.changed_layer()
+        if start is None:
+            canvas.restore_region(self._saved[-1][1] if self._saved else self._base)
+            self._draw_animated(canvas.get_renderer())
+        else:
+            canvas.restore_region(self._saved[start - 1][1] if start else self._base)
+            self._draw_layers(canvas.get_renderer(), start)
+        canvas.blit(self.fig.bbox)
+
+    def draw_now(self):
+        # full synchronous draw (draw_idle only draws once the GUI is idle)
+        self._connect()
+        self.fig.canvas.draw()
+
+    def set_limits(self, xlim=None, ylim=None, yscale=None):
+        """
+        Returns True if anything changed.
+        Note: no 'xlim_changed' / 'ylim_changed' callbacks are called, these are for zooming with the toolbar,
+        the caller updates the data for the new limits itself.
+        """
+        changed = False
+        if yscale is not None and self.ax.get_yscale() != yscale:
+            self.ax.set_yscale(yscale)
+            changed = True
+        if xlim is not None and tuple(self.ax.get_xlim()) != tuple(xlim):
+            self.ax.set_xlim(xlim, emit=False)
+            changed = True
+        if ylim is not None and tuple(self.ax.get_ylim()) != tuple(ylim):
+            self.ax.set_ylim(ylim, emit=False)
+            changed = True
+        return changed
+
+    def autoscale(self, scalex=True, visible_only=False):
+        # fits the limits to the data (of the shown artists), returns True if they changed
+        limits = (tuple(self.ax.get_xlim()), tuple(self.ax.get_ylim()))
+        self.ax.relim(visible_only=visible_only)
+        self.ax.autoscale_view(scalex=scalex)
+        return limits != (tuple(self.ax.get_xlim()), tuple(self.ax.get_ylim()))
+
+
+class LinePlot(ArtistPlot):
+    """
+    One line per channel, created the first time the channel is shown:
+        plot = LinePlot(fig)
+        plot.set_line('h2', x, y, label='ch.2')     --> creates or updates (set_data) the line
+        plot.set_visible({'h2': True, 'h3': False})
+        plot.update_legend()
+        plot.set_limits(xlim=(0, 5000), yscale='log')
+        plot.redraw(full=False)                     --> blit, only redraws the lines and changed axes
+    The legend is the overlay: it's drawn again only when 'update_legend' rebuilds it (other shown lines or labels),
+    in between it stays where it was placed then (also with loc='best').
+    """
+
+    def __init__(self, fig, ax=None):
+        super().__init__(fig, ax)
+        self.lines = {}
+        self._legend_labels = None
+
+    def animated_artists(self):
+        return list(self.lines.values())
+
+    def overlay(self):
+        # note: a new legend object is a new state, see 'update_legend'
+        legend = self.ax.get_legend()
+        return ([legend], legend) if legend is not None else None
+
+    def set_line(self, name, x, y, label=None, **kwargs):
+        line = self.lines.get(name)
+        if line is None:
+            line, = self.ax.plot(x, y, label=label, animated=True, **kwargs)
+            self.lines[name] = line
+        else:
+            line.set_data(x, y)
+            if label is not None:
+                line.set_label(label)
+        return line
+
+    def set_ydata(self, name, y):
+        self.lines[name].set_ydata(y)
+
+    def set_visible(self, visible):
+        # {name: bool}, returns True if any line changed (then update the legend)
+        changed = False
+        for name, show in visible.items():
+            if name in self.lines and self.lines[name].get_visible() != bool(show):
+                self.lines[name].set_visible(bool(show))
+                changed = True
+        return changed
+
+    def update_legend(self, **kwargs):
+        # only rebuilt if the shown lines (or their labels) changed, returns True if it was
+        shown = [line for line in self.lines.values() if line.get_visible()]
+        labels = [line.get_label() for line in shown]
+        if labels != self._legend_labels:
+            if self.ax.get_legend() is not None:
+                self.ax.get_legend().remove()
+            if shown:
+                self.ax.legend(handles=shown, **kwargs).set_animated(True)   # note: left out of a full draw, see 'overlay'
+            self._legend_labels = labels
+            return True
+        return False
+
+
+class ColorRowPlot(ArtistPlot):
+    """
+    One horizontal band per channel (row), colored by the counts in each time bin ('Lifetime Color' tab).
+    Each band is a 1 x bins image, which draws much faster than a LineCollection with a segment per bin.
+    All rows share one norm, so 'set_clim' rescales every row and the colorbar at once.
+        plot = ColorRowPlot(fig)
+        plot.set_rows(x, {'h2': counts, ...}, labels={...}, height=0.9)
+        plot.set_clim(0, 1000)
+    """
+
+    def __init__(self, fig, ax=None, cmap='plasma'):
+        super().__init__(fig, ax)
+        self.cmap = cmap
+        self.norm = plt.Normalize(0, 1)
+        self.images = {}
+        self.colorbar = None
+        self._layout = None    # (names of the shown rows in order, x range, band height, row labels)
+
+    def animated_artists(self):
+        return list(self.images.values())
+
+    def layers(self):
+        # note: the rows are the y ticks, and the colorbar follows the color limits
+        y_axis, x_axis = super().layers()
+        rows = (self._layout[0], self._layout[3]) if self._layout else None
+        layers = [([self.ax.yaxis], (y_axis[1], rows)), x_axis]
+        if self.colorbar is not None:
+            layers.insert(1, ([self.colorbar.ax], (self.norm.vmin, self.norm.vmax)))
+        return layers
+
+    def set_rows(self, x, values, labels=None, height=0.9):
+        """
+        x: left bin edges, values: {name: counts (same length as x)} of the rows to show, from bottom to top.
+        height: thickness of each band, as a fraction of the distance between rows.
+        Returns True if the layout changed (rows shown, x range, height).
+        """
+        x = np.asarray(x)
+        rows = list(values.keys())
+        x_range = (float(x[0]), float(x[-1] + (x[1] - x[0] if len(x) > 1 else 1)))   # note: right edge of last bin
+        layout = (rows, x_range, height, [labels[name] if labels else name for name in rows])
+        layout_changed = layout != self._layout
+
+        for i, name in enumerate(rows):
+            extent = [x_range[0], x_range[1], i + 1 - height / 2, i + 1 + height / 2]
+            counts = np.asarray(values[name])[np.newaxis, :]
+            image = self.images.get(name)
+            if image is None:
+                image = self.ax.imshow(counts, extent=extent, aspect='auto', origin='lower', interpolation='nearest',
+                                       cmap=self.cmap, norm=self.norm, animated=True)
+                self.images[name] = image
+            else:
+                image.set_data(counts)
+                if layout_changed:
+                    image.set_extent(extent)
+            image.set_visible(True)
+        for name, image in self.images.items():
+            if name not in values:
+                image.set_visible(False)
+
+        if self.colorbar is None and rows:
+            self.colorbar = self.fig.colorbar(self.images[rows[0]], ax=self.ax)
+            self.colorbar.ax.set_animated(True)
+            self.invalidate()     # note: the colorbar takes space from the axes, so the next redraw is a full one
+
+        if layout_changed:
+            self.ax.set_yticks([i + 1 for i in range(len(rows))])
+            self.ax.set_yticklabels(layout[3])
+            self.ax.set_ylim([0.0, len(rows) + 1.0])
+            self._layout = layout
+        return layout_changed
+
+    def set_clim(self, vmin, vmax):
+        # returns True if the limits changed
+        if (self.norm.vmin, self.norm.vmax) == (vmin, vmax):
+            return False
+        self.norm.vmin = vmin
+        self.norm.vmax = vmax   # note: the images and colorbar follow the shared norm
+        return True
+
+
+def benchmark_redraw(n_channels=24, bins=625, n_updates=50, seed=0):
+    # Time per interactive update of lifetime-like data, comparing the old way (fig.clear() and plotting
+    # everything again) with persistent artists (full redraw, and blitting the data, shown lines and limits)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    # lifetime-like data: a peak at 5 ns with a decay (different for each channel) on a flat background, plus noise
+    rng = np.random.default_rng(seed)
+    x = np.arange(bins) * 20
+    tau = rng.uniform(500, 3000, n_channels)
+    expected = [10 + np.where(x >= 5000, 2000 * np.exp(-(x - 5000) / tau[c]), 0) for c in range(n_channels)]
+    data = [{f'h{c}': rng.poisson(expected[c]) for c in range(n_channels)} for _ in range(n_updates)]
+    y_max = 2200
+    results = {}
+
+    def timed(name, update):
+        t_start = time.perf_counter()
+        for frame in data:
+            update(frame)
+        results[name] = (time.perf_counter() - t_start) / n_updates * 1000
+        print(f"{name:32s}: {results[name]:6.1f} ms per update")
+
+    # -- lines (Lifetime tab) --
+    fig = Figure(figsize=(8, 5), dpi=100)
+    FigureCanvasAgg(fig)
+
+    def clear_and_plot(frame):
+        fig.clear()
+        ax = fig.add_subplot(111)
+        for name, y in frame.items():
+            ax.plot(x, y, label=name)
+        ax.legend()
+        fig.canvas.draw()
+    timed("lines, fig.clear()", clear_and_plot)
+
+    fig = Figure(figsize=(8, 5), dpi=100)
+    FigureCanvasAgg(fig)
+    line_plot = LinePlot(fig)
+    for name, y in data[0].items():
+        line_plot.set_line(name, x, y, label=name)
+    line_plot.update_legend()
+    line_plot.set_limits(xlim=(0, x[-1]), ylim=(0, y_max))
+    line_plot.draw_now()
+
+    def set_data_full(frame):
+        for name, y in frame.items():
+            line_plot.set_ydata(name, y)
+        line_plot.draw_now()
+    timed("lines, set_data + full draw", set_data_full)
+
+    def set_data_blit(frame):
+        for name, y in frame.items():
+            line_plot.set_ydata(name, y)
+        line_plot.redraw(full=False)
+    timed("lines, set_data + blit", set_data_blit)
+
+    def range_edit_blit(frame):
+        # e.g. a new 'x max' in the Lifetime tab: only the x axis is redrawn
+        line_plot.set_limits(xlim=(0, x[-1] - 1000 if line_plot.ax.get_xlim()[1] == x[-1] else x[-1]))
+        set_data_blit(frame)
+    timed("lines, range edit + blit", range_edit_blit)
+
+    def toggle_blit(frame):
+        # e.g. a channel checkbox: the legend is redrawn with the lines
+        line_plot.set_visible({'h0': not line_plot.lines['h0'].get_visible()})
+        line_plot.update_legend()
+        set_data_blit(frame)
+    timed("lines, toggle channel + blit", toggle_blit)
+
+    def scale_blit(frame):
+        line_plot.set_limits(ylim=(1, y_max), yscale='log' if line_plot.ax.get_yscale() == 'linear' else 'linear')
+        set_data_blit(frame)
+    timed("lines, scale change + blit", scale_blit)
+
+    # -- color lines (Lifetime Color tab) --
+    fig = Figure(figsize=(8, 5), dpi=100)
+    FigureCanvasAgg(fig)
+
+    def clear_and_collections(frame):
+        fig.clear()
+        ax = fig.add_subplot(111)
+        norm = plt.Normalize(0, y_max)
+        for i, y in enumerate(frame.values()):
+            points = np.array([x, np.ones(bins) * (i + 1)]).T.reshape(-1, 1, 2)
+            lc = LineCollection(np.concatenate([points[:-1], points[1:]], axis=1), cmap='plasma', norm=norm)
+            lc.set_array(y[:-1])
+            line = ax.add_collection(lc)
+        fig.colorbar(line, ax=ax)
+        ax.set_xlim([0, x[-1]])
+        ax.set_ylim([0, n_channels + 1])
+        fig.canvas.draw()
+    timed("color lines, fig.clear()", clear_and_collections)
+
+    fig = Figure(figsize=(8, 5), dpi=100)
+    FigureCanvasAgg(fig)
+    color_plot = ColorRowPlot(fig)
+    color_plot.set_rows(x, data[0])
+    color_plot.set_clim(0, y_max)
+    color_plot.set_limits(xlim=(0, x[-1]))
+    color_plot.draw_now()
+
+    def set_array_full(frame):
+        color_plot.set_rows(x, frame)
+        color_plot.draw_now()
+    timed("color rows, set_data + full draw", set_array_full)
+
+    def set_array_blit(frame):
+        color_plot.set_rows(x, frame)
+        color_plot.redraw(full=False)
+    timed("color rows, set_data + blit", set_array_blit)
+
+    def clim_blit(frame):
+        color_plot.set_clim(0, y_max / 2 if color_plot.norm.vmax == y_max else y_max)
+        set_array_blit(frame)
+    timed("color rows, clim change + blit", clim_blit)
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_redraw()
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import numpy as np
+try:
+    import h5py             # optional: HDF5 with chunked, compressed datasets
+except ImportError:
+    h5py = None             # note: without h5py the results are saved as a compressed '.npz' instead
+
+# Analysis results of a scan, saved next to its '.timeres' file so that opening the scan again does not need a
+# new analysis ('scan.timeres' --> 'scan.timeres.results.h5', or '.results.npz' without h5py):
+#     ScanResults(results, axes, channels, params).save(file)
+#     scan = ScanResults.load(file)          --> None if there are no results, or the '.timeres' changed since
+#     scan.results['lifetime']['h2'], scan.axes['lifetime'], scan.channels['h2']['lifetime'], scan.params['scantime']
+#     scan.matches_params({'scantime': 5, 'backend': 'numpy'})    --> False if it was analyzed with other parameters
+# results:   {analysis: {histogram name: array}}, e.g. the output of 'ETA.run_combined_analysis'
+#            (the 'signal' counts {channel: n} are stored as two arrays and come back as a dict)
+# axes:      {analysis: time axis in ps}
+# channels:  {channel: {field: number or short array}}, e.g. 'ETA.pix_dict' (text and colors are left out), for
+#            reading the results elsewhere: the GUI computes them again from the histograms and its current settings
+# params:    the scan parameters, e.g. the values of 'NewScanGroup.params' and 'ETA.analysis_params'
+# Like the sidecar index (see 'TimeresIndex'), the results are outdated when the size or modification time of the
+# '.timeres' file differs from when they were saved. Loading only reads the arrays, so it takes milliseconds.
+
+RESULTS_VERSION = 1
+H5_SUFFIX = '.results.h5'
+NPZ_SUFFIX = '.results.npz'
+
+
+def _channel_fields(values):
+    # the numeric fields of one channel (e.g. of pix_dict), as numbers or arrays
+    fields = {}
+    for key, value in values.items():
+        if isinstance(value, (bool, int, float, np.number, np.bool_)):
+            fields[key] = value
+        elif isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+            fields[key] = value
+    return fields
+
+
+class ScanResults:
+
+    def __init__(self, results, axes=None, channels=None, params=None, info=None):
+        self.results = results
+        self.axes = axes or {}
+        self.channels = channels or {}
+        self.params = params or {}
+        self.info = info or {}      # the '.timeres' file it belongs to (size, mtime_ns), when it was saved
+
+    @staticmethod
+    def results_file(file, h5=None):
+        # where the results of 'file' are (or would be) saved: HDF5 if h5py is installed, unless h5 says otherwise
+        h5 = h5py is not None if h5 is None else h5
+        return str(file) + (H5_SUFFIX if h5 else NPZ_SUFFIX)
+
+    @classmethod
+    def find(cls, file):
+        # the saved results of 'file' (either format, the newer one if both exist), or None
+        candidates = [f for f in (str(file) + H5_SUFFIX, str(file) + NPZ_SUFFIX) if os.path.exists(f)]
+        if h5py is None:
+            candidates = [f for f in candidates if f.endswith(NPZ_SUFFIX)]
+        return max(candidates, key=os.path.getmtime) if candidates else None
+
+    # ---- flat layout, shared by both formats: 'results/lifetime/h2', 'axes/lifetime', 'channels/h2/lifetime' ----
+
+    def _arrays(self):
+        arrays = {}
+        for analysis, histograms in self.results.items():
+            if analysis == 'signal':
+                arrays['results/signal/channels'] = np.array(list(histograms.keys()), dtype=np.int64)
+                arrays['results/signal/counts'] = np.array(list(histograms.values()), dtype=np.int64)
+                continue
+            for name, values in histograms.items():
+                arrays[f'results/{analysis}/{name}'] = np.asarray(values)
+        for analysis, axis in self.axes.items():
+            arrays[f'axes/{analysis}'] = np.asarray(axis)
+        for channel, values in self.channels.items():
+            for key, value in _channel_fields(values).items():
+                arrays[f'channels/{channel}/{key}'] = np.asarray(value)
+        return arrays
+
+    def _meta(self):
+        return json.dumps({'version': RESULTS_VERSION, 'params': self.params, 'info': self.info}, default=str)
+
+    @classmethod
+    def _from_arrays(cls, arrays, meta):
+        results, axes, channels = {}, {}, {}
+        for path, values in arrays.items():
+            parts = path.split('/')
+            if parts[0] == 'results':
+                results.setdefault(parts[1], {})[parts[2]] = values
+            elif parts[0] == 'axes':
+                axes[parts[1]] = values
+            elif parts[0] == 'channels':
+                channels.setdefault(parts[1], {})[parts[2]] = values.item() if values.ndim == 0 else values
+        if 'signal' in results:
+            signal = results['signal']
+            results['signal'] = dict(zip(signal['channels'].tolist(), signal['counts'].tolist()))
+        return cls(results, axes, channels, meta.get('params', {}), meta.get('info', {}))
+
+    # ---- saving and loading ----
+
+    def save(self, file, h5=None):
+        # next to the '.timeres' file 'file', returns the path of the results file
+        stat = os.stat(file)
+        self.info = {'file': os.path.basename(str(file)), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                     'saved': time.strftime('%Y-%m-%d %H:%M:%S')}
+        path = self.results_file(file, h5)
+        arrays = self._arrays()
+        if path.endswith(H5_SUFFIX):
+            if h5py is None:
+                raise ImportError("saving as HDF5 needs h5py, use h5=False for '.npz'")
+            with h5py.File(path + '.tmp', 'w') as f:
+                f.attrs['meta'] = self._meta()
+                for key, values in arrays.items():
+                    if values.ndim and values.size > 1:
+                        # note: chunked + compressed, histograms are mostly small counts (or zeros)
+                        f.create_dataset(key, data=values, chunks=True, compression='gzip', compression_opts=4,
+                                         shuffle=True)
+                    else:
+                        f.create_dataset(key, data=values)
+        else:
+            with open(path + '.tmp', 'wb') as f:   # note: passing a file handle stops numpy from adding '.npz'
+                np.savez_compressed(f, meta=np.array(self._meta()), **{key: v for key, v in arrays.items()})
+        os.replace(path + '.tmp', path)
+        return path
+
+    @classmethod
+    def load(cls, file, check=True):
+        # the saved results of 'file', or None if there are none or (with check) the '.timeres' file has changed
+        path = cls.find(file)
+        if path is None:
+            return None
+        try:
+            if path.endswith(H5_SUFFIX):
+                with h5py.File(path, 'r') as f:
+                    meta = json.loads(f.attrs['meta'])
+                    arrays = {}
+                    f.visititems(lambda key, item: arrays.__setitem__(key, item[()]) if isinstance(item, h5py.Dataset)
+                                 else None)
+            else:
+                with np.load(path) as data:
+                    meta = json.loads(str(data['meta']))
+                    arrays = {key: data[key] for key in data.files if key != 'meta'}
+        except (OSError, ValueError, KeyError):
+            return None      # note: unreadable (e.g. written by a crashed session): analyze again
+        if meta.get('version') != RESULTS_VERSION:
+            return None
+        scan = cls._from_arrays(arrays, meta)
+        if check and not scan.matches(file):
+            return None
+        return scan
+
+    def matches(self, file):
+        # True if the results belong to 'file' as it is now
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return False
+        return (self.info.get('size'), self.info.get('mtime_ns')) == (stat.st_size, stat.st_mtime_ns)
+
+    def matches_params(self, params):
+        # True if every parameter in 'params' has the saved value (compared as saved: tuples are lists, etc.)
+        params = json.loads(json.dumps(params, default=str))
+        return all(key in self.params and self.params[key] == value for key, value in params.items())
+
+
+def benchmark_scan_results(file="bench_results.timeres", n_records=10 ** 6, repeat=20):
+    # time to save and load the results of a combined analysis, against analyzing the file again
+    from Code.SpectroGUILibrary.TimeresFile import write_synthetic_timeres
+    from Code.SpectroGUILibrary.HistogramEngines import LifetimeHistogram, CountrateHistogram, \
+        CorrelationHistogram, SignalCounter, run_engines
+    write_synthetic_timeres(file, n_records)
+    try:
+        engines = {'lifetime': LifetimeHistogram(), 'countrate': CountrateHistogram(bins=100, binsize=10 ** 11),
+                   'correlation': CorrelationHistogram(), 'signal': SignalCounter()}
+        t_start = time.perf_counter()
+        results = dict(zip(engines, run_engines(file, list(engines.values()))))
+        t_analysis = time.perf_counter() - t_start
+        axes = {name: engine.time_axis() for name, engine in engines.items() if hasattr(engine, 'time_axis')}
+        channels = {'h2': {'wavelength': 729.1, 'counts': 1234, 'lifetime': 850.0, 'color': (0.1, 0.2, 0.3)}}
+        scan = ScanResults(results, axes, channels, params={'scantime': 5, 'slit': 10})
+        for h5 in ((False, True) if h5py is not None else (False,)):
+            t_start = time.perf_counter()
+            path = scan.save(file, h5=h5)
+            t_save = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            for _ in range(repeat):
+                loaded = ScanResults.load(file)
+            t_load = (time.perf_counter() - t_start) / repeat
+            same = all(np.array_equal(loaded.results[a][n], results[a][n]) for a in results if a != 'signal'
+                       for n in results[a]) and loaded.results['signal'] == results['signal']
+            print(f"{os.path.basename(path)}: {os.path.getsize(path) / 1e3:.0f} kB, save {t_save * 1e3:.1f} ms, "
+                  f"load {t_load * 1e3:.1f} ms ({'identical' if same else 'MISMATCH'}), "
+                  f"analysis of {n_records} records {t_analysis * 1e3:.0f} ms")
+            os.remove(path)
+    finally:
+        for f in (file, file + '.idx'):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+if __name__ == '__main__':
+    benchmark_scan_results()
@@ -0,0 +1,224 @@
+import os
+import time
+import numpy as np
+
+# Each record written by 'TimeTagger.Dump' is 16 bytes (little endian):
+#   [0]     type            (uint8)   --> 0 = time tag, other values are overflow/error markers
+#   [1]     reserved        (uint8)
+#   [2:4]   missed_events   (uint16)
+#   [4:8]   channel         (int32)   --> negative for falling edge channels, e.g. -2
+#   [8:16]  time            (int64)   --> timestamp in ps
+TIMERES_DTYPE = np.dtype([
+    ('type',          '<u1'),
+    ('reserved',      '<u1'),
+    ('missed_events', '<u2'),
+    ('channel',       '<i4'),
+    ('time',          '<i8'),
+])
+RECORD_SIZE = TIMERES_DTYPE.itemsize   # 16 bytes
+
+DEFAULT_CHUNK_SIZE = 2 ** 22   # records per chunk (64 MB)
+
+
+def count_records(file):
+    # number of complete 16-byte records, without reading the file
+    return os.path.getsize(file) // RECORD_SIZE
+
+
+def temp_timeres_file(file):
+    # where 'TT.start_tt_neg' dumps the scan of 'file' (still with negative channels), until it is fixed and renamed
+    file = str(file)
+    return (file[:-len('.timeres')] if file.endswith('.timeres') else file) + 'temp.timeres'
+
+
+def flip_neg_channels(old_file, new_file=None, bad_ch=(-1, -2, -3, -4), chunk_size=DEFAULT_CHUNK_SIZE, in_place=False):
+    """
+    Changes negative (falling edge) channel numbers into positive ones, e.g. -2 --> 2, which is needed for ETA analysis.
+    The file is memory-mapped and rewritten 'chunk_size' records at a time, so memory use does not depend on file size.
+        in_place=False  --> fixed records are written to 'new_file'
+        in_place=True   --> the channel field in 'old_file' is rewritten directly ('new_file' is ignored)
+    Returns the number of records that were changed.
+    """
+    if not in_place and old_file == new_file:
+        print("\n*ERROR*\nProvided file names are the same:\n"
+              f"   -->  {old_file}\n"
+              "Please give two separate file names (old and new), or use 'in_place=True'")
+        exit()
+
+    bad_ch = np.asarray(bad_ch, dtype=np.int32)
+    n_entries = count_records(old_file)
+    n_changed = 0
+
+    print('\nFixing Data ')
+    if n_entries == 0:
+        if not in_place:
+            open(new_file, "wb").close()
+        print(f"--> Done fixing data! (empty file)\n")
+        return 0
+
+    if in_place:
+        records = np.memmap(old_file, dtype=TIMERES_DTYPE, mode='r+', shape=(n_entries,))
+        for start in range(0, n_entries, chunk_size):
+            channel = records['channel'][start:start + chunk_size]   # view into the mapped file
+            mask = np.isin(channel, bad_ch)
+            n_changed += int(np.count_nonzero(mask))
+            channel[mask] = np.abs(channel[mask])
+        records.flush()
+        del records
+
+    else:
+        records = np.memmap(old_file, dtype=TIMERES_DTYPE, mode='r', shape=(n_entries,))
+        with open(new_file, "wb") as output_file:
+            for start in range(0, n_entries, chunk_size):
+                chunk = np.array(records[start:start + chunk_size])   # copy of chunk that we can modify
+                mask = np.isin(chunk['channel'], bad_ch)
+                n_changed += int(np.count_nonzero(mask))
+                chunk['channel'][mask] = np.abs(chunk['channel'][mask])
+                chunk.tofile(output_file)
+        del records
+
+    print(f"--> Done fixing data! ({n_changed}/{n_entries} records changed)\n")
+    return n_changed
+
+
+class TimeresFile:
+    """
+    Read-only, memory-mapped view of a '.timeres' file (records are only read from disk when they are accessed).
+        tf = TimeresFile(file)
+        tf.records                              --> structured array with fields 'type', 'missed_events', 'channel', 'time'
+        tf.time, tf.channel                     --> zero-copy field views
+        for chunk in tf.iter_chunks(10**6): ... --> consecutive views of 'n_records' records
+        tf.time_window(t_start, t_stop)         --> view of records with t_start <= time < t_stop (ps)
+        tf.channel_times(2)                     --> timestamps of all tags on channel 2
+    """
+
+    def __init__(self, file):
+        self.file = str(file)
+        self.n_records = count_records(self.file)
+        if self.n_records > 0:
+            self.records = np.memmap(self.file, dtype=TIMERES_DTYPE, mode='r', shape=(self.n_records,))
+        else:
+            self.records = np.zeros(0, dtype=TIMERES_DTYPE)   # note: np.memmap can't map an empty file
+
+    def __len__(self):
+        return self.n_records
+
+    def __getitem__(self, item):
+        return self.records[item]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # drops the reference to the map, the file is unmapped once no views into it remain
+        self.records = np.zeros(0, dtype=TIMERES_DTYPE)
+        self.n_records = 0
+
+    @property
+    def time(self):
+        return self.records['time']
+
+    @property
+    def channel(self):
+        return self.records['channel']
+
+    @property
+    def first_time(self):
+        return int(self.records['time'][0]) if self.n_records else None
+
+    @property
+    def last_time(self):
+        return int(self.records['time'][-1]) if self.n_records else None
+
+    @property
+    def duration(self):
+        # in ps
+        return (self.last_time - self.first_time) if self.n_records else 0
+
+    def iter_chunks(self, n_records=DEFAULT_CHUNK_SIZE, start=0, stop=None):
+        # yields views of (at most) 'n_records' records each, from record index 'start' up to 'stop'
+        stop = self.n_records if stop is None else min(stop, self.n_records)
+        for i in range(start, stop, n_records):
+            yield self.records[i:min(i + n_records, stop)]
+
+    def index_of_time(self, t, side='left'):
+        # binary search on the (time ordered) records, only touches ~log2(n) pages of the file
+        return int(np.searchsorted(self.records['time'], t, side=side))
+
+    def time_window(self, t_start=None, t_stop=None):
+        # view of all records with t_start <= time < t_stop (in ps)
+        i_start = 0 if t_start is None else self.index_of_time(t_start)
+        i_stop = self.n_records if t_stop is None else self.index_of_time(t_stop)
+        return self.records[i_start:i_stop]
+
+    def iter_channel(self, channel, n_records=DEFAULT_CHUNK_SIZE, t_start=None, t_stop=None):
+        # yields the timestamps of tags on 'channel', one array per chunk of the file
+        i_start = 0 if t_start is None else self.index_of_time(t_start)
+        i_stop = self.n_records if t_stop is None else self.index_of_time(t_stop)
+        for chunk in self.iter_chunks(n_records, start=i_start, stop=i_stop):
+            yield chunk['time'][chunk['channel'] == channel]
+
+    def channel_times(self, channel, n_records=DEFAULT_CHUNK_SIZE, t_start=None, t_stop=None):
+        # all timestamps (ps) of 'channel', note: this is a copy (size = number of tags on this channel)
+        parts = list(self.iter_channel(channel, n_records, t_start, t_stop))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def channel_counts(self, n_records=DEFAULT_CHUNK_SIZE):
+        # {channel: number of tags}, in one streaming pass
+        counts = {}
+        for chunk in self.iter_chunks(n_records):
+            chs, n = np.unique(chunk['channel'], return_counts=True)
+            for ch, c in zip(chs.tolist(), n.tolist()):
+                counts[ch] = counts.get(ch, 0) + c
+        return counts
+
+
+def write_synthetic_timeres(file, n_records, channels=(1, -2, -3, -4), chunk_size=DEFAULT_CHUNK_SIZE, seed=0):
+    # Writes a file of random (but time ordered) records, used for benchmarks and checks without a timetagger
+    rng = np.random.default_rng(seed)
+    channels = np.asarray(channels, dtype=np.int32)
+    t_last = 0
+    with open(file, "wb") as f:
+        for start in range(0, n_records, chunk_size):
+            n = min(chunk_size, n_records - start)
+            chunk = np.zeros(n, dtype=TIMERES_DTYPE)
+            chunk['channel'] = channels[rng.integers(0, len(channels), n)]
+            chunk['time'] = t_last + np.cumsum(rng.integers(1, 20000, n))
+            t_last = int(chunk['time'][-1])
+            chunk.tofile(f)
+
+
+def benchmark_flip_neg_channels(sizes_gb=(1, 2, 5, 10), folder="", chunk_size=DEFAULT_CHUNK_SIZE, in_place=False):
+    # Measures throughput of 'flip_neg_channels' on synthetic files. Note: needs 2x the largest size in free disk space
+    results = {}
+    for size_gb in sizes_gb:
+        n_records = int(size_gb * (1024 ** 3) / RECORD_SIZE)
+        old_file = os.path.join(folder, f"bench_flip_{size_gb}GB_temp.timeres")
+        new_file = os.path.join(folder, f"bench_flip_{size_gb}GB.timeres")
+        try:
+            write_synthetic_timeres(old_file, n_records, chunk_size=chunk_size)
+
+            t_start = time.perf_counter()
+            flip_neg_channels(old_file, new_file, bad_ch=[-1, -2, -3, -4], chunk_size=chunk_size, in_place=in_place)
+            t_elapsed = time.perf_counter() - t_start
+
+            results[size_gb] = {
+                'records':      n_records,
+                'seconds':      t_elapsed,
+                'MB/s':         n_records * RECORD_SIZE / (1024 ** 2) / t_elapsed,
+                'Mrecords/s':   n_records / 1e6 / t_elapsed,
+            }
+            print(f"{size_gb} GB: {t_elapsed:.2f} s  -->  {results[size_gb]['MB/s']:.0f} MB/s, "
+                  f"{results[size_gb]['Mrecords/s']:.1f} M records/s")
+        finally:
+            for f in [old_file, new_file]:
+                if os.path.exists(f):
+                    os.remove(f)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_flip_neg_channels()
@@ -0,0 +1,154 @@
+import os
+import numpy as np
+
+from Code.SpectroGUILibrary.TimeresFile import TimeresFile, DEFAULT_CHUNK_SIZE
+
+INDEX_SUFFIX = '.idx'        # e.g. 'scan.timeres' --> 'scan.timeres.idx'
+INDEX_VERSION = 1
+DEFAULT_STRIDE = 10 ** 9     # ps between stored record offsets (1 ms)
+
+
+class TimeresIndex:
+    """
+    Sidecar index of a '.timeres' file, built in one streaming pass and saved next to it as '<file>.idx'.
+    Holds per-channel counts and first/last timestamps, plus the record offset at every 'stride' ps,
+    so that channel totals are available instantly and analyses can seek straight to a time window.
+    The index is rebuilt automatically if the size or modification time of the '.timeres' file changed.
+        index = TimeresIndex.get(file)
+        index.channel_totals()          --> {1: 52013, 2: 1204, ...}
+        index.record_range(t0, t1)      --> (i_start, i_stop) covering all records with t0 <= time < t1
+    """
+
+    def __init__(self, file, file_size, file_mtime_ns, n_records, stride, t_first, t_last,
+                 channels, counts, first_times, last_times, offsets):
+        self.file = str(file)
+        self.file_size = int(file_size)
+        self.file_mtime_ns = int(file_mtime_ns)
+        self.n_records = int(n_records)
+        self.stride = int(stride)
+        self.t_first = int(t_first)
+        self.t_last = int(t_last)
+        self.channels = np.asarray(channels, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.first_times = np.asarray(first_times, dtype=np.int64)
+        self.last_times = np.asarray(last_times, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)   # offsets[k] = first record with time >= t_first + k*stride
+
+    @staticmethod
+    def index_file(file):
+        return str(file) + INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, file, stride=DEFAULT_STRIDE, chunk_size=DEFAULT_CHUNK_SIZE, save=True):
+        stat = os.stat(file)
+        tf = TimeresFile(file)
+
+        counts = {}
+        first_times = {}
+        last_times = {}
+        offsets = []
+        t_first = tf.first_time if len(tf) else 0
+        t_last = tf.last_time if len(tf) else 0
+
+        i_chunk = 0
+        for chunk in tf.iter_chunks(chunk_size):
+            times = chunk['time']
+            chs, first_idx, n = np.unique(chunk['channel'], return_index=True, return_counts=True)
+            # note: last occurrence of each channel = first occurrence in the reversed chunk
+            _, last_idx_rev = np.unique(chunk['channel'][::-1], return_index=True)
+            last_idx = len(chunk) - 1 - last_idx_rev
+            for ch, i_first, i_last, c in zip(chs.tolist(), first_idx, last_idx, n.tolist()):
+                counts[ch] = counts.get(ch, 0) + c
+                first_times.setdefault(ch, int(times[i_first]))
+                last_times[ch] = int(times[i_last])
+
+            # stride boundaries that fall inside this chunk
+            k_start = len(offsets)
+            k_stop = (int(times[-1]) - t_first) // stride + 1
+            if k_stop > k_start:
+                boundaries = t_first + np.arange(k_start, k_stop, dtype=np.int64) * stride
+                offsets.extend((i_chunk + np.searchsorted(times, boundaries, side='left')).tolist())
+            i_chunk += len(chunk)
+
+        channels = sorted(counts.keys())
+        index = cls(file, stat.st_size, stat.st_mtime_ns, len(tf), stride, t_first, t_last,
+                    channels=channels,
+                    counts=[counts[ch] for ch in channels],
+                    first_times=[first_times[ch] for ch in channels],
+                    last_times=[last_times[ch] for ch in channels],
+                    offsets=offsets)
+        tf.close()
+
+        if save:
+            index.save()
+        return index
+
+    def save(self):
+        try:
+            with open(self.index_file(self.file), 'wb') as f:   # note: passing a file handle stops numpy from adding '.npz'
+                np.savez(f, version=INDEX_VERSION, file_size=self.file_size, file_mtime_ns=self.file_mtime_ns,
+                         n_records=self.n_records, stride=self.stride, t_first=self.t_first, t_last=self.t_last,
+                         channels=self.channels, counts=self.counts, first_times=self.first_times,
+                         last_times=self.last_times, offsets=self.offsets)
+        except OSError as e:
+            print(f"WARNING: could not save index for '{self.file}' ({e})")   # e.g. read-only data folder
+
+    @classmethod
+    def load(cls, file):
+        # returns None if there is no index, or if it is outdated
+        idx_file = cls.index_file(file)
+        if not os.path.exists(idx_file) or not os.path.exists(file):
+            return None
+        try:
+            with np.load(idx_file) as data:
+                if int(data['version']) != INDEX_VERSION:
+                    return None
+                index = cls(file, *(data[key] for key in ['file_size', 'file_mtime_ns', 'n_records', 'stride', 't_first',
+                                                          't_last', 'channels', 'counts', 'first_times', 'last_times', 'offsets']))
+        except (OSError, KeyError, ValueError):
+            print(f"WARNING: could not read index file '{idx_file}', rebuilding")
+            return None
+        return index if index.is_valid() else None
+
+    @classmethod
+    def get(cls, file, stride=DEFAULT_STRIDE):
+        # load the sidecar index, or build (and save) it if missing or outdated
+        index = cls.load(file)
+        if index is None or index.stride != stride:
+            index = cls.build(file, stride=stride)
+        return index
+
+    def is_valid(self):
+        try:
+            stat = os.stat(self.file)
+        except OSError:
+            return False
+        return (stat.st_size == self.file_size) and (stat.st_mtime_ns == self.file_mtime_ns)
+
+    def channel_totals(self):
+        return dict(zip(self.channels.tolist(), self.counts.tolist()))
+
+    def channel_time_range(self, channel):
+        # (first, last) timestamp in ps of a channel, or None if it has no tags
+        where = np.nonzero(self.channels == channel)[0]
+        if len(where) == 0:
+            return None
+        return int(self.first_times[where[0]]), int(self.last_times[where[0]])
+
+    def record_range(self, t_start=None, t_stop=None):
+        # record indices (i_start, i_stop) that are guaranteed to contain all records with t_start <= time < t_stop
+        i_start = 0
+        i_stop = self.n_records
+        if t_start is not None:
+            k = (int(t_start) - self.t_first) // self.stride
+            if k >= len(self.offsets):
+                return self.n_records, self.n_records
+            if k >= 0:
+                i_start = int(self.offsets[k])
+        if t_stop is not None:
+            k = -(-(int(t_stop) - self.t_first) // self.stride)   # ceil
+            if k <= 0:
+                return 0, 0
+            if k < len(self.offsets):
+                i_stop = int(self.offsets[k])
+        return i_start, max(i_start, i_stop)
@@ -0,0 +1,233 @@
+import os
+import sys
+import time
+import zlib
+import struct
+import asyncio
+import argparse
+import threading
+
+import websockets
+
+from Code.SpectroGUILibrary.WebSQStream import WebSQStream
+
+# Recording of what the Retina sends over '/counts', and a websocket server that replays a recording, so the live
+# GUI (calibration, bunching) can be tested and benchmarked without the detector:
+#     python -m Code.SpectroGUILibrary.WebSQRecording record ws://130.237.35.62 run1.wsqrec --seconds 600
+#     python -m Code.SpectroGUILibrary.WebSQRecording replay run1.wsqrec --port 8765 --speed 10
+#     (then connect the GUI to ws://localhost:8765)
+#
+# File layout ('.wsqrec'):
+#     MAGIC
+#     chunk, chunk, ...       every chunk: <u4 compressed size> <u4 nr of frames> <zlib compressed frames>
+# and every frame (after decompressing): <f8 time received> <u4 nr of bytes> <the package as sent, 32 bytes per channel>
+# Chunks are written whole, so a recording that was cut off (crash, power) is readable up to its last full chunk.
+
+MAGIC = b"WSQREC1\n"
+CHUNK_HEADER = struct.Struct("<II")
+FRAME_HEADER = struct.Struct("<dI")
+
+
+class FrameRecorder:
+    """
+    Appends raw packages to a '.wsqrec' file, 'frames_per_chunk' at a time:
+        with FrameRecorder('run1.wsqrec') as recorder:
+            stream = WebSQStream(base_url, on_message=recorder.write).start()
+    'write' can be called from any thread.
+    """
+
+    def __init__(self, file, frames_per_chunk=100, level=6):
+        self.file = str(file)
+        self.frames_per_chunk = frames_per_chunk
+        self.level = level
+        self.n_frames = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._handle = open(self.file, 'wb')
+        self._handle.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, message, t=None):
+        t = time.time() if t is None else t
+        with self._lock:
+            self._pending.append(FRAME_HEADER.pack(t, len(message)) + bytes(message))
+            self.n_frames += 1
+            if len(self._pending) >= self.frames_per_chunk:
+                self._write_chunk()
+
+    def flush(self):
+        with self._lock:
+            self._write_chunk()
+            self._handle.flush()
+
+    def close(self):
+        if self._handle is not None:
+            self.flush()
+            self._handle.close()
+            self._handle = None
+
+    def _write_chunk(self):
+        if not self._pending:
+            return
+        data = zlib.compress(b"".join(self._pending), self.level)
+        self._handle.write(CHUNK_HEADER.pack(len(data), len(self._pending)) + data)
+        self._pending = []
+
+
+def read_recording(file):
+    # yields (time received, package) for every frame in the recording, stops at a cut-off last chunk
+    with open(file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file} is not a WebSQ recording")
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return
+            size, n_frames = CHUNK_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            data = zlib.decompress(data)
+            offset = 0
+            for _ in range(n_frames):
+                t, n_bytes = FRAME_HEADER.unpack_from(data, offset)
+                offset += FRAME_HEADER.size
+                yield t, data[offset:offset + n_bytes]
+                offset += n_bytes
+
+
+def count_frames(file):
+    # number of frames in the recording, from the chunk headers only (stops at a cut-off last chunk, like
+    # 'read_recording')
+    n = 0
+    file_size = os.path.getsize(file)
+    with open(file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file} is not a WebSQ recording")
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return n
+            size, n_frames = CHUNK_HEADER.unpack(header)
+            if f.seek(size, os.SEEK_CUR) > file_size:
+                return n
+            n += n_frames
+
+
+def record(base_url, file, seconds=None, frames_per_chunk=100):
+    # records the '/counts' stream of the Retina at 'base_url' until 'seconds' have passed (or Ctrl+C)
+    with FrameRecorder(file, frames_per_chunk=frames_per_chunk) as recorder:
+        stream = WebSQStream(base_url, on_message=recorder.write).start()
+        t_start = time.monotonic()
+        try:
+            while seconds is None or time.monotonic() - t_start < seconds:
+                time.sleep(0.5)
+                print(f"\r{recorder.n_frames} frames, connected: {stream.connected}", end='')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stream.stop()
+            print("")
+    return recorder.n_frames
+
+
+class ReplayServer:
+    """
+    Websocket server that sends every client the frames of a recording, with the same time between frames as when it
+    was recorded divided by 'speed' (speed=0: as fast as the client takes them). With 'repeat' the recording starts
+    over when it ends, else the connection is closed. Every client reads the file itself, one chunk at a time (and
+    opens it again to start over), so a long recording is never loaded as a whole.
+        server = ReplayServer('run1.wsqrec', port=8765, speed=10).start()     --> in a background thread
+        ...
+        server.stop()
+    """
+
+    def __init__(self, file, host='localhost', port=8765, speed=1.0, repeat=False):
+        self.file = str(file)
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.repeat = repeat
+        self.n_frames = count_frames(self.file)     # note: also checks that it is a recording before serving it
+        self.n_sent = 0
+        self._loop = None
+        self._thread = None
+        self._stopped = None
+        self._ready = threading.Event()
+
+    async def handler(self, websocket):
+        try:
+            await self.send_frames(websocket)
+        except websockets.ConnectionClosed:
+            pass    # the client disconnected
+
+    async def send_frames(self, websocket):
+        while True:
+            t_first = None
+            t_start = time.monotonic()
+            for t, message in read_recording(self.file):
+                t_first = t if t_first is None else t_first
+                delay = t_start + (t - t_first) / self.speed - time.monotonic() if self.speed else 0
+                await asyncio.sleep(max(delay, 0))   # note: also with speed=0, so closing the connection is handled
+                await websocket.send(message)
+                self.n_sent += 1
+            if not self.repeat or t_first is None:
+                return      # note: an empty recording is not repeated
+
+    async def serve(self):
+        self._stopped = asyncio.Event()
+        async with websockets.serve(self.handler, self.host, self.port):
+            self._ready.set()
+            await self._stopped.wait()
+
+    def start(self, timeout=5.0):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_until_complete, args=(self.serve(),), daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError(f"Replay server did not start on {self.host}:{self.port}")
+        return self
+
+    def stop(self, timeout=2.0):
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+            self._thread.join(timeout)
+
+    def url(self):
+        return f"ws://{self.host}:{self.port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record or replay the WebSQ '/counts' websocket stream")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rec = commands.add_parser('record', help="record the stream of a Retina")
+    rec.add_argument('base_url', help="e.g. ws://130.237.35.62")
+    rec.add_argument('file')
+    rec.add_argument('--seconds', type=float, default=None, help="stop after this long (default: Ctrl+C)")
+    rep = commands.add_parser('replay', help="serve a recording on a local websocket")
+    rep.add_argument('file')
+    rep.add_argument('--host', default='localhost')
+    rep.add_argument('--port', type=int, default=8765)
+    rep.add_argument('--speed', type=float, default=1.0, help="1: as recorded, 10: ten times faster, 0: no waiting")
+    rep.add_argument('--repeat', action='store_true', help="start over at the end of the recording")
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        n_frames = record(args.base_url, args.file, seconds=args.seconds)
+        print(f"Recorded {n_frames} frames to {args.file}")
+    else:
+        server = ReplayServer(args.file, host=args.host, port=args.port, speed=args.speed, repeat=args.repeat)
+        print(f"Replaying {server.n_frames} frames of {args.file} on {server.url()} (Ctrl+C to stop)")
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
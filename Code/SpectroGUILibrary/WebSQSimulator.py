@@ -0,0 +1,388 @@
+import sys
+import copy
+import json
+import time
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import websockets
+
+from Code.RetinaFiles.src.WebSQSocketController import PACKET_DTYPE
+from Code.RetinaFiles.src.WebSQController import merge
+
+# Local stand-in for the Single Quantum Retina (WebSQ), to test and load-test the GUI and WebSQController without
+# the hardware:
+#     python -m Code.SpectroGUILibrary.WebSQSimulator --channels 48 --inttime 10
+#     sq = WebSQController('http://localhost:8080/')      --> JSON-RPC on /api
+#     stream = WebSQStream('ws://localhost:8081')         --> binary count packages on /counts, every integration time
+# Note: the real box serves both on port 80, here the websocket has its own port.
+#
+# The JSON-RPC methods are the ones WebSQController calls: getSettings, setSettings (which is what setBiasI,
+# setTriggerV, setIntTime and startIv send), getIvData, stopIV and IVStatus. getCounts reads the channel 'data' of
+# getSettings, as on the real box.
+# Note: what the real IVStatus returns isn't documented, the 'running' / 'idle' here are made up for the simulator
+# and not part of the protocol. Code that waits for a sweep should look at the data (see 'iv_data'), not these.
+#
+# Each channel is a simple SNSPD model: a critical current 'ic', a detection efficiency that rises with the bias
+# current and saturates (plateau) below ic, dark counts that grow exponentially close to ic, and a latched (normal)
+# state above ic with no counts and a large monitor voltage. The photon rate per channel is a peak over the channels
+# (like a spectral line on the array) unless 'photon_rate' is given.
+
+SHUNT_RESISTANCE = 5e3   # ohm, monitorV = R * biasI while superconducting
+LATCHED_VOLTAGE = 0.2    # V, added to monitorV when latched
+
+
+class SimulatedRetina:
+
+    def __init__(self, n_channels=24, channels_per_mcu=12, int_time=100, photon_rate=None, dark_rate=50.0, seed=None):
+        self.n_channels = n_channels
+        self.channels_per_mcu = channels_per_mcu
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.RLock()
+        self.t_start = time.time()
+
+        ranks = np.arange(1, n_channels + 1)
+        self.ranks = ranks
+        self.mcu_ids = (ranks - 1) // channels_per_mcu + 1
+        self.cu_ids = (ranks - 1) % channels_per_mcu + 1
+        self.ic = self.rng.normal(12e-6, 0.8e-6, n_channels)             # A
+        self.dark_rate = dark_rate                                        # 1/s on the plateau
+        if photon_rate is None:
+            centre = (n_channels + 1) / 2
+            photon_rate = 2e5 * np.exp(-0.5 * ((ranks - centre) / (n_channels / 8)) ** 2) + 1e3
+        self.photon_rate = np.broadcast_to(np.asarray(photon_rate, dtype=float), (n_channels,)).copy()   # 1/s
+
+        self.bias = np.round(0.85 * self.ic, 7)                           # A
+        self.trigger = np.full(n_channels, 0.1)                           # V
+        self.int_time = int(int_time)                                     # ms, steps of 10 ms
+        self.iv = None              # running or last IV sweep (see 'start_iv')
+
+        self._frame_index = None    # the frame of the current integration time is made once and then shared
+        self._frame = None
+
+    # ---- detector model ----
+
+    def efficiency(self, bias):
+        x = bias / self.ic
+        return np.where(x < 1, 0.9 / (1 + np.exp(-(x - 0.75) / 0.04)), 0.0)
+
+    def expected_rate(self, bias):
+        # counts per second at 'bias' for every channel (0 when latched)
+        dark = self.dark_rate * np.exp(np.minimum((bias - 0.9 * self.ic) / (0.02 * self.ic), 50))
+        return np.where(bias < self.ic, self.efficiency(bias) * self.photon_rate + dark, 0.0)
+
+    def monitor_voltage(self, bias):
+        latched = bias >= self.ic
+        return SHUNT_RESISTANCE * bias + LATCHED_VOLTAGE * latched + self.rng.normal(0, 1e-4, len(bias))
+
+    # ---- frames (one per integration time) ----
+
+    def current_bias(self, now):
+        # bias of every channel, following the IV sweep while one is running
+        bias = self.bias.copy()
+        if self.iv is not None and self.iv['running']:
+            step = self.iv_step(now)
+            if step < len(self.iv['biasI']):
+                bias[self.iv['channels']] = self.iv['biasI'][step]
+            else:
+                self.finish_iv()
+        return bias
+
+    def frame(self, now=None):
+        # structured array (PACKET_DTYPE) with the counts of the integration time that ended last
+        now = time.time() if now is None else now
+        with self.lock:
+            index = int((now - self.t_start) * 1000 // self.int_time)
+            if index != self._frame_index:
+                bias = self.current_bias(now)
+                frame = np.zeros(self.n_channels, dtype=PACKET_DTYPE)
+                frame['mcuId'] = self.mcu_ids
+                frame['cuId'] = self.cu_ids
+                frame['cuStatus'] = 2 if self.iv is not None and self.iv['running'] else 0
+                frame['monitorV'] = self.monitor_voltage(bias)
+                frame['biasI'] = bias * 1e6 if self.iv is not None and self.iv['running'] else 0.0
+                frame['counts'] = self.rng.poisson(self.expected_rate(bias) * self.int_time / 1000)
+                frame['inttime'] = self.int_time // 10
+                frame['rank'] = self.ranks
+                frame['time'] = self.t_start + (index * self.int_time) / 1000
+                self._frame_index, self._frame = index, frame
+            return self._frame
+
+    def next_frame_time(self, now=None):
+        now = time.time() if now is None else now
+        index = int((now - self.t_start) * 1000 // self.int_time)
+        return self.t_start + (index + 1) * self.int_time / 1000
+
+    # ---- IV sweep ----
+
+    def start_iv(self, channels, start, stop, step, cycles):
+        # channels: indices, start/stop/step in A, cycles: nr of 10 ms cu cycles per step
+        n_steps = int(round((stop - start) / step)) + 1
+        self.iv = {
+            'channels': np.asarray(channels, dtype=int),
+            'biasI': start + step * np.arange(n_steps),
+            'step_time': cycles * 10 / 1000,     # s
+            't_start': time.time(),
+            'running': True,
+            'counts': np.full((n_steps, self.n_channels), np.nan),
+            'monitorV': np.full((n_steps, self.n_channels), np.nan),
+        }
+        # note: the whole sweep is measured now, 'getIvData' only shows the steps that are done
+        for k, bias_k in enumerate(self.iv['biasI']):
+            bias = self.bias.copy()
+            bias[self.iv['channels']] = bias_k
+            counts = self.rng.poisson(self.expected_rate(bias) * self.iv['step_time'])
+            self.iv['counts'][k, self.iv['channels']] = counts[self.iv['channels']]
+            self.iv['monitorV'][k, self.iv['channels']] = self.monitor_voltage(bias)[self.iv['channels']]
+
+    def iv_step(self, now=None):
+        now = time.time() if now is None else now
+        return int((now - self.iv['t_start']) / self.iv['step_time'])
+
+    def finish_iv(self):
+        if self.iv is not None:
+            self.iv['running'] = False
+
+    def iv_data(self):
+        n_steps = len(self.iv['biasI']) if self.iv else 0
+        done = min(self.iv_step(), n_steps) if self.iv and self.iv['running'] else n_steps
+        if self.iv and done >= n_steps:
+            self.finish_iv()
+
+        def column(values, ch):
+            return [None if k >= done or np.isnan(values[k, ch]) else float(values[k, ch]) for k in range(n_steps)]
+
+        result = {'counts': {'biasI': [float(b) for b in self.iv['biasI']] if self.iv else []}, 'monitorV': {}}
+        for ch, rank in enumerate(self.ranks.tolist()):
+            result['counts'][str(rank)] = column(self.iv['counts'], ch) if self.iv else []
+            result['monitorV'][str(rank)] = column(self.iv['monitorV'], ch) if self.iv else []
+        return result
+
+    # ---- settings ----
+
+    def settings(self):
+        now = time.time()
+        with self.lock:
+            frame = self.frame(now)
+            devices = {}
+            for ch, rank in enumerate(self.ranks.tolist()):
+                mcu, cu = str(self.mcu_ids[ch]), str(self.cu_ids[ch])
+                device = devices.setdefault(mcu, {'channels': {}, 'data': {'temp1': 2.5, 'temp2': 2.6}})
+                device['channels'][cu] = {
+                    'rank': rank,
+                    'configuration': {
+                        'rank': rank,
+                        'biasI': float(self.bias[ch]),
+                        'triggerV': float(self.trigger[ch]),
+                        'cuStatus': int(frame['cuStatus'][ch]),
+                    },
+                    'data': {
+                        'counts': int(frame['counts'][ch]),
+                        'time': float(frame['time'][ch] - self.t_start) * 1000,   # ms since the server started
+                        'monitorV': float(frame['monitorV'][ch]),
+                    },
+                    'iv': {},
+                }
+            return {
+                'backend': {'intTime': self.int_time, 'ivIntTime': self.iv['step_time'] * 1000 if self.iv else None,
+                            'ivTimeStamp': self.iv['t_start'] if self.iv else None},
+                'frontend': {'rankMap': {str(rank): [int(self.mcu_ids[ch]), int(self.cu_ids[ch])]
+                                         for ch, rank in enumerate(self.ranks.tolist())}},
+                'devices': devices,
+                'total_channels': self.n_channels,
+                'total_microcontrollers': int(self.mcu_ids.max()),
+            }
+
+    def set_settings(self, changes):
+        with self.lock:
+            backend = changes.get('backend', {})
+            if 'intTime' in backend:
+                self.int_time = max(10, int(round(backend['intTime'] / 10)) * 10)
+                self._frame_index = None
+
+            sweep, sweep_channels = None, []
+            for mcu, device in changes.get('devices', {}).items():
+                for cu, channel in device.get('channels', {}).items():
+                    config = channel.get('configuration', {})
+                    ch = self.channel_index(int(mcu), int(cu))
+                    if 'biasI' in config:
+                        self.bias[ch] = float(config['biasI'])
+                    if 'triggerV' in config:
+                        self.trigger[ch] = float(config['triggerV'])
+                    if config.get('cuStatus') == 2:
+                        sweep = (config['biasIStart'], config['biasIStop'], config['biasIStep'], config['biasSweepT'])
+                        sweep_channels.append(ch)
+            if sweep is not None:
+                self.start_iv(sweep_channels, *sweep)
+            return merge(self.settings(), copy.deepcopy(changes))
+
+    def channel_index(self, mcu_id, cu_id):
+        matches = np.flatnonzero((self.mcu_ids == mcu_id) & (self.cu_ids == cu_id))
+        if len(matches) != 1:
+            raise ValueError(f"No channel {mcu_id}.{cu_id}")
+        return int(matches[0])
+
+    # ---- JSON-RPC ----
+
+    def rpc(self, method, params):
+        with self.lock:
+            if method == 'getSettings':
+                return self.settings()
+            if method == 'setSettings':
+                return self.set_settings(params)
+            if method == 'getIvData':
+                return self.iv_data()
+            if method == 'stopIV':
+                self.finish_iv()
+                return 'Success'
+            if method == 'IVStatus':
+                # note: made-up status strings, not the protocol (see the top of this file)
+                return 'running' if self.iv is not None and self.iv['running'] and self.iv_step() < len(self.iv['biasI']) else 'idle'
+            if method == 'getBackend':
+                return self.settings()['backend']
+            raise KeyError(method)
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the real box
+    disable_nagle_algorithm = True  # note: headers and body are written separately, don't wait for the ACK in between
+    retina = None                   # set on the server class
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/api':
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self._send_json({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'Parse error',
+                                                                      'data': {'message': 'Parse error'}}})
+            return
+        if isinstance(request, list):   # batch
+            self._send_json([self._call(r) for r in request])
+        else:
+            self._send_json(self._call(request))
+
+    def _call(self, request):
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            response['result'] = self.server.retina.rpc(request.get('method'), request.get('params') or {})
+        except KeyError as e:
+            response['error'] = {'code': -32601, 'message': 'Method not found', 'data': {'message': f"Unknown method {e}"}}
+        except Exception as e:
+            response['error'] = {'code': -32000, 'message': 'Server error', 'data': {'message': str(e)}}
+        return response
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WebSQSimulator:
+    """
+    Runs the JSON-RPC server (http://host:api_port/api) and the counts websocket (ws://host:ws_port/counts)
+    of a 'SimulatedRetina' in background threads:
+        sim = WebSQSimulator(n_channels=48, int_time=10).start()
+        sq = WebSQController(sim.domain)
+        stream = WebSQStream(sim.ws_url).start()
+        ...
+        sim.stop()
+    """
+
+    def __init__(self, host='localhost', api_port=8080, ws_port=8081, **retina_kwargs):
+        self.host = host
+        self.api_port = api_port
+        self.ws_port = ws_port
+        self.retina = SimulatedRetina(**retina_kwargs)
+        self.n_sent = 0
+        self._http = None
+        self._loop = None
+        self._stopped = None
+        self._threads = []
+        self._ready = threading.Event()
+
+    @property
+    def domain(self):
+        return f"http://{self.host}:{self.api_port}/"
+
+    @property
+    def ws_url(self):
+        return f"ws://{self.host}:{self.ws_port}"
+
+    async def counts_handler(self, websocket):
+        try:
+            while True:
+                await asyncio.sleep(max(0.0, self.retina.next_frame_time() - time.time()))
+                await websocket.send(self.retina.frame().tobytes())
+                self.n_sent += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def serve_counts(self):
+        self._stopped = asyncio.Event()
+        async with websockets.serve(self.counts_handler, self.host, self.ws_port):
+            self._ready.set()
+            await self._stopped.wait()
+
+    def start(self, timeout=5.0):
+        self._http = ThreadingHTTPServer((self.host, self.api_port), _ApiHandler)
+        self._http.daemon_threads = True
+        self._http.retina = self.retina
+        self._loop = asyncio.new_event_loop()
+        self._threads = [threading.Thread(target=self._http.serve_forever, daemon=True),
+                         threading.Thread(target=self._loop.run_until_complete, args=(self.serve_counts(),), daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError(f"Counts websocket did not start on {self.ws_url}")
+        return self
+
+    def stop(self, timeout=2.0):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Single Quantum Retina (WebSQ)")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--api-port', type=int, default=8080, help="JSON-RPC on http://host:port/api")
+    parser.add_argument('--ws-port', type=int, default=8081, help="counts websocket on ws://host:port/counts")
+    parser.add_argument('--channels', type=int, default=24)
+    parser.add_argument('--per-mcu', type=int, default=12, help="channels per driver (mcu)")
+    parser.add_argument('--inttime', type=int, default=100, help="integration time in ms (steps of 10 ms)")
+    parser.add_argument('--rate', type=float, default=None, help="photon rate (1/s) on every channel (default: a peak)")
+    parser.add_argument('--dark', type=float, default=50.0, help="dark count rate (1/s) on the plateau")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    sim = WebSQSimulator(host=args.host, api_port=args.api_port, ws_port=args.ws_port, n_channels=args.channels,
+                         channels_per_mcu=args.per_mcu, int_time=args.inttime, photon_rate=args.rate,
+                         dark_rate=args.dark, seed=args.seed).start()
+    print(f"Simulating {args.channels} channels: JSON-RPC on {sim.domain}api, counts on {sim.ws_url}/counts (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
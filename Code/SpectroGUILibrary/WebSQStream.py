@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import threading
+import time
+
+import websockets
+
+from Code.RetinaFiles.src.WebSQSocketController import decode_counts, decode_counts_array
+
+# One long-lived websocket session to the Retina '/counts' stream, instead of connecting for every frame
+# (with 'loop.run_until_complete(websocket_client(..., n=1))' every frame paid for a new TCP connection and HTTP upgrade).
+# The session runs on its own asyncio loop in a background thread, reconnects with a backoff if the connection drops,
+# and keeps the latest decoded frame (and a short backlog of the ones before it). The GUI reads them whenever it redraws:
+#     stream = WebSQStream('ws://130.237.35.62').start()
+#     frame = stream.wait_frame(timeout=5)        --> first frame, e.g. to find the active channels
+#     ...
+#     frame = stream.latest()                     --> (called from a GUI timer) newest frame, or None
+#     if frame is not None and frame.seq != last_seq: ...
+#     for frame in stream.frames_since(last_seq): --> every frame since the last timer tick, e.g. for a history
+#         ...
+#     stream.stop()
+# In asyncio code the session can instead run as a task on the running event loop (no extra thread):
+#     stream = WebSQStream('ws://130.237.35.62').start_async()
+#     frame = await stream.next_frame()
+#     await stream.aclose()
+
+
+class Frame:
+    # one decoded package: 'payload' is the list of channel dicts from 'decode_counts',
+    # or with a 'columnar' stream the structured array from 'decode_counts_array'
+    __slots__ = ('seq', 'received', 'payload')
+
+    def __init__(self, seq, received, payload):
+        self.seq = seq              # 1, 2, 3, ... (counted over reconnects, so a new frame always has a higher seq)
+        self.received = received    # time.time() when the package arrived
+        self.payload = payload
+
+
+class WebSQStream:
+
+    def __init__(self, base_url, normalized=False, columnar=False, on_message=None, min_backoff=0.5, max_backoff=10.0,
+                 open_timeout=5.0, backlog=1000):
+        self.uri = base_url.rstrip('/') + "/counts"
+        self.on_message = on_message        # on_message(message, t_received) with the raw package (in the stream thread)
+        self.normalized = normalized
+        self.decode = decode_counts_array if columnar else decode_counts
+        self.min_backoff = min_backoff      # s, wait before the first reconnect, doubled after every failed attempt
+        self.max_backoff = max_backoff
+        self.open_timeout = open_timeout
+
+        # note: the latest frame is published by replacing one attribute (atomic in Python), so reading it never
+        # waits for the stream thread. The condition is only used by 'wait_frame'.
+        self._latest = None
+        self._recent = collections.deque(maxlen=backlog)    # the last 'backlog' frames, see 'frames_since'
+        self._new_frame = threading.Condition()
+
+        self.connected = False
+        self.n_connects = 0
+        self.last_error = None
+        self._seq = 0
+        self._loop = None
+        self._task = None
+        self._thread = None
+        self._frame_event = None    # asyncio.Event, only when running on the caller's event loop
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def start_async(self):
+        # runs the session as a task on the running event loop, call from a coroutine
+        if not self.running():
+            self._loop = asyncio.get_running_loop()
+            self._frame_event = asyncio.Event()
+            self._task = self._loop.create_task(self._session())
+        return self
+
+    def stop(self, timeout=2.0):
+        if self._thread is None:
+            if self._task is not None:
+                self._task.cancel()     # note: on the caller's loop, see 'aclose' to also wait for it
+        elif self._loop is not None and self._task is not None and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.connected = False
+
+    async def aclose(self):
+        self.stop()
+        if self._thread is None and self._task is not None:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def running(self):
+        if self._thread is None:
+            return self._task is not None and not self._task.done()
+        return self._thread.is_alive()
+
+    def latest(self):
+        # newest frame (or None before the first one), never blocks
+        return self._latest
+
+    def wait_frame(self, after=0, timeout=None):
+        # waits for a frame with seq > 'after' and returns it (or None on timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._new_frame:
+            while self._latest is None or self._latest.seq <= after:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                if not self.running():
+                    return None
+                self._new_frame.wait(remaining if remaining is not None else 0.5)
+        return self._latest
+
+    async def next_frame(self, after=0):
+        # waits (without blocking the event loop) for a frame with seq > 'after', only with 'start_async'
+        while self._latest is None or self._latest.seq <= after:
+            if not self.running():
+                return None
+            self._frame_event.clear()
+            await self._frame_event.wait()
+        return self._latest
+
+    def frames_since(self, seq):
+        # the frames with seq > 'seq' that are still in the backlog, oldest first, never blocks
+        # (if the first one has a seq above 'seq' + 1, the ones in between were pushed out of the backlog)
+        frames = self._recent.copy()    # note: copying a deque is atomic, the stream thread keeps appending
+        return [frame for frame in frames if frame.seq > seq]
+
+    def frames(self, n, timeout=None):
+        # the next 'n' frames, one after the other (frames that arrive while the last one is handled come from the
+        # backlog, so none are lost as long as the handling keeps up on average)
+        seq = self._latest.seq if self._latest else 0
+        while n > 0:
+            frames = self.frames_since(seq)[:n]
+            if not frames:
+                if self.wait_frame(after=seq, timeout=timeout) is None:
+                    return
+                continue
+            for frame in frames:
+                seq = frame.seq
+                n -= 1
+                yield frame
+
+    def _publish(self, message):
+        received = time.time()
+        if self.on_message:
+            self.on_message(message, received)
+        self._seq += 1
+        frame = Frame(self._seq, received, self.decode(message, normalized=self.normalized))
+        self._recent.append(frame)
+        self._latest = frame
+        with self._new_frame:
+            self._new_frame.notify_all()
+        if self._frame_event is not None:
+            self._frame_event.set()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._task = self._loop.create_task(self._session())
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+            with self._new_frame:
+                self._new_frame.notify_all()    # note: wakes up 'wait_frame', which then sees that we stopped
+
+    async def _session(self):
+        try:
+            await self._connect_loop()
+        finally:
+            self.connected = False
+            if self._frame_event is not None:
+                self._frame_event.set()     # note: wakes up 'next_frame', which then sees that we stopped
+
+    async def _connect_loop(self):
+        backoff = self.min_backoff
+        while True:
+            try:
+                async with websockets.connect(self.uri, open_timeout=self.open_timeout) as websocket:
+                    self.connected = True
+                    self.n_connects += 1
+                    self.last_error = None
+                    backoff = self.min_backoff
+                    async for message in websocket:
+                        self._publish(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:   # refused, timed out, closed by the Retina, ...
+                self.last_error = e
+            self.connected = False
+            await asyncio.sleep(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
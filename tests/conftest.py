@@ -0,0 +1,13 @@
+import os
+import sys
+import socket
+
+# the tests import the 'Code' package from the repository root (one folder up), like the entry points do
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def free_port():
+    # a port nothing listens on, for the local test servers
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import pytest
+
+from Code.SpectroGUILibrary.AsyncWebSQController import AsyncWebSQController
+from Code.SpectroGUILibrary.WebSQSimulator import WebSQSimulator
+from conftest import free_port
+
+
+@pytest.fixture
+def simulator():
+    sim = WebSQSimulator(api_port=free_port(), ws_port=free_port(), n_channels=4, int_time=10, seed=0).start()
+    yield sim
+    sim.stop()
+
+
+def sweep(asq, **kwargs):
+    async def run():
+        try:
+            return await asq.sweep_iv(8, 12, 0.5, 10, poll=0.02, **kwargs)
+        finally:
+            await asq.aclose()
+    return asyncio.run(run())
+
+
+def test_sweep_returns_every_step(simulator):
+    traces = sweep(AsyncWebSQController(simulator.domain))
+    assert len(traces) == 4
+    assert all(len(trace['biasI']) == 9 and None not in trace['counts'] for trace in traces.values())
+
+
+def test_sweep_does_not_need_the_iv_status(simulator):
+    # what IVStatus answers on the Retina isn't known, the sweep is done when its data is
+    asq = AsyncWebSQController(simulator.domain)
+    asq.sq.getIvStatus = lambda: 'complete'
+    traces = sweep(asq)
+    assert all(len(trace['biasI']) == 9 for trace in traces.values())
+
+
+def test_incomplete_sweep_returns_the_data_at_the_timeout(simulator, caplog):
+    asq = AsyncWebSQController(simulator.domain)
+    get_iv_data = asq.sq.getIvData
+
+    def missing_last_step(**kwargs):
+        traces = get_iv_data(**kwargs)
+        return dict((loc, dict((key, values[:-1]) for key, values in trace.items())) for loc, trace in traces.items())
+    asq.sq.getIvData = missing_last_step
+    with caplog.at_level(logging.WARNING):
+        traces = sweep(asq, timeout=0.3)
+    assert all(len(trace['biasI']) == 8 for trace in traces.values())
+    assert "not complete" in caplog.text and "(8 of 9 steps)" in caplog.text
+
+
+def test_data_of_the_previous_sweep_is_not_taken(simulator, caplog):
+    # until the new sweep starts (a new 'ivTimeStamp') getIvData returns the complete data of the last one
+    sweep(AsyncWebSQController(simulator.domain))
+    asq = AsyncWebSQController(simulator.domain)
+    asq.sq.startIv = lambda *args, **kwargs: None
+    with caplog.at_level(logging.WARNING):
+        sweep(asq, timeout=0.3)
+    assert "not complete" in caplog.text
+
+
+def test_iv_complete():
+    traces = {(1, 1): {'biasI': [1, 2, 3]}, (1, 2): {'biasI': [1, 2]}}
+    assert not AsyncWebSQController.iv_complete(traces, 3, started=None)
+    traces[(1, 2)]['biasI'].append(3)
+    assert AsyncWebSQController.iv_complete(traces, 3, started=None)
+    assert AsyncWebSQController.iv_complete(traces, 3, started=2.0, started_before=1.0)
+    assert not AsyncWebSQController.iv_complete(traces, 3, started=1.0, started_before=1.0)
+    assert not AsyncWebSQController.iv_complete({}, 3, started=None)
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from Code.Analysis import BatchAnalysis
+from Code.Analysis.BatchAnalysis import run_batch
+from Code.SpectroGUILibrary.TimeresFile import write_synthetic_timeres
+
+
+@pytest.fixture
+def scans(tmp_path):
+    directory = tmp_path / 'scans'
+    directory.mkdir()
+    files = [str(directory / f'scan{i}.timeres') for i in range(3)]
+    for i, file in enumerate(files):
+        write_synthetic_timeres(file, 20000, channels=(1, 2, 3, 4), seed=i)
+    return files
+
+
+def batch(scans, tmp_path, **kwargs):
+    return run_batch([os.path.dirname(scans[0])], out=str(tmp_path / 'results'), analyses=['lifetime', 'signal'],
+                     workers=1, log=lambda line: None, **kwargs)
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    # the files whose content is hashed
+    files = []
+    file_sha1 = BatchAnalysis.file_sha1
+
+    def counted(file, *args, **kwargs):
+        files.append(os.path.basename(file))
+        return file_sha1(file, *args, **kwargs)
+    monkeypatch.setattr(BatchAnalysis, 'file_sha1', counted)
+    return files
+
+
+def test_unchanged_files_are_skipped_without_reading_them(scans, tmp_path, hashed):
+    store, summary = batch(scans, tmp_path)
+    assert summary == {'analyzed': 3, 'skipped': 0, 'failed': 0}
+    assert store.n_rows('files') == 3 and store.n_rows('signal') == 12
+    del hashed[:]
+    store, summary = batch(scans, tmp_path)
+    assert summary == {'analyzed': 0, 'skipped': 3, 'failed': 0}
+    assert hashed == []
+
+
+def test_touched_file_with_the_same_content_is_skipped(scans, tmp_path, hashed):
+    store, _ = batch(scans, tmp_path)
+    lifetime = store.read('lifetime', ['file', 'tau'], mmap=False)
+    stat = os.stat(scans[1])
+    os.utime(scans[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    del hashed[:]
+    store, summary = batch(scans, tmp_path)
+    assert summary == {'analyzed': 0, 'skipped': 3, 'failed': 0}
+    assert hashed == ['scan1.timeres']          # hashed, not analyzed
+    files = store.read('files')
+    assert files['file'].tolist() == scans[:1] + scans[2:] + scans[1:2]
+    assert int(files['mtime_ns'][-1]) == stat.st_mtime_ns + 10 ** 9 and files['n_records'][-1] == 20000
+    new_lifetime = store.read('lifetime', ['file', 'tau'], mmap=False)
+    assert sorted(new_lifetime['file'].tolist()) == sorted(lifetime['file'].tolist())
+    # the new modification time is stored, so the file is not hashed again
+    del hashed[:]
+    assert batch(scans, tmp_path)[1]['skipped'] == 3 and hashed == []
+
+
+def test_changed_files_and_settings_are_analyzed_again(scans, tmp_path, hashed):
+    batch(scans, tmp_path)
+    write_synthetic_timeres(scans[2], 30000, channels=(1, 2, 3, 4), seed=5)
+    store, summary = batch(scans, tmp_path)
+    assert summary == {'analyzed': 1, 'skipped': 2, 'failed': 0}
+    assert store.rows('files', 'file', scans[2])['n_records'].tolist() == [30000]
+    assert store.n_rows('lifetime') == 3 * len(store.rows('lifetime', 'file', scans[0])['name'])
+    store, summary = batch(scans, tmp_path, settings={'lifetime_binsize': 40})
+    assert summary == {'analyzed': 3, 'skipped': 0, 'failed': 0}
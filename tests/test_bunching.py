@@ -0,0 +1,61 @@
+import itertools
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.Bunching import BunchingEngine, optimal_partition
+
+
+def partition_cost(x, weights, labels):
+    # weighted sum of squares of every bunch around its weighted mean
+    cost = 0.0
+    for label in set(labels.tolist()):
+        xs, ws = x[labels == label], weights[labels == label]
+        if ws.sum() > 0:
+            cost += float((ws * (xs - np.average(xs, weights=ws)) ** 2).sum())
+    return cost
+
+
+def brute_force_cost(x, weights, k):
+    # every assignment of the points with counts to k labels (not only runs of neighbours)
+    counted = weights > 0
+    xs, ws = x[counted], weights[counted]
+    return min(partition_cost(xs, ws, np.array(labels)) for labels in itertools.product(range(k), repeat=len(xs)))
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_partition_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 8))
+    k = int(rng.integers(1, 5))
+    x = rng.choice(np.linspace(500, 600, 12), n)      # note: can have the same wavelength twice
+    weights = rng.integers(0, 4, n) * rng.integers(1, 1000, n)
+    result = optimal_partition(x, weights, k)
+    if not (weights > 0).any():
+        assert len(result['centers']) == 0 and result['cost'] == 0.0
+        return
+    expected = brute_force_cost(x, weights, k)
+    assert result['cost'] == pytest.approx(expected, rel=1e-9, abs=1e-6)
+    counted = weights > 0
+    assert partition_cost(x[counted], weights[counted], result['labels'][counted]) == \
+        pytest.approx(expected, rel=1e-9, abs=1e-6)
+    assert len(result['centers']) == min(k, int(counted.sum()))
+    assert np.all(np.diff(result['centers']) >= 0)    # bunches are numbered in increasing x
+
+
+def test_zero_weight_points_join_the_nearest_bunch():
+    x = np.array([500.0, 501.0, 540.0, 590.0, 591.0, 589.0])
+    weights = np.array([10, 10, 0, 10, 10, 0])
+    result = optimal_partition(x, weights, 2)
+    assert result['labels'].tolist() == [0, 0, 0, 1, 1, 1]
+    assert result['centers'] == pytest.approx([500.5, 590.5])
+
+
+def test_engine_only_recomputes_when_the_counts_move():
+    x = np.linspace(500, 600, 24)
+    counts = np.exp(-0.5 * ((x - 530) / 5) ** 2) * 1000 + np.exp(-0.5 * ((x - 570) / 5) ** 2) * 1000 + 10
+    engine = BunchingEngine(threshold=0.02)
+    assert engine.update(x, counts, 2)[1]
+    assert not engine.update(x, counts * 1.5, 2)[1]              # same distribution
+    assert engine.update(x, counts, 3)[1]                        # other number of bunches
+    assert engine.update(x, np.roll(counts, 3), 3)[1]            # the lines moved
+    assert (engine.n_updates, engine.n_computed) == (4, 3)
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.ColumnStore import ColumnStore
+
+
+def counted_writes(store):
+    # the tables written by 'store', one entry per whole table write
+    written = []
+    write = store.write
+
+    def wrapped(table, columns):
+        written.append(table)
+        return write(table, columns)
+    store.write = wrapped
+    return written
+
+
+def test_upsert_replaces_rows_with_the_same_key(tmp_path):
+    store = ColumnStore(tmp_path / 'store')
+    store.upsert('t', 'file', {'file': ['a', 'a', 'b'], 'x': [1.0, 2.0, 3.0]})
+    store.save()
+    store.upsert('t', 'file', {'file': ['a', 'c'], 'x': [10.0, 20.0]})
+    store.save()
+    data = store.read('t')
+    assert data['file'].tolist() == ['b', 'a', 'c'] and data['x'].tolist() == [3.0, 10.0, 20.0]
+    assert store.n_rows('t') == 3
+    # from the files
+    store = ColumnStore(tmp_path / 'store')
+    assert store.read('t', ['x'])['x'].tolist() == [3.0, 10.0, 20.0]
+    assert store.rows('t', 'file', 'a') == {'file': ['a'], 'x': [10.0]}
+
+
+def test_upserts_are_written_once_per_table(tmp_path):
+    store = ColumnStore(tmp_path / 'store')
+    store.upsert('t', 'file', {'file': ['old'], 'x': [0.0]})
+    store.save()
+    written = counted_writes(store)
+    for i in range(50):
+        store.upsert('t', 'file', {'file': [f'f{i}'] * 2, 'x': [i, i + 0.5]})
+        store.upsert('u', 'file', {'file': [f'f{i}'], 'n': [i]})
+    store.upsert('t', 'file', {'file': ['f3', 'old'], 'x': [-3.0, -1.0]})    # a later upsert replaces an earlier one
+    assert written == []
+    store.save()
+    assert sorted(written) == ['t', 'u']
+    data = store.read('t')
+    assert len(data['file']) == 2 * 49 + 2
+    assert data['x'][data['file'] == 'f3'].tolist() == [-3.0]
+    assert data['x'][data['file'] == 'old'].tolist() == [-1.0]
+    assert data['file'][:4].tolist() == ['f0', 'f0', 'f1', 'f1']                # in the order of the upserts
+    assert store.read('u')['n'].tolist() == list(range(50))
+
+
+def test_reading_writes_the_pending_rows(tmp_path):
+    store = ColumnStore(tmp_path / 'store')
+    store.upsert('t', 'file', {'file': ['a'], 'x': [1]})
+    assert store.n_rows('t') == 1 and store.columns('t') == ['file', 'x'] and store.tables() == ['t']
+    assert store.read('t')['x'].tolist() == [1]
+    store.upsert('t', 'file', {'file': ['b'], 'x': [2]})
+    store.delete('t', 'file', ['a'])
+    assert store.read('t')['file'].tolist() == ['b']
+    store.upsert('t', 'file', {'file': ['c'], 'x': [3]})
+    store.write('t', {'file': ['d'], 'x': [4]})           # replaces the table, pending rows included
+    store.save()
+    assert store.read('t')['file'].tolist() == ['d']
+
+
+def test_missing_columns_are_filled(tmp_path):
+    store = ColumnStore(tmp_path / 'store')
+    store.upsert('t', 'file', {'file': ['a', 'b'], 'x': [1.0, 2.0], 'n': [1, 2], 'ok': [True, True],
+                               'h': np.ones((2, 3), dtype=int)})
+    store.save()
+    store.upsert('t', 'file', {'file': ['c'], 'name': ['new'], 'h': np.full((1, 5), 2, dtype=int)})
+    store.save()
+    data = {name: values.tolist() for name, values in store.read('t').items()}
+    assert np.isnan(data['x'][2]) and data['x'][:2] == [1.0, 2.0]
+    assert data['n'] == [1, 2, 0] and data['ok'] == [True, True, False] and data['name'] == ['', '', 'new']
+    # note: integer histograms of another width are padded with NaN (as floats)
+    h = store.read('t', ['h'])['h']
+    assert h.shape == (3, 5) and h.dtype == float
+    assert np.isnan(h[:2, 3:]).all() and (h[:2, :3] == 1).all() and (h[2] == 2).all()
+
+
+def test_bad_rows(tmp_path):
+    store = ColumnStore(tmp_path / 'store')
+    with pytest.raises(ValueError):
+        store.upsert('t', 'file', {'file': ['a', 'b'], 'x': [1.0]})
+    with pytest.raises(KeyError):
+        store.upsert('t', 'file', {'name': ['a']})
+    with pytest.raises(TypeError):
+        store.upsert('t', 'file', {'file': ['a'], 'x': np.array([{}], dtype=object)})
+    store.save()
+    assert store.tables() == []
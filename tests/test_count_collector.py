@@ -0,0 +1,94 @@
+import time
+import numpy as np
+import pytest
+
+from Code.RetinaFiles.src.WebSQController import WebSQController
+from Code.SpectroGUILibrary.CountCollector import CountCollector, SampleSchedule, read_counts_file
+from Code.SpectroGUILibrary.WebSQSimulator import WebSQSimulator
+from conftest import free_port
+
+
+@pytest.fixture
+def simulator():
+    # note: the integration time is longer than the sampling interval, so samples repeat
+    sim = WebSQSimulator(api_port=free_port(), ws_port=free_port(), n_channels=4, int_time=50, seed=0).start()
+    yield sim
+    sim.stop()
+
+
+def test_schedule_on_time_and_late():
+    schedule = SampleSchedule(1.0, runtime=10).start(now=100.0)
+    assert schedule.wait(now=99.5) == 0.5 and schedule.wait(now=100.2) == 0.0
+    assert schedule.take(now=100.0) == (0, 100.0, 0.0)
+    assert schedule.wait(now=100.2) == pytest.approx(0.8)
+    assert schedule.take(now=101.3) == (1, 101.0, pytest.approx(0.3))     # not late: less than half an interval
+    assert schedule.take(now=102.7) == (2, 102.0, pytest.approx(0.7))     # late
+    assert (schedule.n_taken, schedule.n_late, schedule.n_missed) == (3, 1, 0)
+    assert schedule.max_lateness == pytest.approx(0.7) and schedule.sum_lateness == pytest.approx(1.0)
+
+
+def test_schedule_skips_missed_points():
+    schedule = SampleSchedule(1.0).start(now=0.0)
+    schedule.take(now=0.0)
+    # a request that took 3.2 s: the grid points 1 and 2 are missed, the next sample is for point 3
+    assert schedule.take(now=3.2) == (3, 3.0, pytest.approx(0.2))
+    assert schedule.wait(now=3.5) == pytest.approx(0.5)
+    assert (schedule.n_taken, schedule.n_missed, schedule.n_late) == (2, 2, 0)
+    assert not schedule.finished()
+
+
+def test_schedule_finishes_after_the_runtime():
+    schedule = SampleSchedule(1.0, runtime=3).start(now=0.0)
+    assert schedule.take(now=0.0)[0] == 0
+    assert schedule.take(now=1.1)[0] == 1
+    # past the runtime: the points 2 and 3 are missed and nothing is taken
+    assert schedule.take(now=4.5) is None
+    assert schedule.finished() and (schedule.n_taken, schedule.n_missed) == (2, 2)
+
+    schedule = SampleSchedule(1.0, runtime=3).start(now=0.0)
+    for k in range(4):
+        assert schedule.take(now=float(k))[0] == k      # the last point is at the runtime itself
+    assert schedule.finished() and schedule.n_missed == 0
+
+
+def test_collector_writes_every_sample(simulator, tmp_path):
+    sq = WebSQController(simulator.domain)
+    file = tmp_path / 'counts.csv'
+    metrics = CountCollector(sq, interval=0.01, runtime=0.5, file=file).run()
+    data = read_counts_file(file)
+    n = metrics['n_samples']
+    assert n > 10 and metrics['n_errors'] == metrics['n_dropped'] == 0
+    assert data['seq'].tolist() == list(range(n))
+    assert np.all(np.diff(data['tick']) > 0)
+    assert sorted(name for name in data if name.startswith('counts_')) == [f'counts_{rank}' for rank in range(1, 5)]
+    assert metrics['n_repeated'] == int(np.sum(np.diff(data['server_time']) == 0)) > 0
+
+
+def test_slow_consumer_drops_samples(simulator, tmp_path):
+    sq = WebSQController(simulator.domain)
+    file = tmp_path / 'counts.csv'
+    collector = CountCollector(sq, interval=0.01, runtime=0.3, file=file, queue_size=1,
+                               on_sample=lambda sample: time.sleep(0.05))
+    metrics = collector.run()
+    assert metrics['n_dropped'] > 0
+    assert len(read_counts_file(file)['seq']) + metrics['n_dropped'] == metrics['n_samples']
+
+
+def test_failed_requests_are_only_counted(simulator, tmp_path):
+    sq = WebSQController(simulator.domain)
+    get_counts = sq.getCounts
+    calls = []
+
+    def every_third_fails(**kwargs):
+        calls.append(1)
+        if len(calls) % 3 == 0:
+            raise ConnectionError("dropped")
+        return get_counts(**kwargs)
+    sq.getCounts = every_third_fails
+    file = tmp_path / 'counts.csv'
+    collector = CountCollector(sq, interval=0.01, runtime=0.3, file=file)
+    metrics = collector.run()
+    assert metrics['n_errors'] == len(calls) // 3 > 0
+    assert metrics['n_samples'] == len(calls) - metrics['n_errors'] and metrics['n_dropped'] == 0
+    assert collector.last_error == "ConnectionError('dropped')"
+    assert read_counts_file(file)['seq'].tolist() == list(range(metrics['n_samples']))
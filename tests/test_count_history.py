@@ -0,0 +1,61 @@
+import time
+import numpy as np
+
+from Code.SpectroGUILibrary.CountHistory import CountHistory
+from Code.SpectroGUILibrary.WebSQSimulator import WebSQSimulator
+from Code.SpectroGUILibrary.WebSQStream import WebSQStream
+from conftest import free_port
+
+
+def fill(history, n, t0=0.0):
+    for i in range(n):
+        history.append(np.full(len(history.channels), t0 + i), t=t0 + i)
+
+
+def test_history_last_and_mean():
+    history = CountHistory([1, 2, 3], capacity=10)
+    fill(history, 25)
+    times, values = history.last()
+    assert times.tolist() == list(range(15, 25))
+    assert history.mean(n=4).tolist() == [22.5] * 3
+    assert history.since(20)[0].tolist() == [20, 21, 22, 23, 24]
+
+
+def test_clear_does_not_overwrite_spilled_chunks(tmp_path):
+    history = CountHistory([1, 2], capacity=10, spill_dir=str(tmp_path), spill_chunk=5)
+    fill(history, 12)
+    history.clear()          # note: saves the last 2 frames
+    fill(history, 7, t0=100)
+    history.flush()
+    times, values, channels = CountHistory.load_spill(str(tmp_path))
+    assert times.tolist() == list(range(12)) + list(range(100, 107))
+    assert channels.tolist() == [1, 2]
+
+    # a new history in the same directory continues after the chunks that are there
+    history = CountHistory([1, 2], capacity=10, spill_dir=str(tmp_path), spill_chunk=5)
+    fill(history, 5, t0=200)
+    times = CountHistory.load_spill(str(tmp_path))[0]
+    assert times.tolist() == list(range(12)) + list(range(100, 107)) + list(range(200, 205))
+
+
+def test_stream_backlog_keeps_every_frame():
+    # a GUI timer that polls less often than frames arrive still gets all of them
+    sim = WebSQSimulator(api_port=free_port(), ws_port=free_port(), n_channels=4, int_time=10, seed=0).start()
+    stream = WebSQStream(sim.ws_url, columnar=True).start()
+    try:
+        assert stream.wait_frame(timeout=5) is not None
+        history = CountHistory([1, 2, 3, 4], capacity=1000)
+        last_seq = 0
+        for _ in range(3):
+            time.sleep(0.2)
+            frames = stream.frames_since(last_seq)
+            assert [frame.seq for frame in frames] == list(range(last_seq + 1, last_seq + 1 + len(frames)))
+            for frame in frames:
+                history.append_frame(frame.payload)
+            last_seq = frames[-1].seq
+        assert len(history) == last_seq > 10
+        seqs = [frame.seq for frame in stream.frames(5, timeout=5)]
+        assert seqs == list(range(seqs[0], seqs[0] + 5)) and seqs[0] > last_seq
+    finally:
+        stream.stop()
+        sim.stop()
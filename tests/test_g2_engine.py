@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.G2Engine import G2Matrix, g2_all_pairs
+from Code.SpectroGUILibrary.HistogramEngines import run_engines
+from Code.SpectroGUILibrary.ParallelAnalysis import parallel_run_engines
+from Code.SpectroGUILibrary.TimeresFile import TimeresFile, write_synthetic_timeres
+
+CHANNELS = [2, 3, 4]
+BINS, BINSIZE = 1000, 20
+
+
+@pytest.fixture(scope='module')
+def timeres(tmp_path_factory):
+    file = str(tmp_path_factory.mktemp('g2') / 'synthetic.timeres')
+    write_synthetic_timeres(file, 4000, channels=(1, 2, 3, 4), seed=3)
+    return file
+
+
+def brute_force(file, channels, bins, binsize, auto):
+    # every ordered pair of different tags, binned like G2Matrix: delay = bin(t_j) - bin(t_i) for pair (i, j)
+    with TimeresFile(file) as tf:
+        records = np.array(tf.records)
+    t_bin = {ch: records['time'][records['channel'] == ch].astype(np.int64) // binsize for ch in channels}
+    histograms = []
+    for i in range(len(channels)):
+        for j in range(i if auto else i + 1, len(channels)):
+            delay = (t_bin[channels[j]][None, :] - t_bin[channels[i]][:, None]).ravel()
+            if i == j:
+                delay = delay[~np.eye(len(t_bin[channels[i]]), dtype=bool).ravel()]   # not a tag with itself
+            delay = delay[(delay >= -bins) & (delay < bins)]
+            histograms.append(np.bincount(delay + bins, minlength=2 * bins))
+    return np.array(histograms)
+
+
+@pytest.mark.parametrize('method', ['merge', 'fft'])
+@pytest.mark.parametrize('auto', [False, True])
+def test_matches_brute_force(timeres, method, auto):
+    expected = brute_force(timeres, CHANNELS, BINS, BINSIZE, auto)
+    assert expected.sum() > 1000
+    for chunk_size in (97, 10 ** 6):
+        engine = G2Matrix(CHANNELS, bins=BINS, binsize=BINSIZE, method=method, auto=auto)
+        result = run_engines(timeres, [engine], chunk_size=chunk_size)[0]
+        np.testing.assert_array_equal(result['g2'], expected)
+
+
+def test_merge_and_fft_agree(timeres):
+    results = {method: run_engines(timeres, [G2Matrix(CHANNELS, bins=1000, binsize=50, method=method, auto=True)])[0]
+               for method in ('merge', 'fft')}
+    for name in ('g2', 'counts', 'duration', 'span'):
+        np.testing.assert_array_equal(results['merge'][name], results['fft'][name])
+
+
+@pytest.mark.parametrize('method', ['merge', 'fft'])
+def test_parallel_matches_single_pass(timeres, method):
+    single = run_engines(timeres, [G2Matrix(CHANNELS, bins=BINS, binsize=BINSIZE, method=method)])[0]
+    parallel = parallel_run_engines(timeres, [G2Matrix(CHANNELS, bins=BINS, binsize=BINSIZE, method=method)],
+                                    n_workers=3, min_segment_records=300)[0]
+    np.testing.assert_array_equal(parallel['g2'], single['g2'])
+    np.testing.assert_array_equal(parallel['counts'], single['counts'])
+    # the duration is from the first to the last tag of the file, with the time between the segments
+    assert parallel['duration'].tolist() == single['duration'].tolist()
+    assert parallel['span'].tolist() == single['span'].tolist()
+
+
+def test_normalized_is_one_without_correlations(timeres):
+    # note: the synthetic records are 1-20000 ps apart (not Poisson), so only delays much longer than that are flat
+    delays, labels, g2 = g2_all_pairs(timeres, channels=CHANNELS, bins=500, binsize=2000, n_workers=1)
+    assert labels == ['ch.2 - ch.3', 'ch.2 - ch.4', 'ch.3 - ch.4']
+    assert delays[0] == -500 * 2000 and len(delays) == 1000
+    assert g2.mean(axis=1) == pytest.approx([1.0] * 3, rel=0.05)
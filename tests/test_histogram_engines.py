@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.HistogramEngines import cross_check_eta, cross_check_eta_recipe, lifetime_histogram, \
+    run_engines, run_eta_recipe, CountrateHistogram, CorrelationHistogram, SignalCounter, CORRELATION_PAIRS
+from Code.SpectroGUILibrary.ParallelAnalysis import parallel_run_engines
+
+# 'data/small.timeres' is 8000 synthetic records (write_synthetic_timeres(file, 8000, channels=(1, 2, 3, 4), seed=1)),
+# the '.npz' files are what etabackend 0.9.9 made of it:
+#   small_eta_lifetime.npz     'Lifetime-swabian_spectrometer.eta', cross_check_eta_recipe(file, save_as=...)
+#   small_eta_countrate.npz    'Countrate-swabian_spectrometer.eta', run_eta_recipe(..., bins=100, binsize=10**6)
+#   small_eta_correlation.npz  'Correlation-swabian_spectrometer.eta', run_eta_recipe(..., bins=10000, binsize=20)
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+TIMERES = os.path.join(DATA, 'small.timeres')
+ETA_LIFETIME = os.path.join(DATA, 'small_eta_lifetime.npz')
+ETA_COUNTRATE = os.path.join(DATA, 'small_eta_countrate.npz')
+ETA_CORRELATION = os.path.join(DATA, 'small_eta_correlation.npz')
+RECIPES = os.path.join(os.path.dirname(__file__), '..', 'Code', 'ETARecipes')
+
+
+def test_lifetime_matches_stored_eta():
+    assert cross_check_eta(TIMERES, ETA_LIFETIME) == {'h2': True, 'h3': True, 'h4': True}
+
+
+def test_lifetime_stored_eta_is_not_empty():
+    # the reference has to have counts in every histogram, or the check above proves nothing
+    with np.load(ETA_LIFETIME) as eta:
+        numpy_result = lifetime_histogram(TIMERES)
+        for name in ('h2', 'h3', 'h4'):
+            assert eta[name].sum() > 100
+            np.testing.assert_array_equal(numpy_result[name], eta[name])
+
+
+def test_lifetime_matches_eta_recipe():
+    pytest.importorskip('etabackend')
+    recipe = os.path.join(RECIPES, 'Lifetime-swabian_spectrometer.eta')
+    assert all(cross_check_eta_recipe(TIMERES, recipe=recipe).values())
+
+
+def test_countrate_matches_stored_eta():
+    assert all(cross_check_eta(TIMERES, ETA_COUNTRATE, engine=CountrateHistogram(bins=100, binsize=10 ** 6)).values())
+
+
+@pytest.mark.parametrize('chunk_size', [37, 1000, 2 ** 22])
+def test_correlation_matches_stored_eta(chunk_size):
+    with np.load(ETA_CORRELATION) as eta:
+        result = run_engines(TIMERES, [CorrelationHistogram(bins=10000, binsize=20)], chunk_size=chunk_size)[0]
+        for name in CORRELATION_PAIRS:
+            np.testing.assert_array_equal(result[name], eta[name])
+
+
+def test_parallel_correlation_matches_stored_eta():
+    # later segments need the number of start tags before them (see CorrelationHistogram.seek)
+    engines = [CorrelationHistogram(bins=10000, binsize=20), CountrateHistogram(bins=100, binsize=10 ** 6)]
+    correlation, countrate = parallel_run_engines(TIMERES, engines, n_workers=4, min_segment_records=1000)
+    with np.load(ETA_CORRELATION) as eta:
+        for name in CORRELATION_PAIRS:
+            np.testing.assert_array_equal(correlation[name], eta[name])
+    with np.load(ETA_COUNTRATE) as eta:
+        for name in countrate:
+            np.testing.assert_array_equal(countrate[name], eta[name])
+
+
+def test_signal_counts_match_stored_eta():
+    # 'signal_counter.eta' only reads qutag files, so the counts are checked against the ETA countrate histograms,
+    # which have every tag of channels 2, 3 and 4 in them (bins cover the whole file), except the very first tag
+    counts = run_engines(TIMERES, [SignalCounter()])[0]
+    first_channel = int(np.fromfile(TIMERES, dtype=np.int32, count=2)[1])
+    with np.load(ETA_COUNTRATE) as eta:
+        for ch in (2, 3, 4):
+            assert counts[ch] == eta[f'h{ch}'].sum() + (ch == first_channel)
+
+
+def test_correlation_matches_eta_recipe():
+    pytest.importorskip('etabackend')
+    recipe = os.path.join(RECIPES, 'Correlation-swabian_spectrometer.eta')
+    eta_result = run_eta_recipe(TIMERES, recipe, CORRELATION_PAIRS, bins=10000, binsize=200)
+    assert all(cross_check_eta(TIMERES, eta_result, engine=CorrelationHistogram(bins=10000, binsize=200)).values())
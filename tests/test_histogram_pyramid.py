@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.HistogramPyramid import HistogramPyramid
+
+
+def histograms(n_bins, n_rows=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return {f'h{k}': rng.poisson(50, n_bins).astype(float) for k in range(n_rows)}
+
+
+def reference_rebin(counts, factor):
+    # sum of every 'factor' bins, the last group padded with zeros
+    n = -(-len(counts) // factor) * factor
+    return np.concatenate((counts, np.zeros(n - len(counts)))).reshape(-1, factor).sum(axis=1)
+
+
+def test_level_for():
+    pyramid = HistogramPyramid(histograms(1000), binsize=20)      # levels of 20 ... 20 * 2**6 ps
+    assert len(pyramid) == 7
+    assert pyramid.level_for(0, 20000, pixels=100) == 3           # 10 bins per pixel --> 8 per bin of level 3
+    assert pyramid.level_for(0, 20000, pixels=1000) == 0          # 1 bin per pixel
+    assert pyramid.level_for(0, 20000, pixels=600) == 0           # less than 2 bins per pixel
+    assert pyramid.level_for(0, 20000, pixels=500) == 1
+    assert pyramid.level_for(0, 20000, pixels=1) == len(pyramid) - 1     # not coarser than the last level
+    assert pyramid.level_for(0, 20000, pixels=0) == len(pyramid) - 1     # note: as 1 pixel
+    assert pyramid.level_for(5000, 5000, pixels=100) == 0         # empty range
+
+
+@pytest.mark.parametrize('n_bins', [37, 64, 1001])
+def test_levels_and_views_conserve_counts(n_bins):
+    data = histograms(n_bins)
+    pyramid = HistogramPyramid(data, binsize=20, x0=-500.0)
+    for level in range(len(pyramid)):
+        x, rows = pyramid.view(level=level, mean=False)
+        size = pyramid.level_binsize(level)
+        assert np.allclose(x, -500.0 + np.arange(len(x)) * size)
+        assert x[-1] < -500.0 + n_bins * 20 <= x[-1] + size       # the last bin covers the end
+        for name, counts in data.items():
+            assert rows[name].sum() == counts.sum()
+        # per base bin: times the number of base bins in each bin (the last one can be short) gives the counts back
+        x, means = pyramid.view(level=level)
+        widths = np.minimum(2 ** level, n_bins - np.arange(len(x)) * 2 ** level)
+        for name, counts in data.items():
+            assert np.allclose(means[name] * widths, rows[name])
+
+
+def test_view_of_a_range():
+    data = histograms(1000)
+    pyramid = HistogramPyramid(data, binsize=20, x0=100.0)
+    x, rows = pyramid.view(2000, 6000, level=2)                   # bins of 80 ps
+    assert x[0] <= 2000 < x[0] + 80 and x[-1] >= 6000 - 80
+    assert np.allclose(np.diff(x), 80)
+    i = int((x[0] - 100.0) // 20)
+    assert np.allclose(rows['h1'] * 4, reference_rebin(data['h1'][i:i + 4 * len(x)], 4))
+    # centered: in the middle of the 4 base bins (where the base bins have their left edge)
+    x_centered, _ = pyramid.view(2000, 6000, level=2, centered=True)
+    assert np.allclose(x_centered - x, 30)
+    # a range outside of the data is empty, a range over the ends is clipped
+    assert len(pyramid.view(10 ** 6, 2 * 10 ** 6, level=0)[0]) == 0
+    x, rows = pyramid.view(-10 ** 6, 10 ** 6, level=0)
+    assert x[0] == 100.0 and len(x) == 1000 and np.array_equal(rows['h0'], data['h0'])
+
+
+@pytest.mark.parametrize('n_bins', [13, 37, 100])
+@pytest.mark.parametrize('factor', [1, 2, 3, 4, 6, 8, 12])
+def test_rebinned(n_bins, factor):
+    data = histograms(n_bins)
+    pyramid = HistogramPyramid(data, binsize=20, min_bins=2)
+    rebinned = pyramid.rebinned(20 * factor)
+    for name, counts in data.items():
+        np.testing.assert_array_equal(rebinned[name], reference_rebin(counts, factor))
+
+
+def test_rebinned_needs_a_multiple():
+    pyramid = HistogramPyramid(histograms(50), binsize=20)
+    with pytest.raises(ValueError):
+        pyramid.rebinned(30)
+    with pytest.raises(ValueError):
+        pyramid.rebinned(10)
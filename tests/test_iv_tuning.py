@@ -0,0 +1,39 @@
+import time
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.IvTuning import IvTuner, iv_arrays
+from Code.SpectroGUILibrary.WebSQSimulator import WebSQSimulator
+from conftest import free_port
+
+
+@pytest.fixture
+def simulator():
+    sim = WebSQSimulator(api_port=free_port(), ws_port=free_port(), n_channels=8, int_time=10, seed=0).start()
+    yield sim
+    sim.stop()
+
+
+def test_iv_arrays_converts_the_bias_to_uA():
+    channelLoc = {'1': [1, 1], '2': [1, 2], '3': [1, 3]}
+    traces = {(1, 1): {'biasI': [8e-6, 8.1e-6, 8.2e-6], 'counts': [1, 2, 3], 'monitorV': [0.1, 0.2, 0.3]},
+              (1, 2): {'biasI': [8.1e-6], 'counts': [5], 'monitorV': [0.5]}}
+    ranks, bias, counts, monitorV = iv_arrays(traces, channelLoc)
+    assert ranks == ['1', '2', '3']
+    assert bias.tolist() == [8.0, 8.1, 8.2]
+    assert np.array_equal(counts, [[1, 2, 3], [np.nan, 5, np.nan], [np.nan] * 3], equal_nan=True)
+    assert np.array_equal(monitorV[1], [np.nan, 0.5, np.nan], equal_nan=True)
+
+
+def test_tuner_biases_every_channel_below_ic(simulator):
+    tuner = IvTuner(simulator.domain, poll=0.02)
+    t_start = time.perf_counter()
+    result = tuner.run(6, 16, 0.1, 10, apply=True)      # 101 steps of 10 ms
+    t_run = time.perf_counter() - t_start
+    ic = simulator.retina.ic * 1e6
+    assert result['rank'] == [str(rank) for rank in range(1, 9)]
+    assert result['ok'].all()
+    assert np.all(result['bias'] < ic)
+    assert np.all((result['ic'] >= ic) & (result['ic'] - ic <= 0.1 + 1e-9))     # the first step at or above ic
+    assert simulator.retina.bias * 1e6 == pytest.approx(result['bias'])
+    assert t_run < 1.01 + 1.0       # about the time of the one sweep of all channels
@@ -0,0 +1,61 @@
+import warnings
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.LifetimeFit import fit_lifetimes, synthetic_decays
+
+
+@pytest.mark.parametrize('method', ['mle', 'lsq'])
+def test_mono_recovers_tau_with_pulls_of_about_one(method):
+    pulls = []
+    for seed in range(4):
+        histograms, tau = synthetic_decays(n_channels=48, seed=seed)
+        fit = fit_lifetimes(histograms, binsize=20, method=method)
+        assert fit['ok'].all()
+        assert np.allclose(fit['tau'][:, 0], tau, rtol=0.05)
+        pulls.append((fit['tau'][:, 0] - tau) / fit['tau_err'][:, 0])
+    pulls = np.concatenate(pulls)
+    # note: 192 channels, so the mean of the pulls is known to about 0.07 and their spread to about 5 %
+    assert abs(pulls.mean()) < 0.3
+    assert 0.8 < pulls.std() < 1.25
+
+
+def test_low_counts_mle():
+    # at a few counts per bin least squares is biased, the Poisson likelihood is not
+    histograms, tau = synthetic_decays(n_channels=200, tau=1000, amplitude=20, background=0.5, seed=1)
+    mle = fit_lifetimes(histograms, binsize=20, method='mle')
+    assert mle['ok'].mean() > 0.95
+    assert np.median(mle['tau'][mle['ok'], 0]) == pytest.approx(1000, rel=0.05)
+
+
+@pytest.mark.parametrize('method', ['mle', 'lsq'])
+def test_bi_separates_the_decays(method):
+    histograms, _ = synthetic_decays(n_channels=24, tau=500, tau2=2500, fraction=0.3, amplitude=5000, seed=2)
+    fit = fit_lifetimes(histograms, binsize=20, model='bi', method=method)
+    assert fit['ok'].all()
+    assert np.median(fit['tau'][:, 0]) == pytest.approx(500, rel=0.05)
+    assert np.median(fit['tau'][:, 1]) == pytest.approx(2500, rel=0.05)
+    assert np.all(fit['tau'][:, 0] < fit['tau'][:, 1])
+    assert np.all(np.abs(fit['tau'] - [500, 2500]) < 5 * fit['tau_err'])
+
+
+@pytest.mark.parametrize('model', ['mono', 'bi'])
+def test_empty_and_flat_channels_are_not_ok(model):
+    histograms, _ = synthetic_decays(n_channels=3, tau=1000, seed=3)
+    rng = np.random.default_rng(3)
+    rows = np.vstack([histograms, np.zeros(625), np.full(625, 20.0), rng.poisson(20, 625), np.zeros((1, 625))])
+    rows[-1, -3:] = 5          # too few bins after the peak
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')       # note: no warnings either
+        fit = fit_lifetimes(rows, binsize=20, model=model)
+    assert fit['ok'].tolist()[3:] == [False] * 4
+    if model == 'mono':
+        assert fit['ok'][:3].all()
+    assert all(len(value) == len(rows) for value in fit.values())
+
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        fit_lifetimes(np.ones((2, 100)), model='tri')
+    with pytest.raises(ValueError):
+        fit_lifetimes(np.ones((2, 100)), method='chi2')
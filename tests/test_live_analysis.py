@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+from Code.SpectroGUILibrary.HistogramEngines import LifetimeHistogram, lifetime_histogram
+from Code.SpectroGUILibrary.LiveAnalysis import TimeresTail
+from Code.SpectroGUILibrary.TimeresFile import TIMERES_DTYPE, flip_neg_channels, temp_timeres_file, \
+    write_synthetic_timeres
+
+
+def test_temp_timeres_file():
+    assert temp_timeres_file('Data/scan_1.timeres') == 'Data/scan_1temp.timeres'
+
+
+def test_tail_follows_scan(tmp_path):
+    # a scan as 'TT.start_tt_neg' writes it: records with negative channels appended to the temp file,
+    # which is then flipped in place and renamed to the scan file
+    source = str(tmp_path / 'source.timeres')
+    write_synthetic_timeres(source, 30000, channels=(1, -2, -3, -4))
+    records = np.fromfile(source, dtype=TIMERES_DTYPE)
+    file = str(tmp_path / 'scan.timeres')
+    temp = temp_timeres_file(file)
+
+    tail = TimeresTail(temp, chunk_size=4000, renamed_to=file)
+    engine = LifetimeHistogram()
+    assert len(tail.read()) == 0     # nothing dumped yet
+
+    with open(temp, 'wb') as f:
+        for start in range(0, 20000, 7001):
+            records[start:min(start + 7001, 20000)].tofile(f)
+            f.flush()
+            while len(new := tail.read()):
+                assert np.all(new['channel'] > 0)
+                engine.feed(new)
+        rest = records[20000:].tobytes()
+        f.write(rest[:5000 * 16 + 5])    # the last record is not complete yet
+        f.flush()
+        while len(new := tail.read()):
+            engine.feed(new)
+        assert tail.offset == 25000 * 16
+        f.write(rest[5000 * 16 + 5:])
+
+    flip_neg_channels(temp, in_place=True)
+    os.replace(temp, file)          # note: the tail has no open handle, so this also works on Windows
+    while len(new := tail.read()):
+        engine.feed(new)
+
+    assert tail.file == file and tail.offset == len(records) * 16
+    expected = lifetime_histogram(file)
+    result = engine.finish()
+    for name in expected:
+        np.testing.assert_array_equal(result[name], expected[name])
+
+
+def test_tail_ignores_older_scan(tmp_path):
+    # a scan file of the same name from before is not read while the new scan has not started
+    file = str(tmp_path / 'scan.timeres')
+    write_synthetic_timeres(file, 100)
+    tail = TimeresTail(temp_timeres_file(file), renamed_to=file)
+    assert tail.available() == 0 and len(tail.read()) == 0
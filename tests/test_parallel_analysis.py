@@ -0,0 +1,53 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.AnalysisRunner import AnalysisCancelled
+from Code.SpectroGUILibrary.HistogramEngines import run_engines, LifetimeHistogram, CountrateHistogram, \
+    CorrelationHistogram, SignalCounter
+from Code.SpectroGUILibrary.ParallelAnalysis import parallel_run_engines
+from Code.SpectroGUILibrary.TimeresFile import write_synthetic_timeres
+
+
+def make_engines():
+    return [LifetimeHistogram(), CountrateHistogram(bins=100, binsize=10 ** 8), CorrelationHistogram(), SignalCounter()]
+
+
+@pytest.fixture(scope='module')
+def timeres(tmp_path_factory):
+    file = str(tmp_path_factory.mktemp('parallel') / 'synthetic.timeres')
+    write_synthetic_timeres(file, 200000, channels=(1, 2, 3, 4))
+    return file
+
+
+def test_segments_match_single_pass(timeres):
+    expected = run_engines(timeres, make_engines())
+    fractions = []
+    # 3 workers x 4 segments, two per worker submitted at a time
+    results = parallel_run_engines(timeres, make_engines(), n_workers=3, chunk_size=5000, min_segment_records=10000,
+                                   progress=fractions.append)
+    for result, expect in zip(results, expected):
+        for name in expect:
+            np.testing.assert_array_equal(result[name], expect[name])
+    assert fractions[-1] == 1.0 and len(set(fractions)) > 2    # progress is reported along the way
+
+
+def test_cancel_stops_workers(timeres):
+    cancel = threading.Event()
+    timer = threading.Timer(0.2, cancel.set)
+    t_start = time.perf_counter()
+    timer.start()
+    with pytest.raises(AnalysisCancelled):
+        # small chunks and segments: takes much longer than the time it may take to stop
+        parallel_run_engines(timeres, make_engines(), n_workers=2, chunk_size=200, min_segment_records=2000,
+                             cancel=cancel)
+    assert time.perf_counter() - t_start < 1.5     # the whole run takes about 3 s
+
+
+def test_cancel_before_start(timeres):
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(AnalysisCancelled):
+        parallel_run_engines(timeres, make_engines(), cancel=cancel, min_segment_records=10 ** 9)   # single pass
@@ -0,0 +1,151 @@
+import time
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.legend import Legend
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from Code.SpectroGUILibrary.PlotArtists import LinePlot, ColorRowPlot
+
+X = np.arange(625) * 20
+
+
+def line_plot(n_channels=3):
+    fig = Figure(figsize=(8, 5), dpi=100)
+    FigureCanvasAgg(fig)
+    plot = LinePlot(fig)
+    rng = np.random.default_rng(0)
+    for c in range(n_channels):
+        plot.set_line(f'h{c}', X, rng.poisson(100, len(X)), label=f'ch.{c}')
+    plot.ax.set_title('Lifetime')
+    plot.ax.set_xlabel('time [ps]')
+    plot.update_legend()
+    plot.set_limits(xlim=(0, X[-1]), ylim=(0, 200))
+    plot.draw_now()
+    return plot
+
+
+def lifetime_plot(n_channels=24, seed=0):
+    # decays after a peak at 5 ns on a flat background, like 'benchmark_redraw'
+    rng = np.random.default_rng(seed)
+    plot = line_plot(n_channels=0)
+    for c in range(n_channels):
+        plot.set_line(f'h{c}', X, lifetime_counts(rng, tau=rng.uniform(500, 3000)), label=f'ch.{c}')
+    plot.update_legend()
+    plot.set_limits(ylim=(0, 2200))
+    plot.draw_now()
+    return plot
+
+
+def lifetime_counts(rng, tau):
+    return rng.poisson(10 + np.where(X >= 5000, 2000 * np.exp(-(X - 5000) / tau), 0))
+
+
+def pixels(plot):
+    return np.asarray(plot.fig.canvas.buffer_rgba()).copy()
+
+
+def count_draws(artist):
+    calls = []
+    draw = artist.draw
+    artist.draw = lambda renderer: (calls.append(1), draw(renderer))
+    return calls
+
+
+def test_blit_matches_full_draw():
+    plot = line_plot()
+    plot.set_ydata('h0', np.full(len(X), 150))
+    plot.set_visible({'h1': False})
+    plot.update_legend()
+    plot.set_limits(xlim=(1000, 9000), ylim=(1, 300), yscale='log')
+    plot.redraw(full=False)
+    blitted = pixels(plot)
+    plot.draw_now()
+    assert np.array_equal(blitted, pixels(plot))
+
+
+def test_color_rows_blit_matches_full_draw():
+    fig = Figure(figsize=(8, 5), dpi=100)
+    FigureCanvasAgg(fig)
+    plot = ColorRowPlot(fig)
+    rows = {f'h{c}': np.random.default_rng(c).poisson(100, len(X)) for c in range(3)}
+    plot.set_rows(X, rows)
+    plot.set_clim(0, 200)
+    plot.draw_now()
+    plot.set_rows(X, {name: rows[name] for name in ('h0', 'h2')})
+    plot.set_clim(0, 150)
+    plot.set_limits(xlim=(100, 9000))
+    plot.redraw(full=False)
+    blitted = pixels(plot)
+    plot.draw_now()
+    assert np.array_equal(blitted, pixels(plot))
+
+
+def test_only_changed_axes_are_redrawn():
+    plot = line_plot()
+    x_draws, y_draws = count_draws(plot.ax.xaxis), count_draws(plot.ax.yaxis)
+    plot.set_ydata('h0', np.full(len(X), 150))
+    plot.set_visible({'h1': False})
+    plot.update_legend()
+    plot.redraw(full=False)
+    assert (len(x_draws), len(y_draws)) == (0, 0)
+    plot.set_limits(xlim=(0, 5000))
+    plot.redraw(full=False)
+    assert (len(x_draws), len(y_draws)) == (1, 0)
+    plot.set_limits(yscale='log', ylim=(1, 200))
+    plot.redraw(full=False)
+    assert (len(x_draws), len(y_draws)) == (2, 1)
+
+
+def test_set_limits_does_not_call_xlim_callbacks():
+    # the GUI updates its lines after set_limits itself, the callback is for zooming with the toolbar
+    plot = line_plot()
+    calls = []
+    plot.ax.callbacks.connect('xlim_changed', lambda ax: calls.append(ax.get_xlim()))
+    assert plot.set_limits(xlim=(0, 5000))
+    assert not plot.set_limits(xlim=(0, 5000))
+    assert calls == []
+    plot.ax.set_xlim(0, 6000)
+    assert calls == [(0, 6000)]
+
+
+def fastest(update, repeat=5):
+    times = []
+    for i in range(repeat):
+        t_start = time.perf_counter()
+        update(i)
+        times.append(time.perf_counter() - t_start)
+    return min(times)
+
+
+def test_legend_is_only_drawn_when_it_changes(monkeypatch):
+    plot = lifetime_plot(n_channels=24)
+    calls = []
+    draw = Legend.draw
+    monkeypatch.setattr(Legend, 'draw', lambda legend, renderer: (calls.append(1), draw(legend, renderer)))
+    for i in range(3):
+        plot.set_ydata('h0', np.full(len(X), 100 + i))
+        plot.redraw(full=False)
+    plot.set_limits(xlim=(0, 5000), yscale='log', ylim=(1, 200))
+    plot.redraw(full=False)
+    plot.draw_now()
+    assert calls == []
+    plot.set_visible({'h3': False})
+    assert plot.update_legend()
+    plot.redraw(full=False)
+    plot.redraw(full=False)
+    assert calls == [1]
+
+
+def test_blit_is_faster_than_full_draw():
+    # the size of the Lifetime tab with every channel shown, where the legend is the slowest artist to draw
+    plot = lifetime_plot(n_channels=24)
+    rng = np.random.default_rng(1)
+
+    t_full = fastest(lambda i: plot.draw_now())
+    t_legend = fastest(lambda i: plot.ax.get_legend().draw(plot.fig.canvas.get_renderer()))
+    t_data = fastest(lambda i: ([plot.set_ydata(name, lifetime_counts(rng, tau=1000)) for name in plot.lines],
+                                plot.redraw(full=False)))
+    t_range = fastest(lambda i: (plot.set_limits(xlim=(0, 10000 + 100 * i)), plot.redraw(full=False)))
+    assert t_data < 0.6 * t_full
+    assert t_data < 0.6 * t_legend
+    assert t_range < 0.8 * t_full
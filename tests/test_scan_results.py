@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary import ScanResults as scan_results
+from Code.SpectroGUILibrary.ScanResults import ScanResults
+
+FORMATS = ['npz', pytest.param('h5', marks=pytest.mark.skipif(scan_results.h5py is None, reason="needs h5py"))]
+
+
+def make_scan():
+    rng = np.random.default_rng(0)
+    results = {'lifetime': {name: rng.poisson(20, 625) for name in ('h2', 'h3', 'h4')},
+               'countrate': {'h2': rng.poisson(5, 50).astype(float)},
+               'signal': {1: 1000, 2: 250, -3: 7}}
+    axes = {'lifetime': np.arange(625) * 20, 'countrate': np.arange(50) * 10 ** 10}
+    channels = {'h2': {'name': 'ch2', 'wavelength': 729.1, 'counts': 1234, 'lifetime ok': True,
+                       'lifetimes': np.array([850.0]), 'color': (0.1, 0.2, 0.3)}}
+    params = {'scantime': 5.0, 'nm': 730.0, 'backend': 'numpy', 'analyses': ('lifetime', 'countrate', 'signal'),
+              'g2_channels': None}
+    return ScanResults(results, axes, channels, params)
+
+
+@pytest.fixture
+def timeres(tmp_path):
+    file = tmp_path / 'scan.timeres'
+    file.write_bytes(bytes(range(256)) * 10)
+    return str(file)
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_round_trip(timeres, fmt):
+    scan = make_scan()
+    path = scan.save(timeres, h5=fmt == 'h5')
+    assert path == timeres + '.results.' + fmt and ScanResults.find(timeres) == path
+    loaded = ScanResults.load(timeres)
+    for analysis in ('lifetime', 'countrate'):
+        assert loaded.results[analysis].keys() == scan.results[analysis].keys()
+        for name, values in scan.results[analysis].items():
+            np.testing.assert_array_equal(loaded.results[analysis][name], values)
+        np.testing.assert_array_equal(loaded.axes[analysis], scan.axes[analysis])
+    assert loaded.results['signal'] == scan.results['signal']
+    # only the numeric channel fields
+    assert loaded.channels['h2'].keys() == {'wavelength', 'counts', 'lifetime ok', 'lifetimes'}
+    assert loaded.channels['h2']['wavelength'] == 729.1 and loaded.channels['h2']['lifetime ok'] is True
+    assert loaded.params['scantime'] == 5.0 and loaded.info['size'] == 2560
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_outdated_after_the_file_changed(timeres, fmt):
+    make_scan().save(timeres, h5=fmt == 'h5')
+    assert ScanResults.load(timeres) is not None
+    stat = os.stat(timeres)
+    os.utime(timeres, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))    # same size, other modification time
+    assert ScanResults.load(timeres) is None
+    assert ScanResults.load(timeres, check=False) is not None
+    make_scan().save(timeres, h5=fmt == 'h5')
+    with open(timeres, 'ab') as f:
+        f.write(b'\0' * 16)
+    os.utime(timeres, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))    # other size
+    assert ScanResults.load(timeres) is None
+
+
+def test_unreadable_or_missing_results(timeres):
+    assert ScanResults.load(timeres) is None
+    with open(ScanResults.results_file(timeres, h5=False), 'wb') as f:
+        f.write(b'not a zip file')
+    assert ScanResults.load(timeres) is None
+
+
+def test_matches_params(timeres):
+    make_scan().save(timeres, h5=False)
+    scan = ScanResults.load(timeres)
+    assert scan.matches_params({'scantime': 5, 'backend': 'numpy', 'analyses': ['lifetime', 'countrate', 'signal'],
+                                'g2_channels': None})
+    assert scan.matches_params({'analyses': ('lifetime', 'countrate', 'signal')})    # as saved, a list
+    assert not scan.matches_params({'scantime': 10})
+    assert not scan.matches_params({'analyses': ('lifetime',)})
+    assert not scan.matches_params({'recipes': {}})                   # not saved
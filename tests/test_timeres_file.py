@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from Code.SpectroGUILibrary.TimeresFile import TIMERES_DTYPE, flip_neg_channels, write_synthetic_timeres
+
+
+def flip_reference(old_file, new_file, bad_ch):
+    # the original record by record version of the acquisition script
+    with open(old_file, "rb") as f:
+        data = f.read()
+    with open(new_file, "wb") as output_file:
+        for i in range(len(data) // 16):
+            binary_line = data[16 * i:16 * (i + 1)]
+            channel_int = int.from_bytes(binary_line[4:8], 'little', signed=True)
+            if channel_int in bad_ch:
+                binary_line = binary_line[:4] + abs(channel_int).to_bytes(4, 'little', signed=True) + binary_line[8:]
+            output_file.write(binary_line)
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 2 ** 22])
+def test_flip_matches_reference(tmp_path, chunk_size):
+    old, new, ref = (str(tmp_path / name) for name in ('old.timeres', 'new.timeres', 'ref.timeres'))
+    write_synthetic_timeres(old, 5003, channels=(1, -1, -2, -3, -4, -5))
+    bad_ch = (-1, -2, -3, -4)
+    flip_reference(old, ref, bad_ch)
+
+    n_changed = flip_neg_channels(old, new, bad_ch=bad_ch, chunk_size=chunk_size)
+    with open(new, "rb") as f_new, open(ref, "rb") as f_ref:
+        assert f_new.read() == f_ref.read()
+    channels = np.fromfile(old, dtype=TIMERES_DTYPE)['channel']
+    assert n_changed == np.isin(channels, bad_ch).sum()
+    assert -5 in np.fromfile(new, dtype=TIMERES_DTYPE)['channel']     # not in bad_ch, left alone
+
+
+def test_flip_in_place(tmp_path):
+    old, ref = str(tmp_path / 'old.timeres'), str(tmp_path / 'ref.timeres')
+    write_synthetic_timeres(old, 2500)
+    flip_reference(old, ref, (-1, -2, -3, -4))
+
+    flip_neg_channels(old, in_place=True, chunk_size=333)
+    with open(old, "rb") as f_old, open(ref, "rb") as f_ref:
+        assert f_old.read() == f_ref.read()
+
+
+def test_flip_empty_file(tmp_path):
+    old, new = tmp_path / 'old.timeres', tmp_path / 'new.timeres'
+    old.write_bytes(b'')
+    assert flip_neg_channels(str(old), str(new)) == 0
+    assert new.read_bytes() == b''
@@ -0,0 +1,92 @@
+import time
+import pytest
+
+from Code.RetinaFiles.src.WebSQController import WebSQController
+from Code.SpectroGUILibrary.WebSQSimulator import WebSQSimulator
+from conftest import free_port
+
+
+@pytest.fixture
+def simulator():
+    sim = WebSQSimulator(api_port=free_port(), ws_port=free_port(), n_channels=4, int_time=10, seed=0).start()
+    yield sim
+    sim.stop()
+
+
+def counted_requests(sq, batch_error=None):
+    # records the JSON RPC methods of every HTTP request, optionally answering batches with an error
+    requests = []
+    request = sq.request
+
+    def wrapped(params=None, payload=None):
+        if isinstance(payload, list):
+            requests.append([call['method'] for call in payload])
+            if batch_error is not None:
+                raise batch_error
+        elif payload is not None:
+            requests.append(payload['method'])
+        return request(params=params, payload=payload)
+    sq.request = wrapped
+    return requests
+
+
+def finished_sweep(sq):
+    sq.startIv(8, 10, 1, 10)
+    t_start = time.monotonic()
+    while not all(len(trace['biasI']) == 3 for trace in sq.getIvData().values()):
+        assert time.monotonic() - t_start < 5
+        time.sleep(0.01)
+
+
+def test_iv_data_batch_is_opt_in(simulator):
+    sq = WebSQController(simulator.domain, settings_ttl=0)
+    finished_sweep(sq)
+    requests = counted_requests(sq)
+    single = sq.getIvData()
+    assert requests == ['getSettings', 'getIvData']
+    assert sq.getIvData(batch=True) == single
+    assert requests[2:] == [['getSettings', 'getIvData']]
+    assert len(single) == 4 and all(len(trace['biasI']) == 3 for trace in single.values())
+
+
+def test_iv_data_falls_back_without_batch_support(simulator):
+    sq = WebSQController(simulator.domain, settings_ttl=0)
+    finished_sweep(sq)
+    expected = sq.getIvData()
+    requests = counted_requests(sq, batch_error=AssertionError("Got HTTP 400 with batch not supported"))
+    assert sq.getIvData(batch=True) == expected
+    assert requests == [['getSettings', 'getIvData'], 'getSettings', 'getIvData']
+
+
+def test_settings_changed_while_retrieved_are_not_cached(simulator):
+    sq = WebSQController(simulator.domain, settings_ttl=60)
+    request = sq.request
+
+    def changed_meanwhile(params=None, payload=None):
+        # another thread (e.g. of AsyncWebSQController) changes the settings while these are on their way
+        response = request(params=params, payload=payload)
+        if payload and payload['method'] == 'getSettings':
+            sq.setBiasIuA(9.5, selectedCus=['1'], settings=response['result'])
+        return response
+    sq.request = changed_meanwhile
+    stale = sq.getSettings()
+    sq.request = request
+    requests = counted_requests(sq)
+    fresh = sq.getSettings()
+    assert requests == ['getSettings']
+    assert fresh is not stale and fresh['devices']['1']['channels']['1']['configuration']['biasI'] == \
+        pytest.approx(9.5e-6)
+    assert sq.getSettings() is fresh and requests == ['getSettings']    # cached now
+
+
+def test_per_integration_data_is_never_cached(simulator):
+    sq = WebSQController(simulator.domain, settings_ttl=60)
+    sq.getSettings()
+    requests = counted_requests(sq)
+    sq.getRankMap()
+    assert requests == []
+    sq.getCountsHistoryById(1)
+    sq.getTemperatures()
+    sq.getChannelInformationByLoc(1, 1, 'data')
+    sq.getCounts()
+    assert requests == ['getSettings'] * 4
@@ -0,0 +1,54 @@
+import struct
+import numpy as np
+import pytest
+
+from Code.RetinaFiles.src.WebSQSocketController import PACKET_DTYPE, decode_counts, decode_counts_array, \
+    decode_counts_struct, synthetic_package
+
+
+def package(values):
+    # one raw channel per dict of field values, the rest zero
+    raw = np.zeros(len(values), dtype=PACKET_DTYPE)
+    for i, channel in enumerate(values):
+        for name, value in channel.items():
+            raw[name][i] = value
+    return raw.tobytes()
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+@pytest.mark.parametrize('seed', range(5))
+def test_frombuffer_matches_struct(seed, normalized):
+    message = synthetic_package(n_channels=48, inttime=1 + seed * 7, seed=seed)
+    assert decode_counts(message, normalized=normalized) == decode_counts_struct(message, normalized=normalized)
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+def test_frombuffer_matches_struct_edge_values(normalized):
+    # inttime that does not divide a second, the largest counts (no overflow when normalized), negative floats
+    message = package([
+        {'mcuId': 255, 'cuId': 12, 'cuStatus': 3, 'monitorV': -1.5e-3, 'biasI': 12.25, 'counts': 2 ** 32 - 1,
+         'inttime': 1, 'rank': 2 ** 32 - 1, 'time': 1.7e9 + 0.125},
+        {'mcuId': 1, 'cuId': 1, 'counts': 123456, 'inttime': 3, 'rank': 7, 'time': -1.0},
+        {'counts': 1, 'inttime': 100},
+    ])
+    assert decode_counts(message, normalized=normalized) == decode_counts_struct(message, normalized=normalized)
+
+
+def test_frombuffer_field_layout():
+    # the fields are where the struct decoder reads them
+    message = synthetic_package(n_channels=3, seed=1)
+    channels = decode_counts_array(message)
+    for i, channel in enumerate(channels):
+        raw = message[i * 32:(i + 1) * 32]
+        assert channel['counts'] == struct.unpack('<I', raw[12:16])[0]
+        assert channel['inttime'] == struct.unpack('<I', raw[16:20])[0] * 10
+        assert channel['time'] == struct.unpack('<d', raw[24:32])[0]
+
+
+def test_zero_inttime_and_empty_package():
+    # note: the struct decoder divides by zero here, the array decoder gives 0 counts per second
+    channels = decode_counts_array(package([{'counts': 50, 'inttime': 0}]), normalized=True)
+    assert channels['counts'].tolist() == [0]
+    assert decode_counts(package([{'counts': 50, 'inttime': 0}])) == \
+        decode_counts_struct(package([{'counts': 50, 'inttime': 0}]))
+    assert decode_counts(b'') == decode_counts_struct(b'') == []
@@ -0,0 +1,52 @@
+import asyncio
+import numpy as np
+import websockets
+
+from Code.RetinaFiles.src.WebSQSocketController import synthetic_package
+from Code.SpectroGUILibrary.WebSQRecording import FrameRecorder, ReplayServer, count_frames, read_recording
+from conftest import free_port
+
+
+def make_recording(file, n_frames=250, frames_per_chunk=100):
+    messages = [synthetic_package(n_channels=4, seed=i) for i in range(n_frames)]
+    with FrameRecorder(file, frames_per_chunk=frames_per_chunk) as recorder:
+        for i, message in enumerate(messages):
+            recorder.write(message, t=1000.0 + 0.01 * i)
+    return messages
+
+
+def receive(url, n):
+    async def client():
+        # note: with a bounded queue the client stops reading the flood of frames and never gets the close frame
+        async with websockets.connect(url + "/counts", max_queue=None) as websocket:
+            return [await websocket.recv() for _ in range(n)]
+    return asyncio.run(client())
+
+
+def test_recording_round_trip(tmp_path):
+    file = str(tmp_path / 'run.wsqrec')
+    messages = make_recording(file)
+    frames = list(read_recording(file))
+    assert [message for t, message in frames] == messages
+    assert np.allclose([t for t, message in frames], 1000.0 + 0.01 * np.arange(len(messages)))
+    assert count_frames(file) == len(messages)
+
+    # a cut-off last chunk is left out
+    with open(file, 'rb') as f:
+        data = f.read()
+    with open(file, 'wb') as f:
+        f.write(data[:-10])
+    assert count_frames(file) == len(list(read_recording(file))) == 200
+
+
+def test_replay_reads_the_file_per_client(tmp_path):
+    file = str(tmp_path / 'run.wsqrec')
+    messages = make_recording(file)
+    server = ReplayServer(file, port=free_port(), speed=0, repeat=True).start()
+    try:
+        assert server.n_frames == len(messages)
+        # repeats by reading the file again, and every client starts at the beginning
+        assert receive(server.url(), 2 * len(messages) + 10) == 2 * messages + messages[:10]
+        assert receive(server.url(), 5) == messages[:5]
+    finally:
+        server.stop()
@@ -0,0 +1,64 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+import websockets
+
+from Code.RetinaFiles.src.WebSQController import WebSQController
+from Code.RetinaFiles.src.WebSQSocketController import decode_counts_array
+from Code.SpectroGUILibrary.WebSQSimulator import WebSQSimulator
+from conftest import free_port
+
+
+@pytest.fixture
+def simulator():
+    sim = WebSQSimulator(api_port=free_port(), ws_port=free_port(), n_channels=4, channels_per_mcu=2, int_time=10,
+                         seed=0).start()
+    yield sim
+    sim.stop()
+
+
+def test_settings_and_setters(simulator):
+    sq = WebSQController(simulator.domain, settings_ttl=0)
+    settings = sq.getSettings()
+    assert settings['total_channels'] == 4 and sorted(settings['devices']) == ['1', '2']
+    assert sq.getRankMap() == {'1': [1, 1], '2': [1, 2], '3': [2, 1], '4': [2, 2]}
+
+    sq.setBiasI(8e-6, selectedCus=['3'])
+    assert sq.getBiasI(selectedCus=['3']) == pytest.approx([8e-6])
+    assert simulator.retina.bias[2] == pytest.approx(8e-6)
+    sq.setTriggerV(0.25)
+    assert sq.getTriggerV() == pytest.approx([0.25] * 4)
+    sq.setIntTime(20)
+    assert sq.getIntTime() == 20
+
+    counts = sq.getCounts()
+    assert sorted(counts) == [(1, 1), (1, 2), (2, 1), (2, 2)]
+    assert all(data['counts'] >= 0 and {'time', 'monitorV'} <= set(data) for data in counts.values())
+
+
+def test_iv_sweep(simulator):
+    sq = WebSQController(simulator.domain, settings_ttl=0)
+    sq.startIv(8, 10, 1, 10, selectedCus=['1', '2'])
+    t_start = time.monotonic()
+    while True:
+        traces = sq.getIvData(selectedCus=['1', '2'])
+        if all(len(trace['biasI']) == 3 for trace in traces.values()):
+            break
+        assert time.monotonic() - t_start < 5
+        time.sleep(0.01)
+    for trace in traces.values():
+        assert trace['biasI'] == pytest.approx([8e-6, 9e-6, 10e-6])
+        assert len(trace['counts']) == len(trace['monitorV']) == 3
+    assert sq.getIvTimeStamp() is not None and sq.getIvIntTime() == pytest.approx(10)
+
+
+def test_counts_frame_decodes(simulator):
+    async def receive():
+        async with websockets.connect(simulator.ws_url + "/counts") as websocket:
+            return await websocket.recv()
+    channels = decode_counts_array(asyncio.run(receive()))
+    assert channels['rank'].tolist() == [1, 2, 3, 4]
+    assert channels['mcuId'].tolist() == [1, 1, 2, 2] and channels['cuId'].tolist() == [1, 2, 1, 2]
+    assert np.all(channels['inttime'] == 10)
+    assert np.all(channels['counts'] >= 0)